@@ -0,0 +1,806 @@
+import gc
+import sys
+import pickle
+import multiprocessing
+import asyncio
+import time
+import random
+import numpy
+import subprocess
+import tempfile
+import tracemalloc
+from typing import Callable, List
+from collections import OrderedDict
+import spacy
+from waterwheel import WaterWheel
+from waterwheel.waterwheel import DOC_BIN_FILE
+from waterwheel.export import load_columns
+from waterwheel.candidates import AliasIndex, CandidateTable
+from waterwheel.network import RiverNetwork
+from waterwheel.index import IndexWriter, InvertedIndex
+from waterwheel.memory import rss
+from waterwheel.aio import AsyncWaterWheel
+from waterwheel.docbin import read_doc_bin
+from waterwheel.stream import EntityStream
+from spacy.tokens import DocBin
+
+sample_sentences = [
+    'The ultimate source of the Mackenzie River is Thutade Lake.',
+    'The River Cherwell is a major tributary of the River Thames in central England.',
+    'Lakes Ontario and Erie were created, along with the Saint Lawrence River.',
+    'The Mackenzie River flows from the Great Slave Lake into the Arctic Ocean.',
+    'Some address is university avenue, AB, canada or NY, usa.',
+    'Patients should have had a CT scan showing bilateral infiltrates.',
+    'Aggregated gridded soil texture dataset for Mississippi/Missouri Rivers.',
+    'There is no waterbody in this sentence.',
+]
+
+def sample_texts(n: int = 10000):
+    """Build a synthetic corpus by cycling through sample sentences.
+
+    Parameters
+    ----------
+    n : int
+        Number of texts to build.
+
+    Returns
+    -------
+    texts : List[str]
+        The sample texts.
+    """
+
+    return [sample_sentences[i % len(sample_sentences)] for i in range(n)]
+
+def measure(fn: Callable, *args):
+    """Run a function while tracing memory allocations.
+
+    Parameters
+    ----------
+    fn : Callable
+        The function to benchmark.
+
+    Returns
+    -------
+    seconds : float
+        Wall clock time of the call.
+    peak : int
+        Peak traced memory in bytes.
+    blocks : int
+        Number of memory blocks still allocated after the call.
+    """
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    seconds = time.perf_counter() - start
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics('filename'))
+    del result
+    return seconds, peak, blocks
+
+def report(name: str, n: int, seconds: float, peak: int, blocks: int):
+    """Print a single benchmark result line."""
+    print(f'{name:<24} {n / seconds:>10.1f} docs/s {peak / 2**20:>8.1f} MiB peak {blocks:>10} blocks')
+
+def bench_extract(n: int = 10000):
+    """Compare WaterWheel.extract against reading spans from doc.ents."""
+
+    nlp = spacy.load('en_core_web_sm')
+    ww = WaterWheel(nlp)
+    nlp.add_pipe(ww)
+    texts = sample_texts(n)
+
+    def span_path(texts: List[str]):
+        return [
+            [(ent.start_char, ent.end_char, ent.label_, ent._.wikilink) for ent in doc.ents]
+            for doc in nlp.pipe(texts, batch_size=1000)
+        ]
+
+    def extract_path(texts: List[str]):
+        return list(ww.extract(texts, batch_size=1000))
+
+    report('span path', n, *measure(span_path, texts))
+    report('extract', n, *measure(extract_path, texts))
+
+def bench_export(n: int = 100000):
+    """Compare columnar export against converting doc.ents into dicts."""
+
+    nlp = spacy.load('en_core_web_sm')
+    ww = WaterWheel(nlp)
+    nlp.add_pipe(ww)
+    texts = sample_texts(n)
+
+    def dict_path(texts: List[str]):
+        return [
+            {'doc': i, 'start_char': ent.start_char, 'end_char': ent.end_char,
+             'start': ent.start, 'end': ent.end, 'label': ent.label_, 'wikilink': ent._.wikilink}
+            for i, doc in enumerate(nlp.pipe(texts, batch_size=1000)) for ent in doc.ents
+        ]
+
+    def export_path(texts: List[str]):
+        with tempfile.TemporaryDirectory() as path:
+            ww.export(texts, path, batch_size=1000, chunk_size=100000)
+            return load_columns(path)
+
+    report('dict path', n, *measure(dict_path, texts))
+    report('columnar export', n, *measure(export_path, texts))
+
+def bench_load():
+    """Time import plus construction of WaterWheel in blocking and background mode."""
+
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import waterwheel'], check=True)
+    print(f'import (fresh interpreter) {time.perf_counter() - start:>8.3f} s')
+    nlp = spacy.load('en_core_web_sm')
+    start = time.perf_counter()
+    WaterWheel(nlp)
+    print(f'blocking construction      {time.perf_counter() - start:>8.3f} s')
+    start = time.perf_counter()
+    ww = WaterWheel(nlp, background=True)
+    returned = time.perf_counter() - start
+    ww.wait()
+    print(f'background construction    {returned:>8.3f} s (ready after {time.perf_counter() - start:.3f} s)')
+
+def perturb(name: str, rng: random.Random):
+    """Add an accent to, or make a single typo in, a name."""
+    accents = {'a': 'á', 'e': 'é', 'i': 'í', 'o': 'ó', 'u': 'ú', 'n': 'ñ'}
+    i = rng.randrange(1, len(name) - 1)
+    edit = rng.choice(['accent', 'substitute', 'delete', 'transpose'])
+    if edit == 'accent' and any(c in accents for c in name):
+        i = rng.choice([j for j, c in enumerate(name) if c in accents])
+        return name[:i] + accents[name[i]] + name[i+1:]
+    if edit == 'substitute':
+        return name[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz') + name[i+1:]
+    if edit == 'delete':
+        return name[:i] + name[i+1:]
+    return name[:i-1] + name[i] + name[i-1] + name[i+1:]
+
+def bench_fuzzy(n: int = 1000, seed: int = 0):
+    """Measure recall on perturbed gazetteer names and throughput with and without the fuzzy matcher."""
+
+    nlp = spacy.load('en_core_web_sm')
+    exact = WaterWheel(nlp)
+    fuzzy = WaterWheel(nlp, fuzzy=True)
+    rng = random.Random(seed)
+    names = sorted(
+        name for label in ['LAKE', 'RIVER', 'MOUNTAIN'] for name in exact.gazetteer.wikidata[label]
+        if len(name) >= 6 and name.replace(' ', '').isalpha()
+    )
+    texts, spans = [], []
+    for name in rng.sample(names, n):
+        mention = perturb(name, rng).title()
+        text = f'Samples were taken near {mention} last year.'
+        texts.append(text)
+        spans.append((text.index(mention), text.index(mention) + len(mention)))
+    corpus = sample_texts(n)
+    for name, ww in [('exact', exact), ('fuzzy', fuzzy)]:
+        found = sum(
+            any(entity.start_char <= start and end <= entity.end_char for entity in entities)
+            for entities, (start, end) in zip(ww.extract(texts), spans)
+        )
+        start = time.perf_counter()
+        n_entities = sum(len(entities) for entities in ww.extract(corpus))
+        seconds = time.perf_counter() - start
+        print(f'{name:<8} recall {found / n:>6.1%} {n / seconds:>10.1f} docs/s {n_entities:>8} entities on sample texts')
+
+def bench_candidates():
+    """Report the memory overhead of keeping every candidate of ambiguous names."""
+
+    nlp = spacy.load('en_core_web_sm')
+    ww = WaterWheel(nlp)
+    for label, table in ww.gazetteer.candidates.items():
+        top1 = sys.getsizeof(ww.gazetteer.wikidata[label]) + sum(sys.getsizeof(qid) for qid in ww.gazetteer.wikidata[label].values())
+        print(f'{label:<18} {len(table):>7} names {table.n_ambiguous():>6} ambiguous '
+              f'{table.nbytes() / 2**20:>6.1f} MiB candidates {top1 / 2**20:>6.1f} MiB top-1 links')
+
+def bench_geo(n: int = 500, seed: int = 0):
+    """Measure linking accuracy and throughput of geographic disambiguation
+    on synthetic documents: an ambiguous lake mentioned next to the two
+    unambiguous lakes closest to the intended candidate. Candidates get
+    random coordinates since the shipped gazetteer may lack them.
+    """
+
+    nlp = spacy.load('en_core_web_sm')
+    ww = WaterWheel(nlp)
+    rng = random.Random(seed)
+    table = ww.gazetteer.candidates['LAKE']
+    rows = [
+        (name, qid, prior, rng.uniform(-60, 70), rng.uniform(-180, 180), None)
+        for name in table._index for qid, prior in table.get(name)
+    ]
+    ww.gazetteer.candidates['LAKE'] = table = CandidateTable.from_rows(rows)
+    names = [name for name in table._index if name.isalpha() and name not in ww.gazetteer.stop_words]
+    ambiguous = [name for name in names if table.count(name) > 1]
+    unambiguous = [name for name in names if table.count(name) == 1]
+    coordinates = numpy.array([table.coordinates(name)[1:3] for name in unambiguous], dtype=float)[:, :, 0]
+    texts, gold = [], []
+    for name in rng.sample(ambiguous, n):
+        qids, lats, lons, _ = table.coordinates(name)
+        target = rng.randrange(len(qids))
+        distances = (coordinates[:, 0] - lats[target]) ** 2 + (coordinates[:, 1] - lons[target]) ** 2
+        near = [unambiguous[i] for i in numpy.argsort(distances)[:2]]
+        texts.append(f'{name.title()} Lake drains into {near[0].title()} Lake and {near[1].title()} Lake.')
+        gold.append('Q' + str(qids[target]))
+    for mode in [False, True]:
+        ww._geo_disambiguation = mode
+        start = time.perf_counter()
+        results = list(ww.extract(texts))
+        seconds = time.perf_counter() - start
+        correct = sum(any(entity.qid == qid for entity in entities) for entities, qid in zip(results, gold))
+        print(f'geo_disambiguation={mode!s:<5} accuracy {correct / n:>6.1%} {n / seconds:>10.1f} docs/s')
+
+def bench_memory_mode(compact: int = 0):
+    """Print the memory report of a WaterWheel loaded in the given mode."""
+
+    nlp = spacy.load('en_core_web_sm')
+    ww = WaterWheel(nlp, compact=bool(compact))
+    list(ww.extract(sample_texts(1000)))
+    gc.collect()
+    print('compact' if compact else 'default')
+    for component, size in ww.memory_report().items():
+        print(f'  {component:<16} {size / 2**20:>8.1f} MiB')
+
+def bench_memory():
+    """Compare steady-state memory of the default and compact load modes,
+    each in a fresh interpreter."""
+
+    for compact in ['0', '1']:
+        subprocess.run([sys.executable, __file__, 'memory_mode', compact], check=True)
+
+def bench_long(n: int = 20000):
+    """Compare peak memory and time of a long text processed as one Doc and in windows."""
+
+    nlp = spacy.load('en_core_web_sm')
+    ww = WaterWheel(nlp)
+    text = ' '.join(sample_texts(n))
+    nlp.max_length = len(text) + 1
+    runs = [('single doc', lambda: list(ww.extract([text])))]
+    for window in [10000, 100000]:
+        runs.append((f'window {window}', lambda: list(ww.extract_long(text, window=window))))
+    for name, fn in runs:
+        seconds, peak, _ = measure(fn)
+        print(f'{name:<24} {seconds:>8.2f} s {peak / 2**20:>8.1f} MiB peak')
+
+def bench_network(n: int = 1000000, queries: int = 100000, seed: int = 0):
+    """Compare interval label ancestor checks to walking the mouths of a
+    random river network."""
+
+    rng = random.Random(seed)
+    mouths = [(f'Q{i}', f'Q{rng.randrange(1, i)}') for i in range(2, n)]
+    seconds, peak, _ = measure(RiverNetwork.from_edges, mouths)
+    print(f'build {n} nodes {seconds:>8.2f} s {peak / 2**20:>8.1f} MiB peak')
+    network = RiverNetwork.from_edges(mouths)
+    pairs = [(f'Q{rng.randrange(1, n)}', f'Q{rng.randrange(1, 100)}') for _ in range(queries)]
+    start = time.perf_counter()
+    upstream = [network.is_upstream(a, b) for a, b in pairs]
+    labels = time.perf_counter() - start
+    start = time.perf_counter()
+    walked = [b in network.downstream(a) for a, b in pairs]
+    walk = time.perf_counter() - start
+    assert upstream == walked
+    print(f'{queries} queries: intervals {labels:.3f} s, walking mouths {walk:.3f} s, {sum(upstream)} upstream')
+
+def bench_index(n_docs: int = 1000000, n_qids: int = 100000, seed: int = 0):
+    """Compare inverted index queries to scanning exported columns, on
+    synthetic annotations with Zipf distributed ids."""
+
+    rng = numpy.random.default_rng(seed)
+    n_rows = 3 * n_docs
+    columns = {
+        'doc': numpy.sort(rng.integers(0, n_docs, n_rows)),
+        'start_char': rng.integers(0, 10000, n_rows),
+        'label_id': rng.integers(1, 4, n_rows).astype(numpy.uint64),
+        'qid': numpy.minimum(rng.zipf(1.3, n_rows), n_qids),
+    }
+    columns['end_char'] = columns['start_char'] + rng.integers(1, 30, n_rows)
+    queries = ['Q' + str(q) for q in [1, 2, 10, 100, 1000, 10000]]
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        with IndexWriter(path, {1: 'RIVER', 2: 'LAKE', 3: 'OCEAN'}, segment_size=n_rows // 8) as writer:
+            writer.add_columns(columns, n_docs)
+        print(f'index {n_rows} rows {time.perf_counter() - start:>8.2f} s')
+        index = InvertedIndex(path)
+        for qid in queries:
+            start = time.perf_counter()
+            docs = index.docs(qid)
+            indexed = time.perf_counter() - start
+            start = time.perf_counter()
+            scanned = numpy.unique(columns['doc'][columns['qid'] == int(qid[1:])])
+            scan = time.perf_counter() - start
+            assert docs.tolist() == scanned.tolist()
+            print(f'{qid:<8} {len(docs):>8} docs index {indexed * 1000:>8.3f} ms scan {scan * 1000:>8.3f} ms')
+
+def bench_reload(n: int = 1000):
+    """Compare per document latency of extract_doc before and during a
+    background reload of the gazetteer."""
+
+    nlp = spacy.load('en_core_web_sm')
+    ww = WaterWheel(nlp)
+    docs = [nlp(text) for text in sample_texts(n)]
+
+    def latency(doc):
+        start = time.perf_counter()
+        ww.extract_doc(doc)
+        return time.perf_counter() - start
+
+    runs = [('steady', [latency(doc) for doc in docs])]
+    start = time.perf_counter()
+    future = ww.reload(DOC_BIN_FILE)
+    during = []
+    while not future.done():
+        during.extend(latency(doc) for doc in docs[:100])
+    seconds = time.perf_counter() - start
+    runs.append(('during reload', during))
+    future.result()
+    for name, latencies in runs:
+        p50, p99 = numpy.percentile(latencies, [50, 99]) * 1000
+        print(f'{name:<16} {len(latencies):>8} docs p50 {p50:>7.3f} ms p99 {p99:>7.3f} ms max {max(latencies) * 1000:>8.3f} ms')
+    print(f'reload {seconds:.1f} s, version {ww.version}')
+
+def gazetteer_texts(ww: WaterWheel, n: int = 2000, seed: int = 0):
+    """Build texts of 30 tokens where a fifth of the tokens start a gazetteer name."""
+    rng = random.Random(seed)
+    names = [name for label in ww.gazetteer.wikidata.values() for name in list(label)[:2000]]
+    fillers = ['the', 'of', 'and', 'river', 'lake', 'is', 'a', 'in', 'Mount', 'water', 'flows']
+    return [
+        ' '.join(rng.choice(names).title() if rng.random() < 0.2 else rng.choice(fillers) for _ in range(30)) + '.'
+        for _ in range(n)
+    ]
+
+def bench_engine_mode(engine: str):
+    """Print load time, memory and matching speed of a matching engine."""
+
+    nlp = spacy.load('en_core_web_sm')
+    rss_before = rss()
+    start = time.perf_counter()
+    ww = WaterWheel(nlp, engine=engine)
+    load = time.perf_counter() - start
+    gc.collect()
+    print(f'{engine:<16} load {load:>8.3f} s, matcher {ww.gazetteer.matcher_rss / 2**20:>7.1f} MiB, '
+          f'process growth {(rss() - rss_before) / 2**20:>7.1f} MiB')
+    docs = [nlp.make_doc(text) for text in gazetteer_texts(ww)]
+    start = time.perf_counter()
+    n_matches = sum(len(ww.gazetteer.matcher(doc)) for doc in docs)
+    seconds = time.perf_counter() - start
+    print(f'{"":<16} per doc  {n_matches / seconds:>12.0f} matches/s {len(docs) / seconds:>10.0f} docs/s')
+    start = time.perf_counter()
+    n_matches = sum(len(matches) for _, matches in ww.gazetteer.pipe(docs, batch_size=1000))
+    seconds = time.perf_counter() - start
+    print(f'{"":<16} batched  {n_matches / seconds:>12.0f} matches/s {len(docs) / seconds:>10.0f} docs/s')
+    texts = sample_texts(10000)
+    start = time.perf_counter()
+    list(ww.extract(texts, batch_size=1000))
+    print(f'{"":<16} extract  {len(texts) / (time.perf_counter() - start):>12.0f} docs/s (sample texts)')
+
+def bench_engines():
+    """Compare the PhraseMatcher and trie engines, each in a fresh interpreter."""
+
+    for engine in ['phrase_matcher', 'trie']:
+        subprocess.run([sys.executable, __file__, 'engine_mode', engine], check=True)
+
+def screening_texts(ww: WaterWheel, n: int = 5000, seed: int = 0):
+    """Build short title-like texts of gazetteer names in mixed casing,
+    qualifiers and filler words."""
+    rng = random.Random(seed)
+    names = [name for label in ww.gazetteer.wikidata.values() for name in list(label)[:3000]]
+    qualifiers = ['river', 'lake', 'mount', 'Lake', 'River', 'Mt.', 'ocean', 'rivers']
+    fillers = ['the', 'of', 'and', 'in', 'near', 'photo', 'trip', '2019', '-', ',', 'at', 'by', 'a']
+
+    def word():
+        r = rng.random()
+        if r < 0.3:
+            name = rng.choice(names)
+            return rng.choice([name, name.title(), name.upper()])
+        return rng.choice(qualifiers) if r < 0.4 else rng.choice(fillers)
+
+    return [' '.join(word() for _ in range(rng.randint(3, 10))) for _ in range(n)]
+
+def bench_raw(n: int = 5000):
+    """Compare agreement and speed of extract_raw against the spaCy path."""
+
+    nlp = spacy.load('en_core_web_sm')
+    ww = WaterWheel(nlp, engine='trie')
+    texts = screening_texts(ww, n)
+    start = time.perf_counter()
+    list(ww.extract_raw(texts[:1]))
+    print(f'raw matcher compiled in {time.perf_counter() - start:.1f} s')
+    start = time.perf_counter()
+    expected = [[entity[:4] for entity in entities] for entities in ww.extract(texts)]
+    spacy_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    found = [[entity[:4] for entity in entities] for entities in ww.extract_raw(texts)]
+    raw_seconds = time.perf_counter() - start
+    expected_set = set((i,) + entity for i, entities in enumerate(expected) for entity in entities)
+    found_set = set((i,) + entity for i, entities in enumerate(found) for entity in entities)
+    common = len(expected_set & found_set)
+    print(f'agreement: {sum(a == b for a, b in zip(expected, found)) / n:.2%} of texts, '
+          f'precision {common / max(len(found_set), 1):.2%}, recall {common / max(len(expected_set), 1):.2%} '
+          f'of {len(expected_set)} entities')
+    print(f'spacy path {n / spacy_seconds:>10.0f} texts/s')
+    print(f'raw path   {n / raw_seconds:>10.0f} texts/s')
+
+_async_ww = None
+
+def _async_pipeline():
+    # forked workers reuse the component loaded by bench_async.
+    return _async_ww
+
+async def _serve(annotate: Callable, texts: List[str], concurrency: int):
+    """Annotate texts from `concurrency` client coroutines while a ticker
+    measures how late the event loop wakes it up."""
+    loop = asyncio.get_event_loop()
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            start = loop.time()
+            await asyncio.sleep(0.001)
+            lags.append(loop.time() - start - 0.001)
+
+    async def client(queue: List[str]):
+        while queue:
+            await annotate(queue.pop())
+
+    queue = list(texts)
+    tick = asyncio.ensure_future(ticker())
+    start = time.perf_counter()
+    await asyncio.gather(*(client(queue) for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    done.set()
+    await tick
+    return seconds, numpy.array(lags) * 1000
+
+def bench_async(n: int = 5000, concurrency: int = 200):
+    """Event loop lag and throughput of concurrent clients annotating
+    inline, with AsyncWaterWheel threads and with worker processes."""
+
+    global _async_ww
+    nlp = spacy.load('en_core_web_sm')
+    _async_ww = ww = WaterWheel(nlp)
+    texts = sample_texts(n)
+
+    async def inline(text: str):
+        return ww.extract_doc(nlp(text))
+
+    async def run(mode: str):
+        if mode == 'inline':
+            return await _serve(inline, texts, concurrency)
+        async with AsyncWaterWheel(ww, max_in_flight=concurrency, processes=mode == 'processes',
+                                   n_workers=2 if mode == 'processes' else 1, pipeline=_async_pipeline) as aww:
+            await asyncio.gather(*(aww.annotate(text) for text in texts[:4]))
+            return await _serve(aww.annotate, texts, concurrency)
+
+    for mode in ('inline', 'threads', 'processes'):
+        seconds, lags = asyncio.run(run(mode))
+        print(f'{mode:<10} {n / seconds:>7.0f} docs/s   loop lag p50 {numpy.percentile(lags, 50):6.2f} ms  '
+              f'p99 {numpy.percentile(lags, 99):6.2f} ms  max {lags.max():7.2f} ms  ({len(lags)} ticks)')
+
+def soak_texts(n: int, seed: int = 0):
+    """Texts with tokens never seen before, like the ids and misspellings
+    of a real stream, that make the vocab grow."""
+    rng = random.Random(seed)
+    for i in range(n):
+        yield f'Station {i:x}-{rng.getrandbits(32):08x} reported: {sample_sentences[i % len(sample_sentences)]}'
+
+def bench_soak_mode(max_vocab_growth: int = 0, n: int = 2000000):
+    """Print the RSS and vocab size while extracting from a long stream."""
+
+    nlp = spacy.load('en_core_web_sm')
+    ww = WaterWheel(nlp, engine='trie', max_vocab_growth=max_vocab_growth)
+    print(f'max_vocab_growth={max_vocab_growth}')
+    start = time.perf_counter()
+    for i, _ in enumerate(ww.extract(soak_texts(n)), 1):
+        if i % (n // 10) == 0:
+            gc.collect()
+            print(f'  {i:>9} docs  rss {rss() / 2**20:>7.1f} MiB  vocab {len(nlp.vocab.strings):>9} strings  '
+                  f'{ww.n_recycles:>4} recycles  {i / (time.perf_counter() - start):>6.0f} docs/s')
+
+def bench_soak():
+    """Compare memory over a long stream without and with vocab recycling,
+    each in a fresh interpreter."""
+
+    for max_vocab_growth in ['0', '100000']:
+        subprocess.run([sys.executable, __file__, 'soak_mode', max_vocab_growth], check=True)
+
+def bench_doc_bins(docs_per_file: int = 5000):
+    """Compare annotating stored DocBins in place against rebuilding their
+    texts and running the pipeline again, for a growing number of files."""
+
+    nlp = spacy.load('en_core_web_sm')
+    ww = WaterWheel(nlp)
+    nlp.add_pipe(ww)
+    texts = sample_texts(docs_per_file)
+    with tempfile.TemporaryDirectory() as path:
+        doc_bin = DocBin(attrs=['ENT_IOB', 'ENT_TYPE'])
+        for doc in nlp.pipe(texts, disable=[ww.name]):
+            doc_bin.add(doc)
+        data = doc_bin.to_bytes()
+
+        def retokenize(paths: List[str]):
+            for i, file in enumerate(paths):
+                texts = [doc.text for doc in read_doc_bin(file).get_docs(nlp.vocab)]
+                output = DocBin(attrs=['ENT_IOB', 'ENT_TYPE'], store_user_data=True)
+                for doc in nlp.pipe(texts):
+                    output.add(doc)
+                with open(f'{path}/retokenized_{i}.spacy', 'wb') as file:
+                    file.write(output.to_bytes())
+
+        def annotate(paths: List[str]):
+            ww.annotate_doc_bins(paths, f'{path}/annotated', chunk_size=docs_per_file)
+
+        for n_files in (2, 8):
+            paths = []
+            for i in range(n_files):
+                paths.append(f'{path}/{i}.spacy')
+                with open(paths[-1], 'wb') as file:
+                    file.write(data)
+            n = n_files * docs_per_file
+            report(f'retokenize, {n_files} files', n, *measure(retokenize, paths))
+            report(f'annotate, {n_files} files', n, *measure(annotate, paths))
+
+def bench_instances_mode(share: int = 1, n: int = 4):
+    """Print the construction time and RSS of n WaterWheels, each in its
+    own pipeline, alternating disable_abbreviations."""
+
+    print('shared' if share else 'not shared')
+    pipelines = []
+    before = rss()
+    for i in range(n):
+        nlp = spacy.load('en_core_web_sm')
+        start = time.perf_counter()
+        nlp.add_pipe(WaterWheel(nlp, disable_abbreviations=bool(i % 2), share_gazetteer=bool(share)))
+        pipelines.append(nlp)
+        print(f'  instance {i + 1}: {time.perf_counter() - start:>6.2f} s  rss +{(rss() - before) / 2**20:>7.1f} MiB')
+
+def bench_instances():
+    """Compare n WaterWheels with and without a shared gazetteer, each in
+    a fresh interpreter."""
+
+    for share in ['0', '1']:
+        subprocess.run([sys.executable, __file__, 'instances_mode', share], check=True)
+
+def bench_workers_mode(method: str = 'fork', engine: str = 'phrase_matcher', n: int = 2000):
+    """Print the pickled size of a WaterWheel, and the time nlp.pipe with
+    two processes takes on a single batch, dominated by the start of the
+    workers, and on n texts, with the given start method."""
+
+    multiprocessing.set_start_method(method, force=True)
+    nlp = spacy.load('en_core_web_sm')
+    ww = WaterWheel(nlp, engine=engine)
+    nlp.add_pipe(ww)
+    ww.wait()
+    texts = sample_sentences * (n // len(sample_sentences))
+    print(f'{method} {engine}: pickle {len(pickle.dumps(ww)) / 2**10:.0f} KiB, nlp {len(pickle.dumps(nlp)) / 2**10:.0f} KiB')
+    start = time.perf_counter()
+    list(nlp.pipe(sample_sentences, n_process=2, batch_size=len(sample_sentences)))
+    print(f'  spin-up    {time.perf_counter() - start:>7.2f} s')
+    start = time.perf_counter()
+    list(nlp.pipe(texts, n_process=2, batch_size=100))
+    elapsed = time.perf_counter() - start
+    print(f'  {len(texts)} texts {elapsed:>7.2f} s  {len(texts) / elapsed:>6.0f} docs/s')
+
+def bench_workers():
+    """Compare the start of nlp.pipe workers by fork and spawn, for both
+    engines, each in a fresh interpreter."""
+
+    for method in ['fork', 'spawn']:
+        for engine in ['phrase_matcher', 'trie']:
+            subprocess.run([sys.executable, __file__, 'workers_mode', method, engine], check=True)
+
+def bench_aliases(n: int = 1000, seed: int = 0):
+    """Compare the lookup of the names of n random qids in the alias index
+    with a scan of the link dicts, and print the build time and size of
+    the index."""
+
+    nlp = spacy.load('en_core_web_sm')
+    ww = WaterWheel(nlp)
+    gazetteer = ww.gazetteer
+    start = time.perf_counter()
+    index = AliasIndex.from_tables(gazetteer.candidates)
+    print(f'build {time.perf_counter() - start:.3f} s, {len(index)} qids, {index.nbytes() / 2**20:.1f} MiB')
+    qids = random.Random(seed).sample(sorted(set(q for links in gazetteer.wikidata.values() for q in links.values())), n)
+    start = time.perf_counter()
+    for qid in qids:
+        gazetteer.aliases.names(qid)
+    print(f'index {(time.perf_counter() - start) / n * 1e6:>10.1f} us/qid')
+    start = time.perf_counter()
+    for qid in qids[:n // 100]:
+        [name for links in gazetteer.wikidata.values() for name, q in links.items() if q == qid]
+    print(f'scan  {(time.perf_counter() - start) / (n // 100) * 1e6:>10.1f} us/qid')
+
+def query_texts(ww: WaterWheel, n: int = 5000, seed: int = 0):
+    """A sample of search queries of 2 to 8 tokens: gazetteer names, some
+    with their qualifier, next to common query words, and queries
+    without any name."""
+
+    rng = random.Random(seed)
+    gazetteer = ww.gazetteer
+    names = [(name, label) for label, links in gazetteer.wikidata.items() for name in links]
+    words = ['water level', 'fishing', 'map', 'near', 'flooding', 'temperature', 'hotels', '2021',
+             'boat rental', 'depth', 'how deep is', 'where is', 'pollution', 'weather']
+    queries = []
+    for _ in range(n):
+        name, label = rng.choice(names)
+        query = name.title()
+        draw = rng.random()
+        if draw < 0.3:
+            query += ' ' + label.lower().replace('_', ' ')
+        if draw < 0.6:
+            query = rng.choice(words) + ' ' + query
+        else:
+            query += ' ' + rng.choice(words)
+        if draw > 0.9:
+            query = ' '.join(rng.sample(words, 3))
+        queries.append(query)
+    return queries
+
+def bench_query(n: int = 5000):
+    """Print the p50 and p99 latency of annotating single queries with the
+    whole pipeline, with extract, and with extract_query, for both engines."""
+
+    for engine in ['phrase_matcher', 'trie']:
+        nlp = spacy.load('en_core_web_sm')
+        ww = WaterWheel(nlp, engine=engine)
+        nlp.add_pipe(ww)
+        queries = query_texts(ww, n)
+        print(engine)
+        modes = [
+            ('tokenizer only', nlp.tokenizer),
+            ('nlp', nlp),
+            ('extract', lambda query: next(ww.extract([query]))),
+            ('extract_query', ww.extract_query),
+        ]
+        latencies = {name: [] for name, _ in modes}
+        # a first pass fills the tokenizer cache, then the modes take turns on each query.
+        for query in queries:
+            nlp.tokenizer(query)
+        for query in queries:
+            for name, annotate in modes:
+                start = time.perf_counter()
+                annotate(query)
+                latencies[name].append(time.perf_counter() - start)
+        for name, _ in modes:
+            p50, p99 = numpy.percentile(latencies[name], [50, 99]) * 1e6
+            print(f'  {name:<15} p50 {p50:>7.0f} us  p99 {p99:>7.0f} us')
+
+def adversarial_texts(ww: WaterWheel, n_tokens: int, seed: int = 0):
+    """Texts of about n_tokens tokens built to produce dense, overlapping
+    matches: runs of capitalized single-word names, two names that chain
+    into one overlap group as long as the text ('Laguna Blanca Laguna
+    Blanca ...'), a name repeated ('Bong Bong ...'), a table dump of names
+    and qualifiers between pipes, and qualifiers alone."""
+
+    rng = random.Random(seed)
+    gazetteer = ww.gazetteer
+    names = set(name for links in gazetteer.wikidata.values() for name in links)
+    words = sorted(name for name in names if name.isalpha())
+    pairs = sorted(tuple(name.split()) for name in names if len(name.split()) == 2 and name.replace(' ', '').isalpha())
+    chain = next(' '.join(pair) for pair in pairs if pair[0] != pair[1] and ' '.join(pair[::-1]) in names)
+    repeated = next(pair[0] for pair in pairs if pair[0] == pair[1])
+    qualifiers = sorted(gazetteer.qualifier_words)
+    return OrderedDict((
+        ('capitalized names', ' '.join(rng.choice(words).title() for _ in range(n_tokens))),
+        ('overlap chain', ' '.join([chain.title()] * (n_tokens // 2))),
+        ('repeated name', ' '.join([repeated.title()] * n_tokens)),
+        ('table dump', ' | '.join(rng.choice(words).title() + ' ' + rng.choice(qualifiers).title()
+                                  for _ in range(n_tokens // 3))),
+        ('qualifiers', ' '.join(rng.choice(qualifiers).title() for _ in range(n_tokens))),
+    ))
+
+def bench_adversarial(lengths: List[int] = (1000, 4000, 16000, 64000)):
+    """Print the time per token of annotating adversarial texts of growing
+    length, without and with the per-document limits. Constant time per
+    token means cost linear in the length of the document."""
+
+    nlp = spacy.load('en_core_web_sm')
+    ww = WaterWheel(nlp, engine='trie')
+    nlp.add_pipe(ww)
+    guarded_nlp = spacy.load('en_core_web_sm')
+    guarded = WaterWheel(guarded_nlp, engine='trie', max_candidates=50000, max_group_size=64, time_budget=1.0)
+    guarded_nlp.add_pipe(guarded)
+    texts = {n: adversarial_texts(ww, n) for n in lengths}
+    for kind in texts[lengths[0]]:
+        print(kind)
+        for n in lengths:
+            text = texts[n][kind]
+            doc = nlp.make_doc(text)
+            n_matches = len(ww.gazetteer.matcher(doc))
+            row = f'  {len(doc):>6} tokens {n_matches:>7} matches'
+            for annotate in [nlp, guarded_nlp]:
+                start = time.perf_counter()
+                doc = annotate(text)
+                elapsed = time.perf_counter() - start
+                row += f'  {elapsed / len(doc) * 1e6:>6.1f} us/token {len(doc.ents):>6} ents'
+            print(row + f'  limits {doc._.limits_hit or []}')
+
+def bench_stream(n: int = 2000):
+    """Compare the time per token of a text streamed one word at a time
+    with that of annotating it at once, and print how many words after
+    its end each entity is emitted, for both engines."""
+
+    for engine in ['phrase_matcher', 'trie']:
+        nlp = spacy.load('en_core_web_sm')
+        ww = WaterWheel(nlp, engine=engine)
+        text = ' '.join(sample_texts(n))
+        words = text.split(' ')
+        start = time.perf_counter()
+        expected = next(ww.extract([text]))
+        batch = time.perf_counter() - start
+        stream = EntityStream(ww)
+        entities, delays = [], []
+        # the character offset of the end of each word appended so far.
+        end = -1
+        start = time.perf_counter()
+        for i, word in enumerate(words):
+            end += len(word) + 1
+            emitted = stream.append(word + ' ' if i + 1 < len(words) else word)
+            # words appended after the end of the entity.
+            delays.extend(text.count(' ', entity.end_char, end) for entity in emitted)
+            entities.extend(emitted)
+        entities.extend(stream.close())
+        streamed = time.perf_counter() - start
+        n_tokens = len(nlp.make_doc(text))
+        print(f'{engine:<15} batch {batch / n_tokens * 1e6:>6.1f} us/token  stream {streamed / n_tokens * 1e6:>6.1f} us/token'
+              f'  delay mean {numpy.mean(delays):.1f} max {max(delays)} words  same {entities == expected}'
+              f'  forced {stream.n_forced}')
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        exit("Not enough arguments")
+    if sys.argv[1] == "extract":
+        bench_extract()
+    elif sys.argv[1] == "export":
+        bench_export()
+    elif sys.argv[1] == "load":
+        bench_load()
+    elif sys.argv[1] == "fuzzy":
+        bench_fuzzy()
+    elif sys.argv[1] == "candidates":
+        bench_candidates()
+    elif sys.argv[1] == "geo":
+        bench_geo()
+    elif sys.argv[1] == "long":
+        bench_long()
+    elif sys.argv[1] == "network":
+        bench_network()
+    elif sys.argv[1] == "index":
+        bench_index()
+    elif sys.argv[1] == "reload":
+        bench_reload()
+    elif sys.argv[1] == "memory":
+        bench_memory()
+    elif sys.argv[1] == "memory_mode":
+        bench_memory_mode(int(sys.argv[2]))
+    elif sys.argv[1] == "raw":
+        bench_raw()
+    elif sys.argv[1] == "engines":
+        bench_engines()
+    elif sys.argv[1] == "async":
+        bench_async()
+    elif sys.argv[1] == "soak":
+        bench_soak()
+    elif sys.argv[1] == "soak_mode":
+        bench_soak_mode(int(sys.argv[2]))
+    elif sys.argv[1] == "doc_bins":
+        bench_doc_bins()
+    elif sys.argv[1] == "instances":
+        bench_instances()
+    elif sys.argv[1] == "instances_mode":
+        bench_instances_mode(int(sys.argv[2]))
+    elif sys.argv[1] == "stream":
+        bench_stream()
+    elif sys.argv[1] == "adversarial":
+        bench_adversarial()
+    elif sys.argv[1] == "query":
+        bench_query()
+    elif sys.argv[1] == "aliases":
+        bench_aliases()
+    elif sys.argv[1] == "workers":
+        bench_workers()
+    elif sys.argv[1] == "workers_mode":
+        bench_workers_mode(sys.argv[2], sys.argv[3])
+    elif sys.argv[1] == "engine_mode":
+        bench_engine_mode(sys.argv[2])
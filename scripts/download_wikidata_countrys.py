@@ -6,18 +6,26 @@ import sys
 
 url = 'https://query.wikidata.org/sparql'
 subquery = """
-SELECT ?item ?itemLabel ?altLabel
+SELECT ?item ?itemLabel ?altLabel ?sitelinks ?coord ?admin ?country
 WHERE 
 {
+  ?item wikibase:sitelinks ?sitelinks.
+  OPTIONAL { ?item wdt:P625 ?coord . }
+  OPTIONAL { ?item wdt:P131 ?admin . }
+  OPTIONAL { ?item wdt:P17 ?country . }
   ?item p:P31/ps:P31/wdt:P279* wd:Q6256.
   OPTIONAL { ?item skos:altLabel ?altLabel . FILTER (lang(?altLabel) = "en") }
   SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
   FILTER (CONTAINS(STR(?item), 
 """
 subquery = """
-SELECT ?item ?itemLabel ?altLabel
+SELECT ?item ?itemLabel ?altLabel ?sitelinks ?coord ?admin ?country
 WHERE 
 {
+    ?item wikibase:sitelinks ?sitelinks.
+    OPTIONAL { ?item wdt:P625 ?coord . }
+    OPTIONAL { ?item wdt:P131 ?admin . }
+    OPTIONAL { ?item wdt:P17 ?country . }
     {?item wdt:P31 wd:Q3624078} 
     UNION
     {?item wdt:P31 wd:Q15634554}
@@ -33,16 +41,28 @@ WHERE
 """
 combinations = [f"Q{n}" for n in range(10, 100)]
 waterbodies = {}
+sitelinks = {}
+coordinates = {}
+admins = {}
+countries = {}
 not_done = []
 #combinations = [f"Q{sys.argv[1]}"]
 combinations = ["Q"]
 for comb in tqdm(combinations):
-    query = subquery + f"'{comb}'))" + "} GROUP BY ?item ?itemLabel ?altLabel"
+    query = subquery + f"'{comb}'))" + "} GROUP BY ?item ?itemLabel ?altLabel ?sitelinks ?coord ?admin ?country"
     try:
         r = requests.get(url, params = {'format': 'json', 'query': query})
         data = r.json()
         for entry in data["results"]["bindings"]:
             key = entry["item"]["value"].split("/")[-1]
+            sitelinks[key] = int(entry["sitelinks"]["value"]) if "sitelinks" in entry else 0
+            if "coord" in entry and key not in coordinates:
+                lon, lat = entry["coord"]["value"].split("Point(")[-1].rstrip(")").split()[:2]
+                coordinates[key] = (lat, lon)
+            if "admin" in entry and key not in admins:
+                admins[key] = entry["admin"]["value"].split("/")[-1]
+            if "country" in entry and key not in countries:
+                countries[key] = entry["country"]["value"].split("/")[-1]
             label = entry['itemLabel']['value'] if 'itemLabel' in entry else ""
             alias = entry['altLabel']['value'] if 'altLabel' in entry else ""
             
@@ -68,9 +88,9 @@ for key, names in waterbodies.items():
 print ("length of waterbodies", len(pairs))
 
 try:
-    csv = "Name,ID\n"
+    csv = "Name,ID,Sitelinks,Latitude,Longitude,Admin,Country\n"
     for key, name in pairs:
-        csv += f"{name.replace(',', ';')},{key.replace(',', ';')}\n"
+        csv += f"{name.replace(',', ';')},{key.replace(',', ';')},{sitelinks.get(key, 0)},{','.join(coordinates.get(key, ('', '')))},{admins.get(key, '')},{countries.get(key, '')}\n"
 
     with open("wikidata_countrys.csv", "a") as file:
         file.write(csv.encode('ascii', 'ignore').decode())
@@ -6,9 +6,13 @@ import sys
 
 url = 'https://query.wikidata.org/sparql'
 subquery = """
-SELECT ?item ?itemLabel ?altLabel
+SELECT ?item ?itemLabel ?altLabel ?sitelinks ?coord ?admin ?country
 WHERE 
 {
+  ?item wikibase:sitelinks ?sitelinks.
+  OPTIONAL { ?item wdt:P625 ?coord . }
+  OPTIONAL { ?item wdt:P131 ?admin . }
+  OPTIONAL { ?item wdt:P17 ?country . }
   ?item wdt:P31 wd:Q8502.
   ?item wdt:P2660 ?height
   OPTIONAL { ?item skos:altLabel ?altLabel . FILTER (lang(?altLabel) = "en") }
@@ -17,6 +21,10 @@ WHERE
 """
 combinations = [f"Q{n}" for n in range(10, 100)]
 waterbodies = {}
+sitelinks = {}
+coordinates = {}
+admins = {}
+countries = {}
 not_done = []
 """
 combinations = []
@@ -26,12 +34,20 @@ for c in ["Q21", "Q27"]:
 """
 combinations = [f"Q{sys.argv[1]}"]
 for comb in tqdm(combinations):
-    query = subquery + f"'{comb}'))" + "} GROUP BY ?item ?itemLabel ?altLabel"
+    query = subquery + f"'{comb}'))" + "} GROUP BY ?item ?itemLabel ?altLabel ?sitelinks ?coord ?admin ?country"
     try:
         r = requests.get(url, params = {'format': 'json', 'query': query})
         data = r.json()
         for entry in data["results"]["bindings"]:
             key = entry["item"]["value"].split("/")[-1]
+            sitelinks[key] = int(entry["sitelinks"]["value"]) if "sitelinks" in entry else 0
+            if "coord" in entry and key not in coordinates:
+                lon, lat = entry["coord"]["value"].split("Point(")[-1].rstrip(")").split()[:2]
+                coordinates[key] = (lat, lon)
+            if "admin" in entry and key not in admins:
+                admins[key] = entry["admin"]["value"].split("/")[-1]
+            if "country" in entry and key not in countries:
+                countries[key] = entry["country"]["value"].split("/")[-1]
             label = entry['itemLabel']['value'] if 'itemLabel' in entry else ""
             alias = entry['altLabel']['value'] if 'altLabel' in entry else ""
             
@@ -58,10 +74,10 @@ for key, names in waterbodies.items():
 print ("length of waterbodies", len(pairs))
 
 try:
-    #csv = "Name,ID\n"
+    #csv = "Name,ID,Sitelinks,Latitude,Longitude,Admin,Country\n"
     csv = ""
     for key, name in pairs:
-        csv += f"{name.replace(',', ';')},{key.replace(',', ';')}\n"
+        csv += f"{name.replace(',', ';')},{key.replace(',', ';')},{sitelinks.get(key, 0)},{','.join(coordinates.get(key, ('', '')))},{admins.get(key, '')},{countries.get(key, '')}\n"
 
     with open("wikidata_mountains.csv", "a") as file:
         file.write(csv.encode('ascii', 'ignore').decode())
@@ -0,0 +1,47 @@
+import requests
+from tqdm import tqdm
+import re
+
+url = 'https://query.wikidata.org/sparql'
+# mouth of the watercourse (P403), tributary (P974) and drainage basin (P4614)
+# of every watercourse, as (source, relation, target) edges.
+subquery = """
+SELECT ?item ?mouth ?tributary ?basin
+WHERE
+{
+  ?item p:P31/ps:P31/wdt:P279* wd:Q355304.
+  OPTIONAL { ?item wdt:P403 ?mouth . }
+  OPTIONAL { ?item wdt:P974 ?tributary . }
+  OPTIONAL { ?item wdt:P4614 ?basin . }
+  FILTER (BOUND(?mouth) || BOUND(?tributary) || BOUND(?basin))
+  FILTER (CONTAINS(STR(?item),
+"""
+combinations = [f"Q{n}" for n in range(10, 100)]
+edges = set()
+for comb in tqdm(combinations):
+    query = subquery + f"'{comb}'))" + "} GROUP BY ?item ?mouth ?tributary ?basin"
+    try:
+        r = requests.get(url, params = {'format': 'json', 'query': query})
+        data = r.json()
+        for entry in data["results"]["bindings"]:
+            key = entry["item"]["value"].split("/")[-1]
+            for relation in ("mouth", "tributary", "basin"):
+                if relation in entry:
+                    target = entry[relation]["value"].split("/")[-1]
+                    if re.search('^Q[0-9]+$', target):
+                        edges.add((key, relation, target))
+    except Exception as e:
+        print (str(e))
+        print (comb)
+
+print ("length of edges", len(edges))
+
+try:
+    csv = "Source,Relation,Target\n"
+    for source, relation, target in sorted(edges):
+        csv += f"{source},{relation},{target}\n"
+
+    with open("wikidata_river_network.csv", "w") as file:
+        file.write(csv)
+except Exception as e:
+    print (str(e))
@@ -5,9 +5,13 @@ import re
 
 url = 'https://query.wikidata.org/sparql'
 subquery = """
-SELECT ?item ?itemLabel ?altLabel
+SELECT ?item ?itemLabel ?altLabel ?sitelinks ?coord ?admin ?country
 WHERE 
 {
+  ?item wikibase:sitelinks ?sitelinks.
+  OPTIONAL { ?item wdt:P625 ?coord . }
+  OPTIONAL { ?item wdt:P131 ?admin . }
+  OPTIONAL { ?item wdt:P17 ?country . }
   ?item p:P31/ps:P31/wdt:P279* wd:Q4022.
   ?item wdt:P2043 ?length
   OPTIONAL { ?item skos:altLabel ?altLabel . FILTER (lang(?altLabel) = "en") }
@@ -16,13 +20,25 @@ WHERE
 """
 combinations = [f"Q{n}" for n in range(10, 100)]
 waterbodies = {}
+sitelinks = {}
+coordinates = {}
+admins = {}
+countries = {}
 for comb in tqdm(combinations):
-    query = subquery + f"'{comb}'))" + "} GROUP BY ?item ?itemLabel ?altLabel"
+    query = subquery + f"'{comb}'))" + "} GROUP BY ?item ?itemLabel ?altLabel ?sitelinks ?coord ?admin ?country"
     try:
         r = requests.get(url, params = {'format': 'json', 'query': query})
         data = r.json()
         for entry in data["results"]["bindings"]:
             key = entry["item"]["value"].split("/")[-1]
+            sitelinks[key] = int(entry["sitelinks"]["value"]) if "sitelinks" in entry else 0
+            if "coord" in entry and key not in coordinates:
+                lon, lat = entry["coord"]["value"].split("Point(")[-1].rstrip(")").split()[:2]
+                coordinates[key] = (lat, lon)
+            if "admin" in entry and key not in admins:
+                admins[key] = entry["admin"]["value"].split("/")[-1]
+            if "country" in entry and key not in countries:
+                countries[key] = entry["country"]["value"].split("/")[-1]
             label = entry['itemLabel']['value'] if 'itemLabel' in entry else ""
             alias = entry['altLabel']['value'] if 'altLabel' in entry else ""
             
@@ -47,9 +63,9 @@ for key, names in waterbodies.items():
 print ("length of waterbodies", len(pairs))
 
 try:
-    csv = "Name,ID\n"
+    csv = "Name,ID,Sitelinks,Latitude,Longitude,Admin,Country\n"
     for key, name in pairs:
-        csv += f"{name.replace(',', ';')},{key.replace(',', ';')}\n"
+        csv += f"{name.replace(',', ';')},{key.replace(',', ';')},{sitelinks.get(key, 0)},{','.join(coordinates.get(key, ('', '')))},{admins.get(key, '')},{countries.get(key, '')}\n"
 
     with open("wikidata_rivers.csv", "w") as file:
         file.write(csv.encode('ascii', 'ignore').decode())
@@ -1,21 +1,31 @@
 import re
 import os
 import sys
+import time
+import subprocess
 import srsly
 import pandas as pd
 from pathlib import Path
-from typing import Dict, Tuple
+from typing import Dict, List, Tuple
 from tqdm import tqdm
 from collections import OrderedDict
 import spacy
 from spacy.tokens import DocBin
 from spacy.language import Language
+from waterwheel.candidates import CandidateTable
+from waterwheel.network import RiverNetwork
+from waterwheel.stats import PatternStats
+from waterwheel.memory import rss
+from waterwheel.profiles import list_profiles, profile_path, select_gazetteer
+from waterwheel.waterwheel import DOC_BIN_FILE
+from waterwheel import WaterWheel
 
 data_dir = Path(os.path.dirname(os.path.realpath(__file__))) / 'data'
 doc_bins_file = Path(os.path.dirname(os.path.realpath(__file__))) / 'data/doc_bins.msgpack'
 vocab_file = Path(os.path.dirname(os.path.realpath(__file__))) / 'data/vocab.json'
 wikidata_file = Path(os.path.dirname(os.path.realpath(__file__))) / 'data/wikidata.json'
 stop_words_file = Path(os.path.dirname(os.path.realpath(__file__))) / 'data/stop_words.json'
+pruned_file = Path(os.path.dirname(os.path.realpath(__file__))) / 'data/doc_bins_pruned.msgpack'
 
 def read_data_files():
     """Load necessary data from data files.
@@ -35,7 +45,7 @@ def read_data_files():
     stop_words = set(srsly.read_json(stop_words_file)['stop_words'])
     return vocab, wikidata, stop_words
 
-def write_data_files(vocab: Dict, wikidata: Dict, stop_words: set, doc_bins_bytes: Dict):
+def write_data_files(vocab: Dict, wikidata: Dict, stop_words: set, doc_bins_bytes: Dict, candidates: Dict, network: Dict = None):
     """Writes necessary data to resource files.
 
     Parameters
@@ -48,6 +58,10 @@ def write_data_files(vocab: Dict, wikidata: Dict, stop_words: set, doc_bins_byte
         A set of commong words in English.
     doc_bins_bytes: Dict
         A dictionary of DocBin bytes for each water body type.
+    candidates: Dict
+        A dictionary of serialized CandidateTables for each water body type.
+    network: Dict, optional
+        A serialized RiverNetwork.
     """
 
     serial = OrderedDict(
@@ -56,8 +70,11 @@ def write_data_files(vocab: Dict, wikidata: Dict, stop_words: set, doc_bins_byte
             ('vocab', vocab),
             ('wikidata', wikidata),
             ('doc_bins', doc_bins_bytes),
+            ('candidates', candidates),
         )
     )
+    if network is not None:
+        serial['network'] = network
     srsly.write_msgpack(doc_bins_file, serial)
 
 def name_split(name: str):
@@ -81,41 +98,77 @@ def name_split(name: str):
         s = s.replace(token, "")
     return s.strip()
 
-def build_vocab(water_bodies: Dict, nlp: Language):
+def build_network(edges: pd.DataFrame):
+    """Build the river network from relation edges.
+
+    Parameters
+    ----------
+    edges : pd.DataFrame
+        Columns Source, Relation and Target, where Relation is one of
+        mouth (P403), tributary (P974) or basin (P4614).
+
+    Returns
+    -------
+    network : RiverNetwork
+        The built network.
+    """
+
+    mouths = []
+    basins = []
+    for source, relation, target in zip(edges['Source'], edges['Relation'], edges['Target']):
+        if relation == 'mouth':
+            mouths.append((source, target))
+        elif relation == 'tributary':
+            mouths.append((target, source))
+        elif relation == 'basin':
+            basins.append((source, target))
+    network = RiverNetwork.from_edges(mouths, basins)
+    print(f'NETWORK: {len(network)} nodes, {network.n_dropped} secondary mouths dropped')
+    return network
+
+def build_vocab(water_bodies: Dict, nlp: Language, network: RiverNetwork = None):
     """Load new vocab and wikidata.
 
     Parameters
     ----------
     water_bodies : Dict
         Dictionary containing the list of new water bodies to be loaded.
+        Names shared by several entities keep all of their ids, ranked by
+        prior, and are linked to the one with the highest prior.
         Format:
         {
-            "LAKE": [(Name, Wiki_Id), ...],
-            "RIVER": [(Name, Wiki_Id), ...],
+            "LAKE": [(Name, Wiki_Id, Prior), ...],
+            "RIVER": [(Name, Wiki_Id, Prior, Latitude, Longitude, Admin), ...],
+            "MOUNTAIN": [(Name, Wiki_Id, Prior, Latitude, Longitude, Admin, Country), ...],
             ...
         }
     nlp: Language
         spacy nlp object
+    network: RiverNetwork, optional
+        The river network of the gazetteer.
     """
 
     vocab = {}
     wikidata = {}
     doc_bins_bytes = {}
+    candidates = {}
     stop_words = set(srsly.read_json(stop_words_file)['stop_words'])
 
     for key in water_bodies:
+        table = CandidateTable.from_rows(water_bodies[key])
+        names = table.to_dict()['names']
         doc_bin = DocBin()
-        for wb, _ in tqdm(water_bodies[key], desc=f'Loading {key}(s)'):
+        for wb in tqdm(names, desc=f'Loading {key}(s)'):
             doc_bin.add(nlp(wb))
         doc_bins_bytes[key] = doc_bin.to_bytes()
 
-        if key not in wikidata:
-            wikidata[key] = {}
-        for name, id in water_bodies[key]:
-            wikidata[key][name.lower()] = id
+        wikidata[key] = {name: table.top(name) for name in names}
+        candidates[key] = table.to_dict()
+        print(f'{key}: {len(names)} names, {table.n_ambiguous()} ambiguous, {table.nbytes() / 2**20:.1f} MiB of candidates')
 
         vocab[str(nlp.vocab.strings[key])] = key
-    write_data_files(vocab, wikidata, stop_words, doc_bins_bytes)
+    network = network.to_dict() if network is not None else None
+    write_data_files(vocab, wikidata, stop_words, doc_bins_bytes, candidates, network)
 
 def build_vocab_csvs(nlp: Language, data_dir: Path = data_dir):
     """Load data from csv files.
@@ -127,9 +180,14 @@ def build_vocab_csvs(nlp: Language, data_dir: Path = data_dir):
     data_dir : Path
         Path to the directory with csv files.
         Format:
-            Each csv file should contain columns Name and ID
+            Each csv file should contain columns Name and ID, and
+            optionally Sitelinks which is used as the prior of the ID,
+            Latitude, Longitude and Admin (P625 and P131 of the ID), and
+            Country (P17 of the ID).
             Filename should be wikidata_{water_body_type}s.csv
             For example wikidata_rivers.csv
+            The river network is read from wikidata_river_network.csv if
+            present, with columns Source, Relation and Target.
     """
 
     water_bodies = {}
@@ -148,12 +206,230 @@ def build_vocab_csvs(nlp: Language, data_dir: Path = data_dir):
                 name = name_split(df['Name'][i])
                 if re.search('^[^a-zA-Z\d]+$', name):
                     continue
-                water_bodies[wb_type].append((name, df['ID'][i]))
-    build_vocab(water_bodies, nlp)
+                prior = int(df['Sitelinks'][i]) if 'Sitelinks' in df else 0
+                if 'Latitude' in df:
+                    admin = df['Admin'][i] if type(df['Admin'][i]) is str else None
+                    row = (name, df['ID'][i], prior, df['Latitude'][i], df['Longitude'][i], admin)
+                    if 'Country' in df:
+                        row += (df['Country'][i] if type(df['Country'][i]) is str else None,)
+                    water_bodies[wb_type].append(row)
+                else:
+                    water_bodies[wb_type].append((name, df['ID'][i], prior))
+    network_file = data_dir / 'wikidata_river_network.csv'
+    network = build_network(pd.read_csv(network_file)) if network_file.exists() else None
+    build_vocab(water_bodies, nlp, network)
+
+def read_corpus(path: Path):
+    """Read a corpus with one document per line."""
+    with open(path, encoding='utf8') as file:
+        return [line.rstrip('\n') for line in file]
+
+def collect_stats(nlp: Language, texts: List[str], path: Path = doc_bins_file):
+    """Count the hits and rejections of every pattern of a gazetteer over a corpus.
+
+    Parameters
+    ----------
+    nlp : Language
+        spacy nlp object, without a waterwheel component.
+    texts : List[str]
+        The corpus.
+    path : Path
+        The gazetteer file.
+
+    Returns
+    -------
+    stats : PatternStats
+        The counters of the patterns hit in the corpus.
+    """
+
+    ww = WaterWheel(nlp, collect_stats=True, path=path)
+    for doc in tqdm(nlp.pipe(texts, batch_size=1000), total=len(texts), desc='Collecting stats'):
+        ww.extract_doc(doc)
+    totals = ww.stats.totals()
+    print(f"STATS: {len(ww.stats)} patterns, {totals['hits']} hits, {totals['kept']} kept")
+    return ww.stats
+
+def select_patterns(stats: PatternStats, min_hits: int = 100, drop: bool = True):
+    """Choose the patterns to prune from their counters. A pattern hit at
+    least `min_hits` times is dropped if it was never kept and never seen
+    with a qualifier, and else marked as needing a qualifier if it was never
+    kept without one.
+
+    Parameters
+    ----------
+    stats : PatternStats
+        The counters collected over a representative corpus.
+    min_hits : int
+        Patterns with fewer hits are kept as they are.
+    drop : bool
+        If False then patterns are only marked, never dropped.
+
+    Returns
+    -------
+    dropped : Dict[str, set]
+        The names to remove from the matcher, by label.
+    needs_qualifier : Dict[str, set]
+        The names only matched next to a qualifier, by label.
+    """
+
+    dropped = {}
+    needs_qualifier = {}
+    for row in stats.rows(min_hits):
+        if drop and row['kept'] == 0 and row['qualified'] == 0:
+            dropped.setdefault(row['label'], set()).add(row['name'])
+        elif row['kept'] == row['kept_qualified']:
+            needs_qualifier.setdefault(row['label'], set()).add(row['name'])
+    return dropped, needs_qualifier
+
+def measure_throughput(ww: WaterWheel, docs: List):
+    """Documents per second of extract_doc with the gazetteer of a
+    WaterWheel, and the (start_char, end_char, label, qid) records of each
+    document."""
+    start = time.perf_counter()
+    entities = [ww.extract_doc(doc) for doc in docs]
+    seconds = time.perf_counter() - start
+    return len(docs) / seconds, [[entity[:4] for entity in doc] for doc in entities]
+
+def prune_patterns(nlp: Language, stats: PatternStats, texts: List[str], min_hits: int = 100, drop: bool = True,
+                   path: Path = doc_bins_file, output: Path = pruned_file):
+    """Write a copy of a gazetteer without the patterns that never survive
+    the filters of WaterWheel, see select_patterns, and report the throughput
+    of both gazetteers over a corpus. Dropped names keep their links and
+    candidates, so fuzzy matches can still resolve them.
+
+    Parameters
+    ----------
+    nlp : Language
+        spacy nlp object, without a waterwheel component.
+    stats : PatternStats
+        The counters collected over a representative corpus.
+    texts : List[str]
+        The corpus the throughput is measured on.
+    min_hits : int
+        Patterns with fewer hits are kept as they are.
+    drop : bool
+        If False then patterns are only marked, never dropped.
+    path : Path
+        The gazetteer file.
+    output : Path
+        The pruned gazetteer file.
+    """
+
+    dropped, needs_qualifier = select_patterns(stats, min_hits, drop)
+    cfg = srsly.read_msgpack(path)
+    for key, value in cfg['doc_bins'].items():
+        if key not in dropped:
+            continue
+        doc_bin = DocBin()
+        for doc in DocBin().from_bytes(value).get_docs(nlp.vocab):
+            if doc.text not in dropped[key]:
+                doc_bin.add(doc)
+        cfg['doc_bins'][key] = doc_bin.to_bytes()
+    marked = {key: set(cfg.get('needs_qualifier', {}).get(key, [])) | names for key, names in needs_qualifier.items()}
+    cfg['needs_qualifier'] = {key: sorted(names) for key, names in marked.items()}
+    srsly.write_msgpack(output, cfg)
+    print(f'PRUNED: {sum(map(len, dropped.values()))} patterns dropped, '
+          f'{sum(map(len, needs_qualifier.values()))} marked as needing a qualifier')
+
+    docs = list(nlp.pipe(texts, batch_size=1000))
+    ww = WaterWheel(nlp, path=path)
+    before, expected = measure_throughput(ww, docs)
+    after, entities = measure_throughput(ww.from_disk(output), docs)
+    n_changed = sum(a != b for a, b in zip(expected, entities))
+    print(f'THROUGHPUT: {before:.1f} docs/s before, {after:.1f} docs/s after ({after / before:.2f}x), '
+          f'{n_changed} of {len(docs)} documents changed')
+
+def build_profile(name: str, labels: List[str] = None, countries: List[str] = (), admins: List[str] = (),
+                  qids: List[str] = (), keep_unlocated: bool = True, path: Path = None):
+    """Write the gazetteer of a deployment profile, which WaterWheel loads
+    with `profile=name`, see waterwheel.profiles.select_gazetteer.
+
+    Parameters
+    ----------
+    name : str
+        The profile name.
+    labels : List[str], optional
+        The labels kept, all by default.
+    countries : List[str], optional
+        Wikidata ids of the countries (P17) whose entities are kept.
+    admins : List[str], optional
+        Wikidata ids of the admin areas (P131) whose entities are kept.
+    qids : List[str], optional
+        Wikidata ids kept whatever their location.
+    keep_unlocated : bool
+        If True then entities without country or admin area are kept too.
+    path : Path, optional
+        The full gazetteer file, the rebuilt one if any, else the bundled one.
+    """
+
+    if path is None:
+        path = doc_bins_file if doc_bins_file.exists() else DOC_BIN_FILE
+    cfg = select_gazetteer(srsly.read_msgpack(path), labels, countries, admins, qids, keep_unlocated)
+    output = profile_path(name)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    srsly.write_msgpack(output, cfg)
+    for key, links in cfg['wikidata'].items():
+        print(f'{key}: {len(links)} names')
+    print(f'PROFILE {name}: {output.stat().st_size / 2**20:.1f} MiB, from {Path(path).stat().st_size / 2**20:.1f} MiB')
+
+def measure_profile(name: str, corpus: Path, engine: str = 'phrase_matcher'):
+    """Print the load time, memory and throughput of a profile, or of the
+    bundled gazetteer if the name is 'full', in the current interpreter."""
+    nlp = spacy.load('en_core_web_sm')
+    docs = list(nlp.pipe(read_corpus(corpus), batch_size=1000))
+    rss_before = rss()
+    start = time.perf_counter()
+    ww = WaterWheel(nlp, engine=engine, profile=None if name == 'full' else name)
+    load = time.perf_counter() - start
+    memory = rss() - rss_before
+    start = time.perf_counter()
+    n_entities = sum(len(ww.extract_doc(doc)) for doc in docs)
+    throughput = len(docs) / (time.perf_counter() - start)
+    print(f'{name:<16} {len(ww):>8} names {load:>7.2f} s load {memory / 2**20:>8.1f} MiB '
+          f'{throughput:>9.1f} docs/s {n_entities:>8} entities')
+
+def report_profiles(corpus: Path, names: List[str] = None, engine: str = 'phrase_matcher'):
+    """Compare the bundled gazetteer with profiles, by default all of
+    them, each in a fresh interpreter so load time and memory are not
+    shared, see measure_profile."""
+    for name in ['full'] + (names or list_profiles()):
+        subprocess.run([sys.executable, __file__, 'profile_mode', name, str(corpus), engine], check=True)
+
+def read_ids(value: str):
+    """Wikidata ids given as 'Q16,Q30' or as a file with one id per line."""
+    if os.path.exists(value):
+        with open(value, encoding='utf8') as file:
+            return [line.strip() for line in file if line.strip()]
+    return [qid for qid in value.split(',') if qid]
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
+    if len(sys.argv) < 2:
         exit("Not enough arguments")
     if sys.argv[1] == "rebuild":
         nlp = spacy.load('en_core_web_sm')
-        build_vocab_csvs(nlp)
\ No newline at end of file
+        build_vocab_csvs(nlp)
+    elif sys.argv[1] == "stats":
+        # python util.py stats corpus.txt pattern_stats.jsonl
+        nlp = spacy.load('en_core_web_sm')
+        collect_stats(nlp, read_corpus(sys.argv[2])).to_disk(sys.argv[3])
+    elif sys.argv[1] == "prune":
+        # python util.py prune pattern_stats.jsonl corpus.txt [min_hits]
+        nlp = spacy.load('en_core_web_sm')
+        min_hits = int(sys.argv[4]) if len(sys.argv) > 4 else 100
+        prune_patterns(nlp, PatternStats.from_disk(sys.argv[2]), read_corpus(sys.argv[3]), min_hits)
+    elif sys.argv[1] == "profile":
+        # python util.py profile canada [labels=LAKE,RIVER] [countries=Q16] [admins=Q1904] [qids=qids.txt] [keep_unlocated=0]
+        options = dict(arg.split('=', 1) for arg in sys.argv[3:])
+        build_profile(
+            sys.argv[2],
+            labels=options['labels'].split(',') if 'labels' in options else None,
+            countries=read_ids(options.get('countries', '')),
+            admins=read_ids(options.get('admins', '')),
+            qids=read_ids(options.get('qids', '')),
+            keep_unlocated=options.get('keep_unlocated', '1') != '0',
+        )
+    elif sys.argv[1] == "profiles":
+        # python util.py profiles corpus.txt [name ...]
+        report_profiles(sys.argv[2], sys.argv[3:])
+    elif sys.argv[1] == "profile_mode":
+        measure_profile(sys.argv[2], sys.argv[3], sys.argv[4])
\ No newline at end of file
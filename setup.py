@@ -20,7 +20,8 @@ setup(
     install_requires=requires,
     packages=['waterwheel'],
     package_data={'waterwheel': [
-        'waterwheel/resources/doc_bins.msgpack'
+        'waterwheel/resources/doc_bins.msgpack',
+        'waterwheel/resources/profiles/*.msgpack'
     ]},
     include_package_data=True,
     classifiers=[
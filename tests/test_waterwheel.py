@@ -1,6 +1,42 @@
+import os
+import re
+import pickle
+import asyncio
+import multiprocessing
 import unittest
+from unittest import mock
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import spacy
+import srsly
+from spacy.tokens import Doc, DocBin, Span
+from spacy.vocab import Vocab
 from waterwheel import WaterWheel
+from waterwheel.waterwheel import DOC_BIN_FILE
+from waterwheel.export import load_columns
+from waterwheel.candidates import AliasIndex, CandidateTable
+from waterwheel.network import RiverNetwork
+from waterwheel.index import InvertedIndex
+from waterwheel.jobs import Job, export_shard
+from waterwheel.stats import PatternStats, REJECTIONS
+from waterwheel.aio import AsyncWaterWheel
+from waterwheel.docbin import load_docs
+from waterwheel.query import is_all_caps, is_all_lower, is_symbols
+from waterwheel.stream import EntityStream, stable_end
+from waterwheel import profiles
+from waterwheel.gazetteer import _shared_locks
+from waterwheel.vocab import SPACY_VERSION, fresh_vocab
+
+def _job_pipeline():
+    # forked workers reuse the component loaded by the test class.
+    return TestWaterWheel.ww
+
+def _fail_on_markers(ww, texts, path):
+    if 'CRASH' in texts:
+        os._exit(1)
+    if 'FAIL' in texts:
+        raise ValueError('forced failure')
+    return export_shard(ww, texts, path)
 
 class TestWaterWheel(unittest.TestCase):
     @classmethod
@@ -273,5 +309,674 @@ class TestWaterWheel(unittest.TestCase):
         for ent in doc.ents:
             self.assertIsNotNone(ent._.wikilink)
 
+    def test_extract(self):
+        text = 'The Mackenzie River flows from the Great Slave Lake into the Arctic Ocean.'
+        doc = self.nlp(text)
+        entities = list(self.ww.extract([text, 'There is no waterbody in this sentence.']))
+        self.assertEqual(len(entities), 2)
+        self.assertEqual(len(entities[0]), len(doc.ents))
+        for entity, ent in zip(entities[0], doc.ents):
+            self.assertEqual(entity.start_char, ent.start_char)
+            self.assertEqual(entity.end_char, ent.end_char)
+            self.assertEqual(entity.label, ent.label_)
+            self.assertEqual(ent._.wikilink, 'https://www.wikidata.org/wiki/' + entity.qid)
+        self.assertEqual(entities[1], [])
+
+    def test_export(self):
+        texts = [
+            'There is no waterbody in this sentence.',
+            'The Mackenzie River flows from the Great Slave Lake into the Arctic Ocean.',
+        ]
+        with tempfile.TemporaryDirectory() as path:
+            n_rows = self.ww.export(texts, path, chunk_size=2)
+            columns = load_columns(path)
+            # a second export would mix its chunks with the first.
+            with self.assertRaises(ValueError):
+                self.ww.export(texts, path)
+            self.assertEqual(len(load_columns(path)['doc']), n_rows)
+        doc = self.nlp(texts[1])
+        self.assertEqual(n_rows, len(doc.ents))
+        self.assertEqual(list(columns['doc']), [1] * len(doc.ents))
+        for i, ent in enumerate(doc.ents):
+            self.assertEqual(columns['start_char'][i], ent.start_char)
+            self.assertEqual(columns['end_char'][i], ent.end_char)
+            self.assertEqual(columns['start'][i], ent.start)
+            self.assertEqual(columns['end'][i], ent.end)
+            self.assertEqual(columns['label'][i], ent.label_)
+            self.assertEqual(ent._.wikilink, 'https://www.wikidata.org/wiki/Q' + str(columns['qid'][i]))
+
+    def test_background_loading(self):
+        ww = WaterWheel(self.nlp, background=True)
+        self.assertTrue(ww.wait())
+        self.assertTrue(ww.ready())
+        self.assertEqual(ww.progress(), 1.0)
+        self.assertEqual(len(ww), len(self.ww))
+        doc = ww(self.nlp.make_doc('The ultimate source of the Mackenzie River is Thutade Lake.'))
+        self.assertEqual(str(doc.ents[0]), 'Mackenzie River')
+        self.assertEqual(str(doc.ents[0].label_), 'RIVER')
+
+    def test_fuzzy(self):
+        ww = WaterWheel(self.nlp, fuzzy=True)
+        doc = ww(self.nlp.make_doc('Water samples from the Río Chiapa and the Makenzie River.'))
+        self.assertEqual(str(doc.ents[0]), 'Río Chiapa')
+        self.assertEqual(str(doc.ents[0].label_), 'RIVER')
+        self.assertEqual(str(doc.ents[1]), 'Makenzie River')
+        self.assertEqual(str(doc.ents[1].label_), 'RIVER')
+        for ent in doc.ents:
+            self.assertIsNotNone(ent._.wikilink)
+        doc = ww(self.nlp.make_doc('The AMAZON, ARCTIC, ONTARIO are something.'))
+        self.assertEqual(len(doc.ents), 0)
+        # the same casing rule as the exact matches.
+        doc = ww(self.nlp.make_doc('Water samples from the MAKENZIE RIVER.'))
+        self.assertEqual(len(doc.ents), 0)
+
+    def test_candidates(self):
+        doc = self.nlp('The Mackenzie River flows from the Great Slave Lake into the Arctic Ocean.')
+        for ent in doc.ents:
+            self.assertGreater(len(ent._.candidates), 0)
+            self.assertEqual(ent._.wikilink, 'https://www.wikidata.org/wiki/' + ent._.candidates[0][0])
+            priors = [prior for _, prior in ent._.candidates]
+            self.assertEqual(priors, sorted(priors, reverse=True))
+        self.assertEqual(self.ww.get_candidates('LAKE', 'not a lake name'), [])
+
+    def test_aliases(self):
+        self.assertEqual(set(self.ww.get_aliases('Q3411')), {'mackenzie', 'fleuve mackenzie'})
+        self.assertEqual(self.ww.get_aliases('Q3411', 'LAKE'), [])
+        self.assertEqual(self.ww.get_aliases('Q1'), [])
+        # an ambiguous name is an alias of each of its candidates.
+        for qid, _ in self.ww.get_candidates('LAKE', 'mud'):
+            self.assertIn('mud', self.ww.get_aliases(qid, 'LAKE'))
+
+        tables = {
+            'LAKE': CandidateTable.from_rows([('mud', 'Q1', 5), ('mud', 'Q2', 9), ('clear', 'Q1', 1)]),
+            'RIVER': CandidateTable.from_rows([('mud', 'Q1', 1)]),
+        }
+        index = AliasIndex.from_tables(tables)
+        self.assertEqual(len(index), 2)
+        self.assertIn('Q2', index)
+        # names for which Q1 is the top candidate come first.
+        self.assertEqual(index.get('Q1'), [('clear', 'LAKE'), ('mud', 'RIVER'), ('mud', 'LAKE')])
+        self.assertEqual(index.names('Q1'), ['clear', 'mud'])
+        self.assertEqual(index.names('Q1', 'RIVER'), ['mud'])
+        self.assertEqual(index.get('Q3'), [])
+
+    def test_geo_disambiguation(self):
+        # a private gazetteer, the shared one must not be modified.
+        nlp = spacy.load('en_core_web_sm')
+        ww = WaterWheel(nlp, engine='trie', geo_disambiguation=True, share_gazetteer=False)
+        nlp.add_pipe(ww)
+        self.assertIsNot(ww.gazetteer, self.ww.gazetteer)
+        ww.gazetteer.candidates = {
+            'LAKE': CandidateTable.from_rows([
+                ('long', 'Q1', 10, 31.0, -97.0, 'Q2'),
+                ('long', 'Q3', 1, 45.1, -79.3, 'Q4'),
+            ]),
+            'CANADIAN_PROVINCE': CandidateTable.from_rows([
+                ('ontario', 'Q1904', 100, 50.0, -85.0, 'Q16'),
+            ]),
+        }
+        doc = nlp('Long Lake is a lake in Ontario.')
+        self.assertEqual(str(doc.ents[0]), 'Long Lake')
+        self.assertEqual(doc.ents[0]._.wikilink, 'https://www.wikidata.org/wiki/Q3')
+        # the linked candidate comes first, the others by prior.
+        self.assertEqual(doc.ents[0]._.candidates, [('Q3', 1), ('Q1', 10)])
+
+    def test_pattern_stats(self):
+        nlp = spacy.load('en_core_web_sm')
+        ww = WaterWheel(nlp, engine='trie', collect_stats=True, share_gazetteer=False)
+        nlp.add_pipe(ww)
+        gazetteer = ww.gazetteer
+        nlp('Is Nile an actual river? The Nile River is.')
+        nlp('Patients should have had a CT scan showing bilateral infiltrates.')
+        stats = ww.stats
+        self.assertEqual(stats.get('RIVER', 'nile')['kept'], 2)
+        self.assertEqual(stats.get('RIVER', 'nile')['kept_qualified'], 1)
+        self.assertEqual(stats.get('RIVER', 'is')['stop_word'], 1)
+        self.assertEqual(stats.get('RIVER', 'is')['overlap'], 1)
+        self.assertEqual(stats.get('US_STATE', 'ct')['context'], 1)
+        totals = stats.totals()
+        self.assertEqual(totals['hits'], totals['kept'] + sum(totals[rule] for rule in REJECTIONS))
+        with tempfile.TemporaryDirectory() as path:
+            stats.to_disk(os.path.join(path, 'stats.jsonl'))
+            loaded = PatternStats.from_disk(os.path.join(path, 'stats.jsonl'))
+        self.assertEqual(list(loaded.rows()), list(stats.rows()))
+        self.assertEqual(loaded.merge(stats).get('RIVER', 'nile')['hits'], 4)
+
+        # a pattern marked as needing a qualifier only matches next to one.
+        gazetteer.needs_qualifier = {label: {'nile'} for label in gazetteer.wikidata}
+        doc = nlp('Is Nile an actual river? The Nile River is.')
+        self.assertEqual([str(ent) for ent in doc.ents], ['Nile River'])
+        self.assertEqual(stats.get('RIVER', 'nile')['needs_qualifier'], 1)
+        serial = srsly.msgpack_loads(gazetteer.to_bytes())
+        self.assertEqual(serial['needs_qualifier'], {label: ['nile'] for label in gazetteer.wikidata})
+
+    def test_shared_gazetteer(self):
+        # the two pipelines of the suite differ in vocab and options, not in gazetteer.
+        self.assertIs(self.ww.gazetteer, self.ww2.gazetteer)
+        own = WaterWheel(spacy.load('en_core_web_sm'), engine='trie', share_gazetteer=False)
+        shared = WaterWheel(spacy.load('en_core_web_sm'), engine='trie')
+        self.assertIsNot(own.gazetteer, shared.gazetteer)
+        self.assertIsNot(shared.gazetteer, self.ww.gazetteer)
+        self.assertIs(WaterWheel(spacy.load('en_core_web_sm'), engine='trie').gazetteer, shared.gazetteer)
+        self.assertEqual(own.gazetteer.version, shared.gazetteer.version)
+        self.assertEqual(_shared_locks, {})
+        # lookups of unknown labels and ids leave the shared gazetteer as it was.
+        gazetteer = self.ww.gazetteer
+        qualifiers, ent_ids = dict(gazetteer.qualifiers), dict(gazetteer.ent_ids)
+        self.ww._get_matches(self.nlp.make_doc('Lake Ontario'), [(0, 0, 2)], gazetteer)
+        self.assertEqual((gazetteer.qualifiers, gazetteer.ent_ids), (qualifiers, ent_ids))
+
+    def test_trie_engine(self):
+        nlp = spacy.load('en_core_web_sm')
+        ww = WaterWheel(nlp, engine='trie')
+        nlp.add_pipe(ww)
+        texts = [
+            'The Mackenzie River flows from the Great Slave Lake into the Arctic Ocean.',
+            'Lakes Ontario and Erie were created, along with the Saint Lawrence River.',
+            'Some address is university avenue, AB, canada or NY, usa.',
+            'Patients should have had a CT scan showing bilateral infiltrates.',
+            'There is no waterbody in this (), ( ) sentence.',
+            '',
+        ]
+        # names of every label, in title case and with qualifiers.
+        for label, names in self.ww.gazetteer.wikidata.items():
+            names = sorted(names)[:200]
+            texts.append(' and '.join(name.title() for name in names[:100]) + ' ' + label.lower() + '.')
+            texts.append('the ' + ' of '.join(names[100:]) + '.')
+        expected = [sorted(self.ww.gazetteer.matcher(self.nlp.make_doc(text))) for text in texts]
+        docs = [nlp.make_doc(text) for text in texts]
+        self.assertEqual([sorted(ww.gazetteer.matcher(doc)) for doc in docs], expected)
+        self.assertEqual([sorted(matches) for _, matches in ww.gazetteer.pipe(docs, batch_size=4)], expected)
+        self.assertEqual(len(ww), len(self.ww))
+        self.assertEqual(list(ww.extract(texts, batch_size=3)), list(self.ww.extract(texts)))
+        for doc, expected_doc in zip(nlp.pipe(texts, batch_size=5), self.nlp.pipe(texts)):
+            self.assertEqual([(ent.text, ent.label_, ent._.wikilink) for ent in doc.ents],
+                             [(ent.text, ent.label_, ent._.wikilink) for ent in expected_doc.ents])
+        with self.assertRaises(ValueError):
+            WaterWheel(nlp, engine='regex')
+
+    def test_extract_raw(self):
+        texts = [
+            'The ultimate source of the Mackenzie River is Thutade Lake.',
+            'The River Cherwell is a major tributary of the River Thames in central England.',
+            'Lakes Ontario and Erie were created, along with the Saint Lawrence River.',
+            'The Mackenzie River flows from the great slave lake into the Arctic Ocean.',
+            'Some address is university avenue, AB, canada or NY, usa.',
+            'Patients should have had a CT scan showing bilateral infiltrates.',
+            'There is an actual river named Is river or is river or IS river.',
+            "Mt. Everest, the Nile's delta and Mt. Diablo.",
+            'There is no waterbody in this (), ( ) sentence.',
+            '',
+        ]
+        self.assertEqual(list(self.ww.extract_raw(texts)), list(self.ww.extract(texts)))
+        # 'İ' lowercases to two characters, offsets after it must not shift.
+        entities = list(self.ww.extract_raw(['İzmir photos of the Diyala River']))[0]
+        self.assertEqual([(e.start_char, e.end_char, e.label) for e in entities], [(20, 32, 'RIVER')])
+        # patterns marked as needing a qualifier follow the same rule.
+        ww = WaterWheel(self.nlp, engine='trie', share_gazetteer=False)
+        ww.gazetteer.needs_qualifier = {label: {'nile'} for label in ww.gazetteer.wikidata}
+        texts = ['Is Nile an actual river? The Nile River is.']
+        self.assertEqual(list(ww.extract_raw(texts)), list(ww.extract(texts)))
+        self.assertEqual(len(list(ww.extract_raw(texts))[0]), 1)
+
+    def test_compact(self):
+        ww = WaterWheel(self.nlp, compact=True)
+        self.assertEqual(len(ww), len(self.ww))
+        text = 'The Mackenzie River flows from the Great Slave Lake into the Arctic Ocean.'
+        self.assertEqual(list(ww.extract([text])), list(self.ww.extract([text])))
+        report = ww.memory_report()
+        self.assertLess(report['doc_bins'], self.ww.memory_report()['doc_bins'])
+        self.assertGreater(report['process_rss'], 0)
+        serial = srsly.msgpack_loads(ww.to_bytes())
+        self.assertEqual(serial['wikidata'], srsly.msgpack_loads(self.ww.to_bytes())['wikidata'])
+        self.assertEqual(set(serial['doc_bins']), set(self.ww.gazetteer.doc_bins))
+
+    def test_extract_query(self):
+        nlp = spacy.load('en_core_web_sm')
+        trie = WaterWheel(nlp, engine='trie')
+        queries = [
+            'fishing Lake Ontario', 'how deep is Great Slave Lake', 'Mackenzie River map', 'NY lakes',
+            'hotels near Mud Lake 2021', 'CT scan', 'the lake', 'Great Slave Lake Ontario', 'Mt. Everest',
+            'Lakes Ontario and Erie', 'Nile', 'water quality', '', '( )',
+        ]
+        for label, names in sorted(self.ww.gazetteer.wikidata.items()):
+            names = sorted(names)[:20]
+            queries.extend(name.title() + ' ' + label.lower() for name in names[:10])
+            queries.extend('where is ' + name for name in names[10:])
+        for ww in [self.ww, self.ww2, trie]:
+            for query in queries:
+                self.assertEqual(ww.extract_query(query), ww.extract_doc(ww.nlp.tokenizer(query)))
+        self.assertEqual([entity.qid for entity in self.ww.extract_query('fishing Lake Ontario')], ['Q1062'])
+        # the trie walks short texts one token at a time.
+        for query in queries:
+            doc = nlp.tokenizer(query)
+            self.assertEqual(sorted(trie.gazetteer.matcher(doc)), sorted(self.ww.gazetteer.matcher(doc)))
+        # each thread has its own scratch state.
+        with ThreadPoolExecutor(4) as pool:
+            self.assertEqual(list(pool.map(self.ww.extract_query, queries)),
+                             [self.ww.extract_query(query) for query in queries])
+        for text in ['ABC', 'A B', 'Ab', 'abc', 'a\tb', '', '()', '1', '\u0661', '\u00c9', '\u00e9', 'Lake 1']:
+            self.assertEqual(is_symbols(text), re.search(r'^[^a-zA-Z\d]+$', text) is not None)
+            self.assertEqual(is_all_caps(text), re.search(r'^[\sA-Z]+$', text) is not None)
+            self.assertEqual(is_all_lower(text), re.search(r'^[\sa-z]+$', text) is not None)
+
+    def test_extract_long(self):
+        sentences = [
+            'Is Great Slave Lake Ontario related?',
+            'The Mackenzie River flows from the Great Slave Lake into the Arctic Ocean.',
+            'Lakes Ontario and Erie were created, along with the Saint Lawrence River.',
+            'Patients should have had a CT scan, but CT is a state and so is Mt. Everest.',
+        ]
+        text = ' '.join(sentences[i % len(sentences)] for i in range(200))
+        entities = list(self.ww.extract(([text])))[0]
+        for window in [100, 1000]:
+            self.assertEqual(list(self.ww.extract_long(text, window=window)), entities)
+
+    def test_stream(self):
+        sentences = [
+            'Is Great Slave Lake Ontario related?',
+            'The Mackenzie River flows from the Great Slave Lake into the Arctic Ocean.',
+            'Lakes Ontario and Erie were created, along with the Saint Lawrence River.',
+            'Patients should have had a CT scan, but CT is a state and so is Mt. Everest.',
+            'SMALL CRAFT ADVISORY FOR LAKE ONTARIO\n\nwinds  near Lake Erie and lake Huron.',
+        ]
+        text = ' '.join(sentences[i * 7 % len(sentences)] for i in range(40))
+        trie = WaterWheel(spacy.load('en_core_web_sm'), engine='trie')
+        for ww in [self.ww, trie]:
+            expected = list(ww.extract([text]))[0]
+            for size in [1, 3, 17, 200]:
+                stream = EntityStream(ww)
+                entities = []
+                for i in range(0, len(text), size):
+                    entities.extend(stream.append(text[i:i + size]))
+                    # only the text after the last cut is kept.
+                    self.assertLess(len(stream), 400)
+                entities.extend(stream.close())
+                self.assertEqual(entities, expected)
+                self.assertEqual(stream.n_forced, 0)
+        # each chunk is tokenized once, whatever the pending text.
+        for ww in [self.ww, trie]:
+            stream = EntityStream(ww)
+            with mock.patch.object(ww.nlp, 'make_doc', wraps=ww.nlp.make_doc) as make_doc:
+                entities = [e for i in range(0, len(text), 5) for e in stream.append(text[i:i + 5])]
+                entities.extend(stream.close())
+            self.assertEqual(entities, list(ww.extract([text]))[0])
+            self.assertEqual(sum(len(call[0][0]) for call in make_doc.call_args_list), len(text))
+        # entities come out as soon as nothing can extend them.
+        stream = EntityStream(trie)
+        self.assertEqual(stream.append('the Mackenzie River '), [])
+        self.assertEqual([(e.start_char, e.end_char) for e in stream.append('flows north ')], [(4, 19)])
+        self.assertEqual(stream.close(), [])
+        with self.assertRaises(ValueError):
+            stream.append('more')
+        stream = EntityStream(self.ww, max_lookahead=2)
+        for word in text.split(' '):
+            stream.append(word + ' ')
+        self.assertGreater(stream.n_forced, 0)
+        for chunk, end in [('a b c', 4), ('a b  ', 2), ('a', 0), ('', 0), ('a\nb', 2), ('  ', 0)]:
+            self.assertEqual(stable_end(chunk), end)
+
+    def test_limits(self):
+        texts = [
+            'Is Great Slave Lake Ontario related?',
+            'The Mackenzie River flows from the Great Slave Lake into the Arctic Ocean.',
+            'Lakes Ontario and Erie were created, along with the Saint Lawrence River.',
+        ]
+        self.assertIsNone(self.nlp(texts[0])._.limits_hit)
+        self.assertEqual(self.ww.n_limited, 0)
+        ww = WaterWheel(spacy.load('en_core_web_sm'), max_group_size=1)
+        doc = ww(ww.nlp(texts[0]))
+        self.assertEqual(doc._.limits_hit, ['group_size'])
+        self.assertEqual(ww.n_limited, 1)
+        tokens = [i for ent in doc.ents for i in range(ent.start, ent.end)]
+        self.assertEqual(len(tokens), len(set(tokens)))
+        # groups within the limit are resolved as before.
+        ww = WaterWheel(spacy.load('en_core_web_sm'), max_group_size=8)
+        for text in texts:
+            doc = ww(ww.nlp(text))
+            self.assertEqual([ent.text for ent in doc.ents], [ent.text for ent in self.nlp(text).ents])
+            self.assertIsNone(doc._.limits_hit)
+        self.assertEqual(ww.n_limited, 0)
+        # only the first matches, by position, are considered.
+        ww = WaterWheel(spacy.load('en_core_web_sm'), max_candidates=2)
+        doc = ww(ww.nlp(texts[1]))
+        self.assertTrue(all(ent.end <= 3 for ent in doc.ents))
+        self.assertEqual(doc._.limits_hit, ['candidates'])
+        ww = WaterWheel(spacy.load('en_core_web_sm'), time_budget=1e-9)
+        doc = ww(ww.nlp(texts[1]))
+        self.assertEqual(list(doc.ents), [])
+        self.assertEqual(doc._.limits_hit, ['time_budget'])
+        for kwargs in [{'max_group_size': 1}, {'max_candidates': 2}]:
+            ww = WaterWheel(spacy.load('en_core_web_sm'), **kwargs)
+            for text in texts:
+                self.assertEqual(ww.extract_query(text), ww.extract_doc(ww.nlp.tokenizer(text)))
+
+    def test_index(self):
+        texts = [
+            'The Mackenzie River flows from the Great Slave Lake into the Arctic Ocean.',
+            'There is no waterbody in this sentence.',
+            'Lakes Ontario and Erie were created, along with the Saint Lawrence River.',
+        ]
+        entities = list(self.ww.extract(texts * 2))
+        with tempfile.TemporaryDirectory() as path:
+            # the second batch is appended to the first and their segments merged.
+            self.assertEqual(self.ww.index(texts, path, segment_size=2), 3)
+            self.assertEqual(self.ww.index(texts, path, segment_size=2), 3)
+            index = InvertedIndex(path)
+            self.assertEqual(index.n_docs, 6)
+            for doc_entities in entities:
+                for entity in doc_entities:
+                    expected = [i for i, doc in enumerate(entities) if any(e.qid == entity.qid for e in doc)]
+                    self.assertEqual(index.docs(entity.qid).tolist(), expected)
+                    self.assertEqual(index.docs(entity.qid, entity.label).tolist(), expected)
+                    postings = index.postings(entity.qid)
+                    self.assertIn(entity.start_char, postings['start_char'].tolist())
+                    self.assertIn(entity.end_char, postings['end_char'].tolist())
+            first, second = entities[0][0].qid, entities[0][1].qid
+            self.assertEqual(index.cooccurring([first, second]).tolist(), [0, 3])
+            self.assertEqual(index.docs('Q1').tolist(), [])
+            self.assertEqual(index.count(first, 'OCEAN'), 0)
+
+    def test_job(self):
+        texts = [
+            'The Mackenzie River flows from the Great Slave Lake into the Arctic Ocean.',
+            'There is no waterbody in this sentence.',
+            'CRASH',
+            'Lakes Ontario and Erie were created, along with the Saint Lawrence River.',
+            'FAIL',
+            'Is Great Slave Lake Ontario related?',
+        ]
+        with tempfile.TemporaryDirectory() as path:
+            corpus = os.path.join(path, 'corpus.txt')
+            with open(corpus, 'w') as file:
+                file.write('\n'.join(texts) + '\n')
+            output_dir = os.path.join(path, 'output')
+
+            def run(**kwargs):
+                reports = []
+                job = Job([corpus], output_dir, shard_size=2, max_retries=1,
+                          pipeline=_job_pipeline, report=reports.append, **kwargs)
+                return job, job.run(), [shard['id'] for shard in reports]
+
+            # a worker crash and an exception, each retried once.
+            job, failed, reports = run(annotate=_fail_on_markers)
+            self.assertEqual(failed, ['00001', '00002'])
+            self.assertEqual(reports, ['00000', '00001', '00001', '00002', '00002'])
+            self.assertEqual(job.completed(), ['00000'])
+            shards_dir = job.output_dir / 'shards'
+            self.assertEqual(list(shards_dir.glob('00002.tmp-*')), [])
+            # resuming only runs the failed shards.
+            job, failed, reports = run()
+            self.assertEqual((failed, reports), ([], ['00001', '00002']))
+            self.assertEqual(list(shards_dir.glob('*.tmp-*')), [])
+            # a corrupted output is detected and rerun.
+            os.remove(job.shard_path('00000') / 'labels.json')
+            job, failed, reports = run()
+            self.assertEqual((failed, reports), ([], ['00000']))
+            for shard in job.manifest['shards'].values():
+                columns = load_columns(job.shard_path(shard['id']))
+                entities = self.ww.extract(texts[shard['doc_start']:shard['doc_start'] + shard['n_docs']])
+                expected = [(i, e.qid) for i, doc in enumerate(entities) for e in doc]
+                self.assertEqual([(doc, 'Q' + str(qid)) for doc, qid in zip(columns['doc'], columns['qid'])], expected)
+                self.assertEqual(shard['n_rows'], len(expected))
+            with self.assertRaises(ValueError):
+                Job([corpus], output_dir, shard_size=3)
+
+    def test_async(self):
+        texts = [
+            'The Mackenzie River flows from the Great Slave Lake into the Arctic Ocean.',
+            'There is no waterbody in this sentence.',
+            'Lakes Ontario and Erie were created, along with the Saint Lawrence River.',
+            'Is Great Slave Lake Ontario related?',
+        ] * 3
+        expected = list(self.ww.extract(texts))
+
+        async def annotate(**kwargs):
+            async with AsyncWaterWheel(batch_size=4, max_in_flight=5, **kwargs) as aww:
+                # concurrent callers are coalesced into batches, at most 5 texts pending.
+                results = await asyncio.gather(*(aww.annotate(text) for text in texts))
+                streamed = [entities async for entities in aww.pipe(texts)]
+                return results, streamed, aww.n_batches
+
+        results, streamed, n_batches = asyncio.run(annotate(ww=self.ww))
+        self.assertEqual(results, expected)
+        self.assertEqual(streamed, expected)
+        self.assertLess(n_batches, 2 * len(texts))
+        results, streamed, _ = asyncio.run(annotate(processes=True, pipeline=_job_pipeline))
+        self.assertEqual((results, streamed), (expected, expected))
+
+        async def close_queued():
+            aww = AsyncWaterWheel(self.ww, batch_size=4, max_wait=60, max_in_flight=len(texts))
+            tasks = [asyncio.ensure_future(aww.annotate(text)) for text in texts]
+            # the texts are queued, the batcher waits for more.
+            await asyncio.sleep(0.01)
+            closing = asyncio.ensure_future(aww.aclose())
+            await asyncio.sleep(0)
+            with self.assertRaises(RuntimeError):
+                await aww.annotate(texts[0])
+            await asyncio.wait_for(closing, 60)
+            with self.assertRaises(RuntimeError):
+                await aww.annotate(texts[0])
+            return [task.result() for task in tasks], aww._in_flight._value
+
+        results, free = asyncio.run(close_queued())
+        self.assertEqual(results, expected)
+        self.assertEqual(free, len(texts))
+        with self.assertRaises(ValueError):
+            AsyncWaterWheel()
+
+    def test_vocab(self):
+        # by default the gazetteer is built on the shared vocab.
+        self.assertIs(self.ww.gazetteer.matcher.vocab, self.nlp.vocab)
+        self.assertIs(self.ww._gazetteer_vocab(), self.nlp.vocab)
+        # fresh_vocab works from spaCy 2.2, pinned in setup.py, to 2.3.
+        vocab = fresh_vocab(self.nlp.vocab, self.ww._pinned_strings)
+        self.assertIsNot(vocab, self.nlp.vocab)
+        self.assertIs(vocab.vectors, self.nlp.vocab.vectors)
+        self.assertEqual(len(vocab.strings), self.ww._n_pinned)
+        self.assertEqual(vocab.morphology.tag_map, self.nlp.vocab.morphology.tag_map)
+        self.assertEqual(vocab.morphology.exc, self.nlp.vocab.morphology.exc)
+        self.assertEqual(getattr(vocab, 'lookups_extra', None) is None, SPACY_VERSION < (2, 3))
+        self.assertEqual([token.lower_ for token in Doc(vocab, words=['Lake', 'Erie'])], ['lake', 'erie'])
+
+    def test_recycle(self):
+        nlp = spacy.load('en_core_web_sm')
+        ww = WaterWheel(nlp, engine='trie', max_vocab_growth=100)
+        nlp.add_pipe(ww)
+        # only a recycled vocab needs a gazetteer vocab of its own.
+        self.assertIsNot(ww._gazetteer_vocab(), nlp.vocab)
+        texts = [f'Barge{i} sailed down the Mackenzie River to Great Slave Lake.' for i in range(300)]
+        self.assertEqual(list(ww.extract(texts, batch_size=20)), list(self.ww.extract(texts)))
+        self.assertGreater(ww.n_recycles, 1)
+        self.assertLess(ww.vocab_growth, 300)
+        # documents made before a recycle keep their vocab.
+        doc = nlp(texts[0])
+        self.assertIn('barge0', nlp.vocab.strings)
+        self.assertGreater(ww.recycle(), 0)
+        self.assertNotIn('barge0', nlp.vocab.strings)
+        self.assertIsNot(doc.vocab, nlp.vocab)
+        self.assertEqual([(e.text, e.label_) for e in doc.ents], [(e.text, e.label_) for e in nlp(texts[0]).ents])
+        self.assertFalse(ww.maybe_recycle())
+
+    def test_annotate_doc_bins(self):
+        texts = [
+            'The Mackenzie River flows from the Great Slave Lake into the Arctic Ocean.',
+            'There is no waterbody in this sentence.',
+            'Lakes Ontario and Erie were created, along with the Saint Lawrence River.',
+        ]
+        entities = lambda doc: [(e.start_char, e.end_char, e.label_, e._.wikilink) for e in doc.ents]
+        with tempfile.TemporaryDirectory() as path:
+            inputs = []
+            for i, chunk in enumerate([texts[:2], texts[2:]]):
+                doc_bin = DocBin(attrs=['LEMMA', 'ENT_IOB', 'ENT_TYPE'])
+                for doc in self.nlp.pipe(chunk, disable=['waterwheel']):
+                    if i == 0:
+                        # an entity of an upstream component.
+                        doc.ents = [Span(doc, 1, 3, label='ORG')] if len(doc) > 3 else []
+                    doc_bin.add(doc)
+                inputs.append(os.path.join(path, f'{i}.spacy'))
+                with open(inputs[-1], 'wb') as file:
+                    file.write(doc_bin.to_bytes())
+
+            output = os.path.join(path, 'output')
+            self.assertEqual(self.ww.annotate_doc_bins(inputs, output, chunk_size=2), 3)
+            self.assertEqual(len(os.listdir(output)), 2)
+            # labels are readable with a vocab that never saw them.
+            docs = list(load_docs(output, Vocab()))
+            self.assertEqual([doc.text for doc in docs], texts)
+            for doc, text in zip(docs, texts):
+                self.assertEqual(entities(doc), entities(self.nlp(text)))
+                self.assertEqual(doc._.gazetteer_version, self.ww.version)
+
+            self.ww.overwrite = False
+            try:
+                self.ww.annotate_doc_bins(inputs[:1], output)
+            finally:
+                self.ww.overwrite = True
+            doc = next(load_docs(output, self.nlp.vocab))
+            self.assertEqual([(e.text, e.label_) for e in doc.ents],
+                             [('Mackenzie River', 'ORG'), ('Great Slave Lake', 'LAKE'), ('Arctic Ocean', 'OCEAN')])
+
+    def test_pickle(self):
+        nlp = spacy.load('en_core_web_sm')
+        ww = WaterWheel(nlp, engine='trie', disable_abbreviations=True)
+        nlp.add_pipe(ww)
+        # a reference to the gazetteer is pickled, not the gazetteer. The
+        # vocab of nlp, which holds the phrases, is pickled with the pipeline.
+        serial = pickle.dumps(ww)
+        self.assertLess(len(serial), len(pickle.dumps(nlp.vocab)) + os.path.getsize(DOC_BIN_FILE) / 20)
+        copy = pickle.loads(serial)
+        self.assertIs(copy.gazetteer, ww.gazetteer)
+        self.assertTrue(copy._disable_abbreviations)
+
+        texts = [
+            'The Mackenzie River flows from the Great Slave Lake into the Arctic Ocean.',
+            'There is no waterbody in this sentence.',
+            'Lakes Ontario and Erie were created, along with the Saint Lawrence River.',
+            'Is Great Slave Lake Ontario related?',
+        ]
+        entities = lambda docs: [[(e.start_char, e.end_char, e.label_, e._.wikilink) for e in doc.ents] for doc in docs]
+        expected = entities(nlp.pipe(texts))
+        method = multiprocessing.get_start_method()
+        try:
+            # spawned workers unpickle the pipeline and load the gazetteer themselves.
+            multiprocessing.set_start_method('spawn', force=True)
+            self.assertEqual(entities(nlp.pipe(texts, n_process=2, batch_size=2)), expected)
+        finally:
+            multiprocessing.set_start_method(method, force=True)
+
+        with open(DOC_BIN_FILE, 'rb') as file:
+            copy.from_bytes(file.read())
+        with self.assertRaises(pickle.PicklingError):
+            pickle.dumps(copy)
+
+    def test_reload(self):
+        text = 'Lake Zzyzx is not the Mackenzie River.'
+        old = self.ww.gazetteer
+        try:
+            with tempfile.TemporaryDirectory() as path:
+                doc_bin = DocBin()
+                doc_bin.add(self.nlp.make_doc('zzyzx'))
+                file = os.path.join(path, 'gazetteer.msgpack')
+                srsly.write_msgpack(file, {
+                    'stop_words': [],
+                    'vocab': {str(self.nlp.vocab.strings['LAKE']): 'LAKE'},
+                    'wikidata': {'LAKE': {'zzyzx': 'Q42'}},
+                    'doc_bins': {'LAKE': doc_bin.to_bytes()},
+                })
+                # a call in flight keeps the gazetteer it started with.
+                stream = self.ww.extract_long(text + ' ' + text, window=len(text) + 1)
+                first = next(stream)
+                version = self.ww.reload(file).result(timeout=60)
+                entities = [first] + list(stream)
+                self.assertEqual([(e.label, e.version) for e in entities], [('RIVER', old.version)] * 2)
+                self.assertNotEqual(version, old.version)
+                self.assertEqual(self.ww.version, version)
+                self.assertEqual(list(self.ww.extract([text]))[0], [(0, 10, 'LAKE', 'Q42', version)])
+                self.assertEqual(self.nlp(text)._.gazetteer_version, version)
+                with self.assertRaises(OSError):
+                    self.ww.reload(os.path.join(path, 'missing.msgpack')).result(timeout=60)
+                self.assertEqual(self.ww.version, version)
+        finally:
+            self.ww._gazetteer = old
+
+    def test_river_network(self):
+        # Liard and Peace flow into the Mackenzie, Peace via the Slave river,
+        # Q9 and Q8 form a cycle, Q7 has a second mouth and the Liard edge
+        # comes from both P403 and P974.
+        mouths = [
+            ('Q1130063', 'Q3411'), ('Q1', 'Q2'), ('Q2', 'Q3411'), ('Q3', 'Q1'),
+            ('Q3411', 'Q788'), ('Q9', 'Q8'), ('Q8', 'Q9'), ('Q7', 'Q3'), ('Q7', 'Q2'),
+            ('Q1130063', 'Q3411'),
+        ]
+        network = RiverNetwork.from_edges(mouths, [('Q3411', 'Q1072')])
+        network = RiverNetwork.from_dict(srsly.msgpack_loads(srsly.msgpack_dumps(network.to_dict())))
+        self.assertEqual(network.n_dropped, 2)
+        self.assertTrue(network.is_upstream('Q7', 'Q3411'))
+        self.assertTrue(network.is_upstream('Q3', 'Q2'))
+        self.assertFalse(network.is_upstream('Q3411', 'Q3'))
+        self.assertFalse(network.is_upstream('Q3411', 'Q3411'))
+        self.assertFalse(network.is_upstream('Q1130063', 'Q2'))
+        self.assertFalse(network.is_upstream('Q404', 'Q3411'))
+        self.assertTrue(network.is_downstream('Q3411', 'Q7'))
+        self.assertEqual(sorted(network.upstream('Q2')), ['Q1', 'Q3', 'Q7'])
+        self.assertEqual(sorted(network.tributaries('Q3411')), ['Q1130063', 'Q2'])
+        self.assertEqual(network.downstream('Q7'), ['Q3', 'Q1', 'Q2', 'Q3411', 'Q788'])
+        self.assertEqual(network.basin('Q7'), 'Q1072')
+        self.assertIsNone(network.basin('Q788'))
+        self.assertTrue(network.is_upstream('Q9', 'Q8') != network.is_upstream('Q8', 'Q9'))
+
+    def test_profiles(self):
+        rows = [
+            ('mud', 'Q1', 12, 1.0, 2.0, 'Q5', 'Q16'), ('mud', 'Q2', 3, None, None, None, 'Q30'),
+            ('erie', 'Q3', 5, 1.0, 1.0, 'Q7', 'Q30'), ('arctic', 'Q4', 1, None, None, None, None),
+        ]
+        nlp = spacy.load('en_core_web_sm')
+        doc_bin = DocBin()
+        for name in ['mud', 'erie', 'arctic']:
+            doc_bin.add(nlp.make_doc(name))
+        cfg = {
+            'vocab': {'1': 'LAKE'}, 'wikidata': {'LAKE': {'mud': 'Q1', 'erie': 'Q3', 'arctic': 'Q4'}},
+            'doc_bins': {'LAKE': doc_bin.to_bytes()}, 'candidates': {'LAKE': CandidateTable.from_rows(rows).to_dict()},
+            'needs_qualifier': {'LAKE': ['erie']},
+        }
+        profile = profiles.select_gazetteer(cfg, countries=['Q16'])
+        self.assertEqual(profile['wikidata'], {'LAKE': {'mud': 'Q1', 'arctic': 'Q4'}})
+        self.assertEqual(len(DocBin().from_bytes(profile['doc_bins']['LAKE'])), 2)
+        self.assertNotIn('needs_qualifier', profile)
+        # the remaining candidates keep their order, the names their best one.
+        profile = profiles.select_gazetteer(cfg, countries=['Q30'], keep_unlocated=False)
+        self.assertEqual(profile['wikidata'], {'LAKE': {'mud': 'Q2', 'erie': 'Q3'}})
+        self.assertEqual(profile['needs_qualifier'], {'LAKE': ['erie']})
+        profile = profiles.select_gazetteer(cfg, admins=['Q7'], qids=['Q1'], keep_unlocated=False)
+        self.assertEqual(profile['wikidata'], {'LAKE': {'mud': 'Q1', 'erie': 'Q3'}})
+        self.assertEqual(profiles.select_gazetteer(cfg, labels=['RIVER'])['wikidata'], {})
+
+        full = srsly.read_msgpack(DOC_BIN_FILE)
+        with self.assertRaises(ValueError):
+            profiles.select_gazetteer(full, countries=['Q16'])
+        profile = profiles.select_gazetteer(full, labels=['LAKE', 'RIVER'], qids=['Q1062', 'Q3411'])
+        self.assertEqual(sorted(profile['vocab'].values()), ['LAKE', 'RIVER'])
+        self.assertEqual(set(name for links in profile['wikidata'].values() for name in links),
+                         {'ontario', 'mackenzie', 'fleuve mackenzie'})
+        text = 'The Mackenzie River flows from the Great Slave Lake into Lake Ontario.'
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(profiles, 'PROFILE_DIR', directory):
+            srsly.write_msgpack(profiles.profile_path('test'), profile)
+            self.assertEqual(profiles.list_profiles(), ['test'])
+            ww = WaterWheel(spacy.load('en_core_web_sm'), profile='test')
+            self.assertEqual([entity.qid for entity in ww.extract_query(text)], ['Q3411', 'Q1062'])
+            self.assertEqual(len(ww), 3)
+            ww = pickle.loads(pickle.dumps(ww))
+            self.assertEqual([entity.qid for entity in ww.extract_query(text)], ['Q3411', 'Q1062'])
+            with self.assertRaises(ValueError):
+                WaterWheel(spacy.load('en_core_web_sm'), profile='missing')
+            # any gazetteer file can be loaded by the constructor.
+            ww = WaterWheel(spacy.load('en_core_web_sm'), path=profiles.profile_path('test'))
+            self.assertEqual(len(ww), 3)
+            with self.assertRaises(ValueError):
+                WaterWheel(spacy.load('en_core_web_sm'), profile='test', path=profiles.profile_path('test'))
+        with self.assertRaises(ValueError):
+            profiles.profile_path('../test')
+
 if __name__ == '__main__':
     unittest.main()
@@ -1 +1 @@
-from .waterwheel import WaterWheel
\ No newline at end of file
+from .waterwheel import WaterWheel, Entity
\ No newline at end of file
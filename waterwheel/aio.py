@@ -0,0 +1,230 @@
+import asyncio
+from collections import deque
+from typing import AsyncIterable, Callable, Iterable, List, Union
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from . import jobs
+from .jobs import default_pipeline
+
+def _extract_batch(texts: List[str], batch_size: int):
+    """Annotate a batch with the pipeline of the current worker process."""
+    return list(jobs._worker_ww.extract(texts, batch_size=batch_size))
+
+async def _aiter(texts: Union[Iterable[str], AsyncIterable[str]]):
+    if hasattr(texts, '__aiter__'):
+        async for text in texts:
+            yield text
+    else:
+        for text in texts:
+            yield text
+
+class AsyncWaterWheel:
+    """Asyncio front end of a WaterWheel. Texts submitted by concurrent
+    callers are coalesced into batches of up to `batch_size`, waiting at
+    most `max_wait` seconds for a batch to fill, and annotated with
+    WaterWheel.extract on a pool of threads or processes, so the event
+    loop is never blocked by spaCy. At most `max_in_flight` texts are
+    queued or being annotated at once; further callers wait, which pushes
+    back on producers. Use as an async context manager, or call `aclose`,
+    which annotates the texts already queued and refuses new ones.
+    """
+
+    def __init__(self, ww=None, batch_size: int = 64, max_wait: float = 0.002, max_in_flight: int = 1024,
+                 n_workers: int = 1, processes: bool = False, pipeline: Callable = default_pipeline):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        ww : WaterWheel, optional
+            The component to annotate with in threads. Not needed with processes.
+        batch_size : int, optional
+            Largest number of texts annotated together.
+        max_wait : float, optional
+            Seconds a batch waits for more texts once its first text arrived.
+        max_in_flight : int, optional
+            Largest number of texts queued or being annotated.
+        n_workers : int, optional
+            Number of threads or processes, and of batches annotated at once.
+            Threads share `ww`, whose pipeline holds the GIL, so more than one
+            thread mostly helps pipelines that release it.
+        processes : bool, optional
+            If True then batches are annotated in worker processes, each
+            with its own pipeline built by `pipeline`.
+        pipeline : Callable, optional
+            Picklable function building the WaterWheel of a worker process.
+        """
+
+        if ww is None and not processes:
+            raise ValueError('a WaterWheel is needed to annotate in threads')
+        self.ww = ww
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_in_flight = max_in_flight
+        self.n_workers = n_workers
+        self.processes = processes
+        self.pipeline = pipeline
+        self.n_batches = 0
+        self._executor = None
+        self._queue = None
+        self._batcher = None
+        self._in_flight = None
+        self._workers = None
+        self._running = set()
+        # set by aclose, after which annotate raises RuntimeError.
+        self._closing = False
+
+    def _start(self):
+        """Create the pool, queue and batcher task inside the running loop."""
+        if self._closing:
+            raise RuntimeError('the AsyncWaterWheel is closed')
+        if self._batcher is not None:
+            return
+        if self.processes:
+            self._executor = ProcessPoolExecutor(
+                self.n_workers, initializer=jobs._init_worker, initargs=(self.pipeline,)
+            )
+        else:
+            self._executor = ThreadPoolExecutor(self.n_workers)
+        self._queue = asyncio.Queue()
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        self._workers = asyncio.Semaphore(self.n_workers)
+        self._batcher = asyncio.ensure_future(self._coalesce())
+
+    def _extract(self, texts: List[str]):
+        return list(self.ww.extract(texts, batch_size=len(texts)))
+
+    async def _coalesce(self):
+        """Group queued texts into batches and hand them to free workers,
+        until the None queued by aclose."""
+        loop = asyncio.get_event_loop()
+        closed = False
+        while not closed:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.batch_size:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self._queue.get_nowait()
+                if item is None:
+                    closed = True
+                    break
+                batch.append(item)
+            await self._workers.acquire()
+            task = asyncio.ensure_future(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: List):
+        """Annotate a batch in the pool and resolve the futures of its callers."""
+        loop = asyncio.get_event_loop()
+        texts = [text for text, _ in batch]
+        try:
+            if self.processes:
+                results = await loop.run_in_executor(self._executor, _extract_batch, texts, len(texts))
+            else:
+                results = await loop.run_in_executor(self._executor, self._extract, texts)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future), entities in zip(batch, results):
+                if not future.done():
+                    future.set_result(entities)
+        finally:
+            self.n_batches += 1
+            self._workers.release()
+            for _ in batch:
+                self._in_flight.release()
+
+    async def annotate(self, text: str):
+        """Annotate a single text, waiting while `max_in_flight` texts are pending.
+
+        Parameters
+        ----------
+        text : str
+            The text to process.
+
+        Returns
+        -------
+        entities : List[Entity]
+            The (start_char, end_char, label, qid, version) records of the text.
+
+        Raises
+        ------
+        RuntimeError
+            If aclose was called, even while this text waited for a slot.
+        """
+
+        self._start()
+        await self._in_flight.acquire()
+        if self._closing:
+            self._in_flight.release()
+            raise RuntimeError('the AsyncWaterWheel is closed')
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((text, future))
+        return await future
+
+    async def pipe(self, texts: Union[Iterable[str], AsyncIterable[str]]):
+        """Annotate a stream of texts, in order, keeping up to
+        `max_in_flight` of them pending so batches stay full.
+
+        Parameters
+        ----------
+        texts : Iterable[str] or AsyncIterable[str]
+            The texts to process.
+
+        Yields
+        ------
+        entities : List[Entity]
+            The records of each text, in the order of the texts.
+        """
+
+        pending = deque()
+        try:
+            async for text in _aiter(texts):
+                pending.append(asyncio.ensure_future(self.annotate(text)))
+                while pending and (pending[0].done() or len(pending) >= self.max_in_flight):
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def aclose(self):
+        """Refuse new texts, annotate the texts already queued, then stop
+        the batcher and the pool."""
+        self._closing = True
+        if self._batcher is None:
+            return
+        # the batcher hands out the texts queued before it, then returns.
+        self._queue.put_nowait(None)
+        await asyncio.gather(self._batcher, return_exceptions=True)
+        await asyncio.gather(*self._running, return_exceptions=True)
+        # texts left by a batcher that failed are not left waiting.
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None:
+                if not item[1].done():
+                    item[1].set_exception(RuntimeError('the AsyncWaterWheel is closed'))
+                self._in_flight.release()
+        self._executor.shutdown(wait=True)
+        self._batcher = None
+
+    async def __aenter__(self):
+        self._start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
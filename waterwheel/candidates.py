@@ -0,0 +1,393 @@
+import sys
+import array
+import numpy
+from typing import Dict, Iterable, Tuple
+from collections import OrderedDict
+from collections.abc import Mapping
+
+from .export import qid_to_int
+from .geo import to_grid
+
+class CandidateTable:
+    """Every candidate Wikidata id of the gazetteer names of one label,
+    together with a prior such as the sitelink count of the entity.
+    Candidates are stored in flat arrays: those of the i-th name are
+    qids[offsets[i]:offsets[i+1]], sorted by descending prior, so the
+    lookup of a name and its top candidate is O(1). Optional grid
+    coordinates (P625), admin areas (P131) and countries (P17) are aligned
+    with qids.
+    """
+
+    def __init__(self, names: Iterable[str] = (), offsets: bytes = b'',
+                 qids: bytes = b'', priors: bytes = b'', lats: bytes = b'',
+                 lons: bytes = b'', admins: bytes = b'', countries: bytes = b''):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        names : Iterable[str], optional
+            The names in the order of their offsets.
+        offsets : bytes, optional
+            Serialized array of len(names) + 1 offsets into qids.
+        qids : bytes, optional
+            Serialized array of integer Wikidata ids.
+        priors : bytes, optional
+            Serialized array of priors, aligned with qids.
+        lats : bytes, optional
+            Serialized array of grid latitudes, aligned with qids.
+        lons : bytes, optional
+            Serialized array of grid longitudes, aligned with qids.
+        admins : bytes, optional
+            Serialized array of integer admin area ids, aligned with qids.
+        countries : bytes, optional
+            Serialized array of integer country ids, aligned with qids.
+        """
+
+        self._index = {name: i for i, name in enumerate(names)}
+        self._offsets = array.array('q', offsets or b'\0' * 8)
+        self._qids = array.array('q', qids)
+        self._priors = array.array('q', priors)
+        self._lats = array.array('i', lats)
+        self._lons = array.array('i', lons)
+        self._admins = array.array('q', admins)
+        self._countries = array.array('q', countries)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple]):
+        """Build a table from (name, qid, prior),
+        (name, qid, prior, latitude, longitude, admin) or
+        (name, qid, prior, latitude, longitude, admin, country) rows.
+
+        Parameters
+        ----------
+        rows : Iterable[Tuple]
+            eg [('mud', 'Q1', 12), ('mud', 'Q2', 3), ...]. Names are
+            lowercased and repeated qids of a name keep their largest prior.
+            Missing coordinates are None or NaN, missing admins and
+            countries None.
+
+        Returns
+        -------
+        table : CandidateTable
+            The built table.
+        """
+
+        grouped = OrderedDict()
+        has_geo = has_countries = False
+        for row in rows:
+            name, qid, prior = row[:3]
+            lat, lon, admin = row[3:6] if len(row) >= 6 else (None, None, None)
+            country = row[6] if len(row) >= 7 else None
+            has_geo = has_geo or len(row) >= 6
+            has_countries = has_countries or len(row) >= 7
+            candidates = grouped.setdefault(name.lower(), {})
+            qid = qid_to_int(qid)
+            if qid not in candidates or prior > candidates[qid][0]:
+                candidates[qid] = (prior, to_grid(lat), to_grid(lon), qid_to_int(admin), qid_to_int(country))
+        table = cls()
+        for name, candidates in grouped.items():
+            table._index[name] = len(table._index)
+            # ties are broken in favour of the older, lower, id.
+            for qid, (prior, lat, lon, admin, country) in sorted(candidates.items(), key = lambda x: (-x[1][0], x[0])):
+                table._qids.append(qid)
+                table._priors.append(prior)
+                if has_geo:
+                    table._lats.append(lat)
+                    table._lons.append(lon)
+                    table._admins.append(admin)
+                if has_countries:
+                    table._countries.append(country)
+            table._offsets.append(len(table._qids))
+        return table
+
+    @classmethod
+    def from_dict(cls, data: Dict):
+        """Load a table from the output of to_dict."""
+        return cls(
+            data['names'], data['offsets'], data['qids'], data['priors'],
+            data.get('lats', b''), data.get('lons', b''), data.get('admins', b''), data.get('countries', b'')
+        )
+
+    def to_dict(self):
+        """Serialize the table to a msgpack friendly dict."""
+        return OrderedDict((
+            ('names', list(self._index)),
+            ('offsets', self._offsets.tobytes()),
+            ('qids', self._qids.tobytes()),
+            ('priors', self._priors.tobytes()),
+            ('lats', self._lats.tobytes()),
+            ('lons', self._lons.tobytes()),
+            ('admins', self._admins.tobytes()),
+            ('countries', self._countries.tobytes()),
+        ))
+
+    def __len__(self):
+        """The number of names."""
+        return len(self._index)
+
+    def __contains__(self, name: str):
+        return name in self._index
+
+    def get(self, name: str):
+        """All candidates of a name.
+
+        Parameters
+        ----------
+        name : str
+            The lowercased gazetteer name.
+
+        Returns
+        -------
+        candidates : List[Tuple[str, int]]
+            (qid, prior) tuples sorted by descending prior. Empty if the
+            name is unknown.
+        """
+
+        i = self._index.get(name)
+        if i is None:
+            return []
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return [('Q' + str(self._qids[j]), self._priors[j]) for j in range(start, end)]
+
+    def top(self, name: str):
+        """The candidate with the highest prior, or None if the name is unknown."""
+        i = self._index.get(name)
+        if i is None:
+            return None
+        return 'Q' + str(self._qids[self._offsets[i]])
+
+    def count(self, name: str):
+        """The number of candidates of a name."""
+        i = self._index.get(name)
+        return 0 if i is None else self._offsets[i + 1] - self._offsets[i]
+
+    def has_coordinates(self):
+        """Whether the table was built with coordinates."""
+        return len(self._lats) > 0
+
+    def coordinates(self, name: str, limit: int = None):
+        """The ids, grid coordinates and admin areas of the candidates of a
+        name, as numpy views in order of descending prior.
+
+        Parameters
+        ----------
+        name : str
+            The lowercased gazetteer name.
+        limit : int, optional
+            Only the first `limit` candidates are returned.
+
+        Returns
+        -------
+        qids, lats, lons, admins : Tuple[numpy.ndarray]
+            Aligned arrays, empty if the name is unknown or the table has
+            no coordinates.
+        """
+
+        i = self._index.get(name)
+        if i is None or not self.has_coordinates():
+            start = end = 0
+        else:
+            start, end = self._offsets[i], self._offsets[i + 1]
+        if limit is not None:
+            end = min(end, start + limit)
+        return (
+            numpy.frombuffer(self._qids, dtype=numpy.int64)[start:end],
+            numpy.frombuffer(self._lats, dtype=numpy.int32)[start:end],
+            numpy.frombuffer(self._lons, dtype=numpy.int32)[start:end],
+            numpy.frombuffer(self._admins, dtype=numpy.int64)[start:end],
+        )
+
+    def has_countries(self):
+        """Whether the table was built with countries."""
+        return len(self._countries) > 0
+
+    def select(self, keep: numpy.ndarray):
+        """A copy of the table with only some of the candidates.
+
+        Parameters
+        ----------
+        keep : numpy.ndarray
+            Boolean mask aligned with the candidates of all names, in the
+            order of their offsets.
+
+        Returns
+        -------
+        table : CandidateTable
+            The kept candidates, in the same order. Names without any kept
+            candidate are dropped.
+        """
+
+        offsets = numpy.frombuffer(self._offsets, dtype=numpy.int64)
+        # the kept candidates before each offset.
+        kept = numpy.concatenate([[0], numpy.cumsum(keep)])[offsets]
+        has_kept = numpy.diff(kept) > 0
+        names = [name for name, has in zip(self._index, has_kept.tolist()) if has]
+        offsets = numpy.append(kept[:-1][has_kept], kept[-1])
+        columns = [self._qids, self._priors, self._lats, self._lons, self._admins, self._countries]
+        columns = [
+            numpy.frombuffer(column, dtype=column.typecode)[keep].tobytes() if len(column) else b''
+            for column in columns
+        ]
+        return CandidateTable(names, offsets.astype(numpy.int64).tobytes(), *columns)
+
+    def n_ambiguous(self):
+        """The number of names with more than one candidate."""
+        offsets = self._offsets
+        return sum(offsets[i + 1] - offsets[i] > 1 for i in range(len(offsets) - 1))
+
+    def nbytes(self):
+        """Approximate memory used by the table, in bytes."""
+        arrays = (self._offsets, self._qids, self._priors, self._lats, self._lons, self._admins, self._countries)
+        arrays = sum(sys.getsizeof(a) for a in arrays)
+        return sys.getsizeof(self._index) + arrays
+
+class TopCandidates(Mapping):
+    """A read-only name -> top qid mapping backed by a CandidateTable. Used
+    in place of a link dict once the gazetteer is loaded in compact mode."""
+
+    def __init__(self, table: CandidateTable):
+        self._table = table
+
+    def __getitem__(self, name: str):
+        qid = self._table.top(name)
+        if qid is None:
+            raise KeyError(name)
+        return qid
+
+    def __contains__(self, name: str):
+        return name in self._table
+
+    def __iter__(self):
+        return iter(self._table._index)
+
+    def __len__(self):
+        return len(self._table)
+
+class AliasIndex:
+    """The reverse of the candidate tables: every gazetteer name each
+    Wikidata id is a candidate of. Distinct names are kept once in a
+    string pool. The alias ids of the i-th qid are the contiguous slice
+    aliases[offsets[i]:offsets[i+1]] of pool indices, with the label each
+    alias was listed under alongside. The row of a qid is found in a dict,
+    so a lookup is O(1) plus the length of the slice.
+
+    Each qid costs about 85 bytes, mostly its entry and int object in the
+    row dict, and each (name, qid) pair 5 bytes. The pool refers to the
+    name strings of the candidate tables, at 8 bytes each. For the bundled
+    gazetteer, 134k qids and 143k pairs, that is about 12 MiB, see nbytes.
+    """
+
+    def __init__(self, labels: Iterable[str] = (), pool: Iterable[str] = (), qids: bytes = b'',
+                 offsets: bytes = b'', aliases: bytes = b'', label_ids: bytes = b''):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        labels : Iterable[str], optional
+            The labels indexed by label_ids.
+        pool : Iterable[str], optional
+            The distinct names indexed by aliases.
+        qids : bytes, optional
+            Serialized array of the integer Wikidata ids, in ascending order.
+        offsets : bytes, optional
+            Serialized array of len(qids) + 1 offsets into aliases.
+        aliases : bytes, optional
+            Serialized array of pool indices.
+        label_ids : bytes, optional
+            Serialized array of label indices, aligned with aliases.
+        """
+
+        self._labels = list(labels)
+        self._pool = list(pool)
+        self._qids = array.array('q', qids)
+        self._offsets = array.array('q', offsets or b'\0' * 8)
+        self._aliases = array.array('i', aliases)
+        self._label_ids = array.array('b', label_ids)
+        self._index = dict(zip(self._qids, range(len(self._qids))))
+
+    @classmethod
+    def from_tables(cls, tables: Dict[str, CandidateTable]):
+        """Build the index of the candidate tables of each label.
+
+        Parameters
+        ----------
+        tables : Dict[str, CandidateTable]
+            The table of each label.
+
+        Returns
+        -------
+        index : AliasIndex
+            The built index. The aliases of a qid are sorted by the rank of
+            the qid among the candidates of the name, so the names that
+            refer to it first come first, then by label and table order.
+        """
+
+        labels = sorted(tables)
+        pool = {}
+        qids, aliases, ranks, label_ids = [], [], [], []
+        for i, label in enumerate(labels):
+            table = tables[label]
+            ids = numpy.array([pool.setdefault(name, len(pool)) for name in table._index], dtype=numpy.int32)
+            offsets = numpy.frombuffer(table._offsets, dtype=numpy.int64)
+            counts = numpy.diff(offsets)
+            qids.append(numpy.frombuffer(table._qids, dtype=numpy.int64))
+            aliases.append(numpy.repeat(ids, counts))
+            ranks.append(numpy.arange(offsets[-1]) - numpy.repeat(offsets[:-1], counts))
+            label_ids.append(numpy.full(offsets[-1], i, dtype=numpy.int8))
+        if not labels:
+            return cls()
+        qids, aliases, ranks, label_ids = (numpy.concatenate(a) for a in (qids, aliases, ranks, label_ids))
+        # lexsort sorts by the last key first; it is stable, so ties keep table order.
+        order = numpy.lexsort((ranks, qids))
+        qids = qids[order]
+        unique, starts = numpy.unique(qids, return_index=True)
+        return cls(
+            labels, pool, unique.tobytes(), numpy.append(starts, len(qids)).astype(numpy.int64).tobytes(),
+            aliases[order].tobytes(), label_ids[order].tobytes()
+        )
+
+    def __len__(self):
+        """The number of Wikidata ids."""
+        return len(self._qids)
+
+    def __contains__(self, qid: str):
+        return qid_to_int(qid) in self._index
+
+    def get(self, qid: str, label: str = None):
+        """All names of a Wikidata id, with their labels.
+
+        Parameters
+        ----------
+        qid : str
+            eg 'Q3411' (Mackenzie River).
+        label : str, optional
+            If set then only the names listed under this label.
+
+        Returns
+        -------
+        aliases : List[Tuple[str, str]]
+            (name, label) tuples, the names for which the qid is the top
+            candidate first. Empty if the qid is unknown.
+        """
+
+        i = self._index.get(qid_to_int(qid))
+        if i is None:
+            return []
+        start, end = self._offsets[i], self._offsets[i + 1]
+        aliases = [(self._pool[self._aliases[j]], self._labels[self._label_ids[j]]) for j in range(start, end)]
+        if label is not None:
+            aliases = [alias for alias in aliases if alias[1] == label]
+        return aliases
+
+    def names(self, qid: str, label: str = None):
+        """The distinct names of a Wikidata id, in the order of get."""
+        return list(OrderedDict.fromkeys(name for name, _ in self.get(qid, label)))
+
+    def nbytes(self):
+        """Approximate memory used by the index, in bytes. The name strings
+        are shared with the candidate tables and not counted."""
+        arrays = (self._qids, self._offsets, self._aliases, self._label_ids)
+        arrays = sum(sys.getsizeof(a) for a in arrays)
+        # the qid int objects are owned by the row dict.
+        ints = sum(sys.getsizeof(qid) for qid in self._index)
+        return sys.getsizeof(self._index) + ints + sys.getsizeof(self._pool) + arrays
@@ -0,0 +1,118 @@
+from typing import Iterable
+
+from spacy.attrs import ENT_IOB, ENT_TYPE, intify_attr
+from spacy.tokens import Doc, DocBin
+from spacy.util import ensure_path
+from spacy.vocab import Vocab
+
+# the attributes an annotated DocBin stores on top of those of its input.
+ENT_ATTRS = (ENT_IOB, ENT_TYPE)
+SUFFIX = '.spacy'
+
+def read_doc_bin(path):
+    """Read a DocBin file, with its user data.
+
+    Parameters
+    ----------
+    path : Path
+        The file written by DocBin.to_bytes.
+
+    Returns
+    -------
+    doc_bin : DocBin
+        The DocBin. Its Docs are only built by get_docs.
+    """
+
+    with open(ensure_path(path), 'rb') as file:
+        doc_bin = DocBin(store_user_data=True).from_bytes(file.read())
+    # files written without user data have none to restore.
+    doc_bin.store_user_data = len(doc_bin.user_data) == len(doc_bin)
+    return doc_bin
+
+def load_docs(path, vocab: Vocab):
+    """Read back the Docs written by a DocBinWriter, in order.
+
+    Parameters
+    ----------
+    path : Path
+        Directory written by a DocBinWriter.
+    vocab : Vocab
+        The vocab of the Docs.
+
+    Yields
+    ------
+    doc : Doc
+        Each Doc, with its entities and user data.
+    """
+
+    for file in sorted(ensure_path(path).glob('*' + SUFFIX)):
+        yield from read_doc_bin(file).get_docs(vocab)
+
+class DocBinWriter:
+    """Buffers Docs in a DocBin and writes it to disk every `chunk_size`
+    Docs, as numbered `.spacy` files, so memory stays bounded regardless of
+    corpus size. The user data, which holds the values of the Span and Doc
+    extensions such as wikilink, is kept, as are the strings of the entity
+    labels, which DocBin.add leaves out.
+    """
+
+    def __init__(self, path, attrs: Iterable = (), chunk_size: int = 10000):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        path : Path
+            Directory the chunks are written to. Created if missing.
+        attrs : Iterable, optional
+            The token attributes to store, see `set_attrs`.
+        chunk_size : int, optional
+            Number of Docs buffered before a chunk is written.
+        """
+
+        self.path = ensure_path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.chunk_size = chunk_size
+        self.n_docs = 0
+        self.files = []
+        self.attrs = None
+        self._doc_bin = None
+        self.set_attrs(attrs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def set_attrs(self, attrs: Iterable):
+        """Store the given token attributes, and the entities, for the next
+        Docs. A chunk is written first if the attributes change."""
+        attrs = sorted(set(intify_attr(attr) for attr in attrs) | set(ENT_ATTRS))
+        if attrs == self.attrs:
+            return
+        self.flush()
+        self.attrs = attrs
+        self._doc_bin = DocBin(attrs=attrs, store_user_data=True)
+
+    def add(self, doc: Doc):
+        """Append a Doc."""
+        self._doc_bin.add(doc)
+        self._doc_bin.strings.update(ent.label_ for ent in doc.ents)
+        self._doc_bin.strings.update(ent.kb_id_ for ent in doc.ents if ent.kb_id)
+        self.n_docs += 1
+        if len(self._doc_bin) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered Docs as a new chunk."""
+        if self._doc_bin is None or len(self._doc_bin) == 0:
+            return
+        file = self.path / f'{len(self.files):05d}{SUFFIX}'
+        with open(file, 'wb') as f:
+            f.write(self._doc_bin.to_bytes())
+        self.files.append(file)
+        self._doc_bin = DocBin(attrs=self.attrs, store_user_data=True)
+
+    def close(self):
+        """Write the remaining Docs."""
+        self.flush()
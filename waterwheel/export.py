@@ -0,0 +1,155 @@
+import array
+import srsly
+import numpy
+from pathlib import Path
+from typing import Dict, Optional
+from collections import OrderedDict
+
+from spacy.util import ensure_path
+
+# column name -> (array typecode, numpy dtype)
+COLUMNS = OrderedDict((
+    ('doc', ('q', numpy.int64)),
+    ('start_char', ('q', numpy.int64)),
+    ('end_char', ('q', numpy.int64)),
+    ('start', ('q', numpy.int64)),
+    ('end', ('q', numpy.int64)),
+    ('label_id', ('Q', numpy.uint64)),
+    ('qid', ('q', numpy.int64)),
+))
+LABELS_FILE = 'labels.json'
+FORMATS = ('npy', 'parquet')
+
+def qid_to_int(qid: Optional[str]):
+    """Convert a Wikidata id such as 'Q3411' to 3411. Missing ids become 0."""
+    return int(qid[1:]) if qid else 0
+
+class ColumnarWriter:
+    """Buffers annotations in typed columns and flushes them to disk in
+    chunks of at most `chunk_size` rows, so memory stays bounded regardless
+    of corpus size. Each chunk is written either as one `.npy` file per
+    column or as a single parquet file (requires pyarrow).
+    """
+
+    def __init__(self, path, ent_ids: Dict, chunk_size: int = 1000000, format: str = 'npy'):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        path : Path
+            Directory the chunks are written to. Created if missing, and
+            must not already hold an export, whose chunks load_columns
+            would merge with the new ones.
+        ent_ids : Dict
+            Mapping of label id to label string, eg ww.gazetteer.ent_ids.
+        chunk_size : int, optional
+            Number of rows buffered before a chunk is flushed.
+        format : str, optional
+            Either 'npy' or 'parquet'.
+        """
+
+        if format not in FORMATS:
+            raise ValueError(f'Unknown format {format}, expected one of {FORMATS}')
+        self.path = ensure_path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        if any(self.path.glob('*.npy')) or any(self.path.glob('*.parquet')) or (self.path / LABELS_FILE).exists():
+            raise ValueError(f'{self.path} already holds an export, write to an empty directory')
+        self.chunk_size = chunk_size
+        self.format = format
+        self.n_rows = 0
+        self._labels = {str(key): label for key, label in ent_ids.items()}
+        self._n_chunks = 0
+        self._reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _reset(self):
+        self._buffers = OrderedDict(
+            (name, array.array(typecode)) for name, (typecode, _) in COLUMNS.items()
+        )
+
+    def add(self, doc: int, start_char: int, end_char: int, start: int, end: int, label_id: int, qid: int):
+        """Append a single annotation row."""
+        buffers = self._buffers
+        buffers['doc'].append(doc)
+        buffers['start_char'].append(start_char)
+        buffers['end_char'].append(end_char)
+        buffers['start'].append(start)
+        buffers['end'].append(end)
+        buffers['label_id'].append(label_id)
+        buffers['qid'].append(qid)
+        self.n_rows += 1
+        if len(buffers['doc']) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows as a new chunk."""
+        if len(self._buffers['doc']) == 0:
+            return
+        columns = OrderedDict(
+            (name, numpy.frombuffer(self._buffers[name], dtype=dtype))
+            for name, (_, dtype) in COLUMNS.items()
+        )
+        stem = f'{self._n_chunks:05d}'
+        if self.format == 'npy':
+            for name, column in columns.items():
+                numpy.save(self.path / f'{stem}.{name}.npy', column)
+        else:
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError('pyarrow is required to export parquet files')
+            table = pyarrow.Table.from_arrays(list(columns.values()), names=list(columns.keys()))
+            pyarrow.parquet.write_table(table, str(self.path / f'{stem}.parquet'))
+        self._n_chunks += 1
+        self._reset()
+
+    def close(self):
+        """Flush remaining rows and write the label mapping."""
+        self.flush()
+        srsly.write_json(self.path / LABELS_FILE, self._labels)
+
+def load_columns(path, decode_labels: bool = True):
+    """Load exported annotations back into memory.
+
+    Parameters
+    ----------
+    path : Path
+        Directory written by a ColumnarWriter.
+    decode_labels : bool, optional
+        If True then a 'label' column with the label strings is added.
+
+    Returns
+    -------
+    columns : Dict
+        Mapping of column name to a numpy array.
+    """
+
+    path = ensure_path(path)
+    chunks = {name: [] for name in COLUMNS}
+    parquet_files = sorted(path.glob('*.parquet'))
+    if parquet_files:
+        import pyarrow.parquet
+        for file in parquet_files:
+            table = pyarrow.parquet.read_table(str(file))
+            for name in COLUMNS:
+                chunks[name].append(table.column(name).to_numpy())
+    else:
+        for name in COLUMNS:
+            for file in sorted(path.glob(f'*.{name}.npy')):
+                chunks[name].append(numpy.load(file))
+    columns = OrderedDict(
+        (name, numpy.concatenate(chunks[name]) if chunks[name] else numpy.empty(0, dtype=dtype))
+        for name, (_, dtype) in COLUMNS.items()
+    )
+    if decode_labels:
+        labels = srsly.read_json(Path(path) / LABELS_FILE)
+        label_ids, inverse = numpy.unique(columns['label_id'], return_inverse=True)
+        names = numpy.array([labels.get(str(label_id), 'WATER_BODY') for label_id in label_ids.tolist()], dtype=object)
+        columns['label'] = names[inverse]
+    return columns
@@ -0,0 +1,152 @@
+import unicodedata
+from typing import Iterable, List
+
+def fold(text: str):
+    """Lowercase a text and strip its diacritics.
+
+    Parameters
+    ----------
+    text : str
+        eg 'Río Chiapa'
+
+    Returns
+    -------
+    folded : str
+        eg 'rio chiapa'
+    """
+
+    text = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+def edit_distance(a: str, b: str, max_distance: int):
+    """Optimal string alignment distance between two strings, i.e.
+    Levenshtein distance with adjacent transpositions.
+
+    Parameters
+    ----------
+    a : str
+        First string.
+    b : str
+        Second string.
+    max_distance : int
+        Computation stops early once the distance exceeds this value.
+
+    Returns
+    -------
+    distance : int
+        The distance, or max_distance + 1 if it exceeds max_distance.
+    """
+
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = None
+    current = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > max_distance and min(previous) >= max_distance:
+            return max_distance + 1
+    return min(current[-1], max_distance + 1)
+
+class FuzzyIndex:
+    """A symmetric deletion (SymSpell) index over gazetteer names. Every
+    name is folded and all deletions of up to `max_edit_distance` characters
+    from its first `prefix_length` characters are indexed, so a lookup only
+    generates the deletions of the query prefix and verifies the few names
+    sharing one of them. The cost of a lookup is independent of the number
+    of names in the gazetteer.
+    """
+
+    def __init__(self, names: Iterable[str], max_edit_distance: int = 1,
+                 prefix_length: int = 7, min_length: int = 5):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        names : Iterable[str]
+            The gazetteer names, eg the keys of WaterWheel._wikidata[label].
+        max_edit_distance : int, optional
+            Maximum edit distance between a query and a returned name.
+        prefix_length : int, optional
+            Number of leading characters that deletions are generated from.
+        min_length : int, optional
+            Queries shorter than this are not looked up.
+        """
+
+        self.max_edit_distance = max_edit_distance
+        self.prefix_length = prefix_length
+        self.min_length = min_length
+        self.names = []
+        self._folded = []
+        self._deletes = {}
+        seen = set()
+        for name in names:
+            folded = fold(name)
+            if len(folded) < min_length - max_edit_distance or folded in seen:
+                continue
+            seen.add(folded)
+            name_id = len(self.names)
+            self.names.append(name)
+            self._folded.append(folded)
+            for delete in self._edits(folded[:prefix_length]):
+                ids = self._deletes.get(delete)
+                if ids is None:
+                    self._deletes[delete] = name_id
+                elif isinstance(ids, int):
+                    self._deletes[delete] = [ids, name_id]
+                else:
+                    ids.append(name_id)
+
+    def __len__(self):
+        """The number of indexed names."""
+        return len(self.names)
+
+    def _edits(self, word: str):
+        """All strings reachable from word by up to max_edit_distance deletions."""
+        edits = {word}
+        frontier = {word}
+        for _ in range(self.max_edit_distance):
+            frontier = {w[:i] + w[i + 1:] for w in frontier if len(w) > 1 for i in range(len(w))}
+            edits.update(frontier)
+        return edits
+
+    def lookup(self, text: str):
+        """Find the gazetteer names closest to a text.
+
+        Parameters
+        ----------
+        text : str
+            The text of a candidate span.
+
+        Returns
+        -------
+        names : List[str]
+            The names at the smallest edit distance found, empty if no
+            name is within max_edit_distance.
+        """
+
+        query = fold(text)
+        if len(query) < self.min_length:
+            return []
+        best_distance = self.max_edit_distance + 1
+        best = []
+        checked = set()
+        for delete in self._edits(query[:self.prefix_length]):
+            ids = self._deletes.get(delete)
+            if ids is None:
+                continue
+            for name_id in ([ids] if isinstance(ids, int) else ids):
+                if name_id in checked:
+                    continue
+                checked.add(name_id)
+                distance = edit_distance(query, self._folded[name_id], best_distance)
+                if distance < best_distance:
+                    best_distance = distance
+                    best = [self.names[name_id]]
+                elif distance == best_distance <= self.max_edit_distance:
+                    best.append(self.names[name_id])
+        return best if best_distance <= self.max_edit_distance else []
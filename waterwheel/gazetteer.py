@@ -0,0 +1,307 @@
+import hashlib
+import threading
+import weakref
+import srsly
+from typing import Callable, Dict, Iterable, Optional
+from collections import OrderedDict
+
+from spacy.attrs import LOWER
+from spacy.vocab import Vocab
+from spacy.matcher import PhraseMatcher
+from spacy.tokens import DocBin
+
+from .fuzzy import FuzzyIndex
+from .candidates import AliasIndex, CandidateTable, TopCandidates
+from .network import RiverNetwork
+from .trie import TokenTrie
+from .raw import RawMatcher
+from .memory import deep_sizeof, rss
+
+# the label of matches whose id is not in the vocab of the gazetteer.
+DEFAULT_LABEL = 'WATER_BODY'
+# number of phrases added to the matcher at a time.
+PHRASE_CHUNK = 1000
+# the matching engines a gazetteer can be built with.
+ENGINES = ('phrase_matcher', 'trie')
+# gazetteers in use in the process, by content hash, language and build options.
+_shared = weakref.WeakValueDictionary()
+# the locks of the gazetteers being built, dropped once they are registered.
+_shared_locks = {}
+_shared_lock = threading.Lock()
+
+class Gazetteer:
+    """Everything loaded from a gazetteer file: the phrase matcher built
+    from its names, the link and candidate tables, the river network and
+    the optional fuzzy index. A gazetteer is not modified once built, so a
+    WaterWheel can swap it for a new one while documents are processed
+    with the old one, see WaterWheel.reload. Its fields are plain dicts,
+    read with `get`, so lookups of unknown keys never insert into a
+    gazetteer shared by threads and WaterWheels.
+    """
+
+    def __init__(self, vocab: Vocab):
+        """Initialize an empty gazetteer.
+
+        Parameters
+        ----------
+        vocab : Vocab
+            The shared vocab the phrase patterns are added to.
+        """
+
+        self.version = None
+        self.matcher = PhraseMatcher(vocab, attr='LOWER')
+        # match id -> label, see DEFAULT_LABEL.
+        self.ent_ids = {}
+        # label -> the words that qualify its names, eg 'lake' or 'mt.'.
+        self.qualifiers = {}
+        self.qualifier_words = set()
+        self.stop_words = set()
+        self.wikidata = {}
+        self.candidates = {}
+        self.aliases = AliasIndex()
+        self.network = None
+        self.needs_qualifier = {}
+        self.doc_bins = {}
+        self.doc_bins_bytes = {}
+        self.n_phrases = {}
+        self.matcher_rss = 0
+        self.max_pattern_length = 0
+        self.fuzzy_index = None
+        self.compact = False
+        self._raw_matcher = None
+        self._raw_lock = threading.Lock()
+
+    @classmethod
+    def from_bytes(cls, serial: bytes, vocab: Vocab, fuzzy: bool = False, max_edit_distance: int = 1,
+                   compact: bool = False, progress: Optional[Callable] = None, engine: str = 'phrase_matcher'):
+        """Build a gazetteer from the bytes of a gazetteer file.
+
+        Parameters
+        ----------
+        serial : bytes
+            The serialized bytes data.
+        vocab : Vocab
+            The shared vocab the phrase patterns are added to.
+        fuzzy : bool, optional
+            If True then a fuzzy index of the names is built.
+        max_edit_distance : int, optional
+            Maximum edit distance of a fuzzy match.
+        compact : bool, optional
+            If True then the DocBins and link dicts are freed once the
+            matcher is built, see WaterWheel.
+        progress : Callable, optional
+            Called with the fraction of phrases added to the matcher.
+        engine : str, optional
+            'phrase_matcher' for spaCy's PhraseMatcher, or 'trie' for a
+            TokenTrie, see waterwheel.trie.
+
+        Returns
+        -------
+        gazetteer : Gazetteer
+            The built gazetteer.
+        """
+
+        if engine not in ENGINES:
+            raise ValueError(f'unknown matching engine {engine!r}, expected one of {ENGINES}')
+        self = cls(vocab)
+        self.version = hashlib.blake2b(serial, digest_size=8).hexdigest()
+        self.compact = compact
+        cfg = srsly.msgpack_loads(serial)
+        if not isinstance(cfg, dict):
+            return self
+        vocab_ids = cfg.get('vocab', {})
+        for hash, label in vocab_ids.items():
+            self.ent_ids[int(hash)] = label
+            self.qualifiers[label] = [label.lower(), label.lower()+'s']
+        self.qualifiers.setdefault('MOUNTAIN', []).extend(['mount', 'mounts', 'mt.'])
+        self.qualifier_words = set(word for words in self.qualifiers.values() for word in words)
+        self.stop_words = set(cfg.get('stop_words', []))
+        self.wikidata = cfg.get('wikidata', {})
+        candidates = cfg.get('candidates', {})
+        self.candidates = {key: CandidateTable.from_dict(value) for key, value in candidates.items()}
+        # labels without candidates only know the linked id of each name.
+        tables = {
+            key: self.candidates.get(key) or CandidateTable.from_rows((name, qid, 0) for name, qid in links.items())
+            for key, links in self.wikidata.items()
+        }
+        self.aliases = AliasIndex.from_tables(tables)
+        network = cfg.get('network')
+        self.network = RiverNetwork.from_dict(network) if network is not None else None
+        needs_qualifier = cfg.get('needs_qualifier', {})
+        self.needs_qualifier = {key: set(names) for key, names in needs_qualifier.items()}
+
+        doc_bins_bytes = cfg.get('doc_bins', {})
+        self.doc_bins = {key: DocBin().from_bytes(value) for key, value in doc_bins_bytes.items()}
+        self.n_phrases = {key: len(bin) for key, bin in self.doc_bins.items()}
+        n_phrases = max(sum(self.n_phrases.values()), 1)
+        n_added = 0
+        rss_before = rss()
+        if engine == 'trie':
+            self.matcher = TokenTrie.from_doc_bins(self.doc_bins, vocab, progress)
+            self.max_pattern_length = self.matcher.depth
+        else:
+            for key, bin in self.doc_bins.items():
+                phrases = list(bin.get_docs(vocab))
+                # added in chunks so that a loading thread regularly releases the GIL.
+                for start in range(0, len(phrases), PHRASE_CHUNK):
+                    self.matcher.add(key.upper(), phrases[start:start + PHRASE_CHUNK])
+                    n_added += len(phrases[start:start + PHRASE_CHUNK])
+                    if progress is not None:
+                        progress(n_added / n_phrases)
+                self.max_pattern_length = max([self.max_pattern_length] + [len(phrase) for phrase in phrases])
+        self.matcher_rss = max(rss() - rss_before, 0)
+        if fuzzy:
+            names = set(name for label in self.wikidata.values() for name in label)
+            self.fuzzy_index = FuzzyIndex(names, max_edit_distance)
+        if compact:
+            # keep the serialized phrases only, and serve links from the candidate arrays.
+            self.doc_bins_bytes = doc_bins_bytes
+            self.doc_bins = {}
+            for key, table in self.candidates.items():
+                if key in self.wikidata:
+                    self.wikidata[key] = TopCandidates(table)
+        return self
+
+    @classmethod
+    def shared(cls, serial: bytes, vocab: Vocab, fuzzy: bool = False, max_edit_distance: int = 1,
+               compact: bool = False, progress: Optional[Callable] = None, engine: str = 'phrase_matcher'):
+        """The gazetteer built from the bytes of a gazetteer file with the
+        given options, shared by every caller in the process while any of
+        them holds it. The first call builds it with from_bytes, and
+        concurrent calls wait for that build rather than repeating it. The
+        matchers compare hashes of lowercase tokens, which only depend on
+        the language, so pipelines with different vocabs of the same
+        language share a gazetteer. See from_bytes for the parameters.
+
+        Returns
+        -------
+        gazetteer : Gazetteer
+            The shared gazetteer. It must not be modified.
+        """
+
+        key = (hashlib.blake2b(serial, digest_size=8).hexdigest(), vocab.lang, fuzzy, max_edit_distance,
+               compact, engine)
+        with _shared_lock:
+            lock = _shared_locks.setdefault(key, threading.Lock())
+        with lock:
+            gazetteer = _shared.get(key)
+            if gazetteer is None:
+                gazetteer = cls.from_bytes(serial, vocab, fuzzy, max_edit_distance, compact, progress, engine)
+                _shared[key] = gazetteer
+            elif progress is not None:
+                progress(1.0)
+        with _shared_lock:
+            if _shared_locks.get(key) is lock:
+                del _shared_locks[key]
+        return gazetteer
+
+    @classmethod
+    def find(cls, version: str, vocab: Vocab, fuzzy: bool = False, max_edit_distance: int = 1,
+             compact: bool = False, engine: str = 'phrase_matcher'):
+        """The shared gazetteer of the given version and options, if one is
+        loaded in the process, eg inherited by a forked worker. See shared.
+
+        Returns
+        -------
+        gazetteer : Gazetteer or None
+            The shared gazetteer, or None if it is not loaded.
+        """
+
+        return _shared.get((version, vocab.lang, fuzzy, max_edit_distance, compact, engine))
+
+    def to_bytes(self):
+        """Serialize the gazetteer to the format read by from_bytes."""
+        if self.compact:
+            doc_bins_bytes = self.doc_bins_bytes
+        else:
+            doc_bins_bytes = {key: bin.to_bytes() for key, bin in self.doc_bins.items()}
+        serial = OrderedDict(
+            (
+                ('stop_words', list(self.stop_words)),
+                ('vocab', self.ent_ids),
+                ('wikidata', {key: dict(links) for key, links in self.wikidata.items()}),
+                ('doc_bins', doc_bins_bytes),
+                ('candidates', {key: table.to_dict() for key, table in self.candidates.items()}),
+            )
+        )
+        if self.network is not None:
+            serial['network'] = self.network.to_dict()
+        if self.needs_qualifier:
+            serial['needs_qualifier'] = {key: sorted(names) for key, names in self.needs_qualifier.items()}
+        return srsly.msgpack_dumps(serial)
+
+    def __len__(self):
+        """The number of names."""
+        return sum(self.n_phrases.values())
+
+    def pipe(self, docs: Iterable, batch_size: int = 1000):
+        """Run the matcher on a stream of documents. A TokenTrie matches a
+        whole batch at once.
+
+        Yields
+        ------
+        doc, matches : Tuple[Doc, List[Tuple[int, int, int]]]
+            Each document and its (match_id, start, end) triples.
+        """
+
+        if isinstance(self.matcher, TokenTrie):
+            yield from self.matcher.pipe(docs, batch_size)
+        else:
+            for doc in docs:
+                yield doc, list(self.matcher(doc))
+
+    def lookahead_start(self, doc):
+        """The first token of a document from which a phrase could continue
+        past its end, see waterwheel.stream. Exact with a TokenTrie, and
+        the longest phrase length from the end with the PhraseMatcher."""
+        if isinstance(self.matcher, TokenTrie):
+            return self.matcher.prefix_start(doc.to_array(LOWER).tolist())
+        return max(len(doc) - self.max_pattern_length + 1, 0)
+
+    def matches_from(self, doc, start: int):
+        """The (match_id, start, end) triples of a document that start at
+        or after token `start`, see waterwheel.stream. A TokenTrie only
+        walks those tokens, the PhraseMatcher matches the whole document."""
+        if isinstance(self.matcher, TokenTrie):
+            return self.matcher(doc, start)
+        return [match for match in self.matcher(doc) if match[1] >= start]
+
+    def raw_matcher(self, abbreviations: Iterable[str] = ()):
+        """The RawMatcher of all names, compiled on first use since that
+        takes a few seconds, see WaterWheel.extract_raw."""
+        with self._raw_lock:
+            if self._raw_matcher is None:
+                names = (name for links in self.wikidata.values() for name in links)
+                self._raw_matcher = RawMatcher(names, abbreviations)
+        return self._raw_matcher
+
+    def get_qid(self, match: Dict):
+        """The Wikidata id of a final match."""
+        if 'qid' in match:
+            return match['qid']
+        return self.wikidata[match['label']].get(match['name'])
+
+    def get_candidates(self, label: str, name: str):
+        """All Wikidata ids a name can refer to, see WaterWheel.get_candidates."""
+        table = self.candidates.get(label)
+        if table is not None and name in table:
+            return table.get(name)
+        # gazetteers built without candidates only know a single id.
+        qid = self.wikidata.get(label, {}).get(name)
+        return [(qid, 0)] if qid is not None else []
+
+    def memory_report(self):
+        """Approximate memory used by each component, in bytes, see
+        WaterWheel.memory_report."""
+        seen = set()
+        return OrderedDict((
+            ('phrase_matcher', self.matcher_rss),
+            ('candidates', deep_sizeof(self.candidates, seen)),
+            ('wikidata', deep_sizeof(self.wikidata, seen)),
+            ('aliases', self.aliases.nbytes()),
+            ('network', deep_sizeof(self.network, seen) if self.network is not None else 0),
+            ('doc_bins', deep_sizeof(self.doc_bins, seen) + deep_sizeof(self.doc_bins_bytes, seen)),
+            ('stop_words', deep_sizeof(self.stop_words, seen)),
+            ('qualifiers', deep_sizeof(self.qualifiers, seen)),
+            ('fuzzy_index', deep_sizeof(self.fuzzy_index, seen) if self.fuzzy_index is not None else 0),
+        ))
@@ -0,0 +1,43 @@
+import math
+import numpy
+from typing import List, Optional, Tuple
+
+# coordinates are stored as int32 grid cells of 1e-5 degrees (about 1 m).
+GRID_SCALE = 100000
+MISSING = -2**31
+KM_PER_DEGREE = 111.2
+
+def to_grid(value: Optional[float]):
+    """Quantize a latitude or longitude. Missing values become MISSING."""
+    if value is None or math.isnan(value):
+        return MISSING
+    return int(round(value * GRID_SCALE))
+
+def closest(lats: numpy.ndarray, lons: numpy.ndarray, anchors: List[Tuple[int, int]]):
+    """Distance from each candidate to its closest anchor.
+
+    Parameters
+    ----------
+    lats : numpy.ndarray
+        Grid latitudes of the candidates.
+    lons : numpy.ndarray
+        Grid longitudes of the candidates.
+    anchors : List[Tuple[int, int]]
+        Grid (latitude, longitude) of the anchors.
+
+    Returns
+    -------
+    distances : numpy.ndarray
+        Approximate (equirectangular) distances in km, inf for candidates
+        without coordinates.
+    """
+
+    anchors = numpy.asarray(anchors, dtype=numpy.float64) / GRID_SCALE
+    c_lats = lats.astype(numpy.float64)[:, None] / GRID_SCALE
+    c_lons = lons.astype(numpy.float64)[:, None] / GRID_SCALE
+    d_lat = c_lats - anchors[None, :, 0]
+    d_lon = (c_lons - anchors[None, :, 1] + 180) % 360 - 180
+    d_lon *= numpy.cos(numpy.radians((c_lats + anchors[None, :, 0]) / 2))
+    distances = numpy.sqrt(d_lat ** 2 + d_lon ** 2).min(axis=1) * KM_PER_DEGREE
+    distances[lats == MISSING] = numpy.inf
+    return distances
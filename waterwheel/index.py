@@ -0,0 +1,417 @@
+import os
+import array
+import srsly
+import numpy
+from typing import Dict, List, Optional
+from collections import OrderedDict
+
+from spacy.util import ensure_path
+
+from .export import qid_to_int
+
+MANIFEST_FILE = 'index.json'
+# per segment term columns, each a contiguous .npy file so that lookups
+# can binary search memory mapped arrays without copying them.
+TERM_COLUMNS = OrderedDict((
+    ('qids', numpy.int64),
+    ('label_ids', numpy.uint64),
+    ('counts', numpy.int64),
+    ('offsets', numpy.int64),
+    ('widths', numpy.uint8),
+))
+POSTINGS_FILE = 'postings.bin'
+WIDTHS = (1, 2, 4, 8)
+
+def _widths(maxima: numpy.ndarray):
+    """The smallest byte widths of unsigned integers able to hold maxima."""
+    return numpy.select([maxima < 1 << 8, maxima < 1 << 16, maxima < 1 << 32], [1, 2, 4], 8).astype(numpy.uint8)
+
+def _positions(counts: numpy.ndarray, offsets: numpy.ndarray, widths: numpy.ndarray, column: int):
+    """Byte position and width of each row of a column, for posting lists
+    laid out as [doc deltas][start chars][lengths] at the term offsets."""
+    terms = numpy.repeat(numpy.arange(len(counts)), counts)
+    firsts = numpy.cumsum(counts) - counts
+    rows = numpy.arange(len(terms)) - firsts[terms]
+    column_starts = offsets + counts * widths[:, :column].sum(axis=1, dtype=numpy.int64)
+    row_widths = widths[terms, column].astype(numpy.int64)
+    return column_starts[terms] + rows * row_widths, row_widths
+
+def _encode(counts: numpy.ndarray, docs: numpy.ndarray, start_chars: numpy.ndarray, end_chars: numpy.ndarray):
+    """Encode the posting lists of consecutive terms as delta coded doc ids,
+    start chars and lengths, each stored with the narrowest unsigned width
+    per term.
+
+    Parameters
+    ----------
+    counts : numpy.ndarray
+        Number of rows of each term.
+    docs, start_chars, end_chars : numpy.ndarray
+        Rows sorted by term and doc, with doc ids relative to the segment.
+
+    Returns
+    -------
+    data, offsets, widths : Tuple[numpy.ndarray]
+        The encoded bytes, the byte offset and the three widths of each term.
+    """
+
+    firsts = numpy.cumsum(counts) - counts
+    deltas = numpy.diff(docs, prepend=0)
+    deltas[firsts] = docs[firsts]
+    columns = (deltas, start_chars, end_chars - start_chars)
+    widths = numpy.stack([_widths(numpy.maximum.reduceat(column, firsts)) for column in columns], axis=1)
+    sizes = counts * widths.sum(axis=1, dtype=numpy.int64)
+    offsets = numpy.cumsum(sizes) - sizes
+    data = numpy.zeros(int(sizes.sum()), dtype=numpy.uint8)
+    for i, column in enumerate(columns):
+        positions, row_widths = _positions(counts, offsets, widths, i)
+        for width in WIDTHS:
+            rows = row_widths == width
+            if rows.any():
+                values = column[rows].astype(f'<u{width}').view(numpy.uint8).reshape(-1, width)
+                data[positions[rows, None] + numpy.arange(width)] = values
+    return data, offsets, widths
+
+def _decode_all(data, counts: numpy.ndarray, offsets: numpy.ndarray, widths: numpy.ndarray):
+    """Decode every posting list of a segment, the inverse of _encode."""
+    columns = []
+    for i in range(3):
+        positions, row_widths = _positions(counts, offsets, widths, i)
+        column = numpy.zeros(len(positions), dtype=numpy.int64)
+        for width in WIDTHS:
+            rows = row_widths == width
+            if rows.any():
+                values = numpy.ascontiguousarray(data[positions[rows, None] + numpy.arange(width)])
+                column[rows] = values.view(f'<u{width}').ravel()
+        columns.append(column)
+    deltas, start_chars, lengths = columns
+    firsts = numpy.cumsum(counts) - counts
+    sums = numpy.cumsum(deltas)
+    docs = sums - numpy.repeat(sums[firsts] - deltas[firsts], counts)
+    return docs, start_chars, start_chars + lengths
+
+def _decode(postings, offset: int, count: int, widths, docs_only: bool = False):
+    """Decode the posting list of a single term, relative doc ids first."""
+    columns = []
+    for width in widths[:1] if docs_only else widths:
+        end = offset + count * int(width)
+        columns.append(numpy.frombuffer(postings[offset:end], dtype=f'<u{int(width)}').astype(numpy.int64))
+        offset = end
+    if docs_only:
+        return numpy.cumsum(columns[0])
+    deltas, start_chars, lengths = columns
+    return numpy.cumsum(deltas), start_chars, start_chars + lengths
+
+class IndexWriter:
+    """Appends annotations to an on-disk inverted index from (integer QID,
+    label id) to posting lists of doc ids and character offsets. Rows are
+    buffered and written as immutable segments of at most `segment_size`
+    rows. After each segment is written, the newest segments are merged
+    while the previous one is not larger than the last, so an index of n
+    postings has O(log n) segments and every posting is rewritten O(log n)
+    times. The manifest is replaced atomically, so readers always see a
+    consistent set of segments.
+    """
+
+    def __init__(self, path, ent_ids: Dict, segment_size: int = 1000000):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        path : Path
+            Directory of the index. Created if missing, appended to if it
+            already holds an index.
+        ent_ids : Dict
+            Mapping of label id to label string, eg ww.gazetteer.ent_ids.
+        segment_size : int, optional
+            Number of rows buffered before a segment is written.
+        """
+
+        self.path = ensure_path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        if (self.path / MANIFEST_FILE).exists():
+            self._manifest = srsly.read_json(self.path / MANIFEST_FILE)
+        else:
+            self._manifest = {'n_docs': 0, 'next_segment': 0, 'segments': [], 'labels': {}}
+        self._manifest['labels'].update((str(key), label) for key, label in ent_ids.items())
+        # doc ids passed to add are relative to the docs already indexed.
+        self._doc_start = self._manifest['n_docs']
+        self.n_docs = 0
+        self.n_rows = 0
+        self._reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _reset(self):
+        self._buffers = OrderedDict((
+            ('doc', array.array('q')),
+            ('start_char', array.array('q')),
+            ('end_char', array.array('q')),
+            ('label_id', array.array('Q')),
+            ('qid', array.array('q')),
+        ))
+
+    def add(self, doc: int, start_char: int, end_char: int, label_id: int, qid: int):
+        """Append a single annotation row. Doc ids must not decrease."""
+        buffers = self._buffers
+        buffers['doc'].append(doc)
+        buffers['start_char'].append(start_char)
+        buffers['end_char'].append(end_char)
+        buffers['label_id'].append(label_id)
+        buffers['qid'].append(qid)
+        self.n_docs = max(self.n_docs, doc + 1)
+        self.n_rows += 1
+        if len(buffers['doc']) >= self.segment_size:
+            self.flush()
+
+    def add_columns(self, columns: Dict, n_docs: Optional[int] = None):
+        """Append annotations from columns, eg the output of
+        waterwheel.export.load_columns(path, decode_labels=False).
+
+        Parameters
+        ----------
+        columns : Dict
+            Arrays doc, start_char, end_char, label_id and qid.
+        n_docs : int, optional
+            Number of documents the columns cover, if some trailing
+            documents have no annotations.
+        """
+
+        n_rows = len(columns['doc'])
+        start = 0
+        while start < n_rows:
+            end = min(n_rows, start + self.segment_size - len(self._buffers['doc']))
+            for name, buffer in self._buffers.items():
+                dtype = numpy.uint64 if buffer.typecode == 'Q' else numpy.int64
+                buffer.frombytes(numpy.ascontiguousarray(columns[name][start:end], dtype=dtype).tobytes())
+            self.n_docs = max(self.n_docs, int(columns['doc'][end - 1]) + 1)
+            self.n_rows += end - start
+            start = end
+            if len(self._buffers['doc']) >= self.segment_size:
+                self.flush()
+        if n_docs is not None:
+            self.n_docs = max(self.n_docs, n_docs)
+
+    def flush(self):
+        """Write the buffered rows as a new segment and merge segments."""
+        if len(self._buffers['doc']) == 0:
+            return
+        columns = {
+            name: numpy.frombuffer(buffer, dtype=numpy.uint64 if buffer.typecode == 'Q' else numpy.int64)
+            for name, buffer in self._buffers.items()
+        }
+        self._reset()
+        columns['doc'] = columns['doc'] + self._doc_start
+        # segments cover increasing doc ranges, which overlap by at most the
+        # doc a segment was cut in.
+        doc_start = int(columns['doc'].min())
+        doc_end = int(columns['doc'].max()) + 1
+        self._manifest['segments'].append(self._write_segment(columns, doc_start, doc_end - doc_start))
+        self._manifest['n_docs'] = max(self._manifest['n_docs'], doc_end)
+        self._merge()
+        self._write_manifest()
+
+    def _write_segment(self, columns: Dict, doc_start: int, n_docs: int):
+        """Write a segment from doc, start_char, end_char, label_id and qid
+        columns with absolute doc ids."""
+        name = f"{self._manifest['next_segment']:05d}"
+        self._manifest['next_segment'] += 1
+        order = numpy.lexsort((columns['start_char'], columns['doc'], columns['label_id'], columns['qid']))
+        columns = {column: values[order] for column, values in columns.items()}
+        qids, label_ids = columns['qid'], columns['label_id']
+        firsts = numpy.flatnonzero(numpy.diff(qids, prepend=-1) | numpy.diff(label_ids.view(numpy.int64), prepend=-1))
+        counts = numpy.diff(numpy.append(firsts, len(qids)))
+        data, offsets, widths = _encode(counts, columns['doc'] - doc_start, columns['start_char'], columns['end_char'])
+        data.tofile(str(self.path / f'{name}.{POSTINGS_FILE}'))
+        terms = {'qids': qids[firsts], 'label_ids': label_ids[firsts], 'counts': counts, 'offsets': offsets, 'widths': widths}
+        for column, dtype in TERM_COLUMNS.items():
+            numpy.save(self.path / f'{name}.{column}.npy', terms[column].astype(dtype))
+        return {'name': name, 'doc_start': doc_start, 'n_docs': n_docs, 'n_postings': len(qids)}
+
+    def _merge(self):
+        """Merge the two newest segments while the older one is not larger."""
+        segments = self._manifest['segments']
+        while len(segments) >= 2 and segments[-2]['n_postings'] <= segments[-1]['n_postings']:
+            first, second = segments[-2], segments[-1]
+            parts = [_Segment(self.path, first).columns(), _Segment(self.path, second).columns()]
+            columns = {column: numpy.concatenate([part[column] for part in parts]) for column in parts[0]}
+            n_docs = second['doc_start'] + second['n_docs'] - first['doc_start']
+            segments[-2:] = [self._write_segment(columns, first['doc_start'], n_docs)]
+            # published before the old files go away.
+            self._write_manifest()
+            for segment in (first, second):
+                for file in self.path.glob(f"{segment['name']}.*"):
+                    file.unlink()
+
+    def _write_manifest(self):
+        tmp = self.path / (MANIFEST_FILE + '.tmp')
+        srsly.write_json(tmp, self._manifest)
+        os.replace(tmp, self.path / MANIFEST_FILE)
+
+    def close(self):
+        """Flush remaining rows and record the number of indexed docs."""
+        self.flush()
+        self._manifest['n_docs'] = max(self._manifest['n_docs'], self._doc_start + self.n_docs)
+        self._write_manifest()
+
+class _Segment:
+    """Read-only view of a segment with memory mapped term columns and postings."""
+
+    def __init__(self, path, info: Dict):
+        self.doc_start = info['doc_start']
+        self.n_docs = info['n_docs']
+        for column in TERM_COLUMNS:
+            setattr(self, column, numpy.load(path / f"{info['name']}.{column}.npy", mmap_mode='r'))
+        postings_file = path / f"{info['name']}.{POSTINGS_FILE}"
+        if postings_file.stat().st_size:
+            self.postings_data = numpy.memmap(postings_file, dtype=numpy.uint8, mode='r')
+        else:
+            self.postings_data = numpy.empty(0, dtype=numpy.uint8)
+
+    def columns(self):
+        """Decode the whole segment into doc, start_char, end_char, label_id
+        and qid columns with absolute doc ids."""
+        counts = numpy.asarray(self.counts)
+        docs, start_chars, end_chars = _decode_all(self.postings_data, counts, numpy.asarray(self.offsets), numpy.asarray(self.widths))
+        return OrderedDict((
+            ('doc', docs + self.doc_start),
+            ('start_char', start_chars),
+            ('end_char', end_chars),
+            ('label_id', numpy.repeat(numpy.asarray(self.label_ids), counts)),
+            ('qid', numpy.repeat(numpy.asarray(self.qids), counts)),
+        ))
+
+    def terms(self, qid: int, label_id: Optional[int] = None):
+        """Term indices of a qid, or of a (qid, label id) pair."""
+        lo = numpy.searchsorted(self.qids, qid, 'left')
+        hi = numpy.searchsorted(self.qids, qid, 'right')
+        if label_id is None:
+            return range(lo, hi)
+        labels = self.label_ids[lo:hi]
+        i = lo + numpy.searchsorted(labels, numpy.uint64(label_id))
+        return range(i, i + 1) if i < hi and self.label_ids[i] == label_id else range(0)
+
+    def docs(self, qid: int, label_id: Optional[int] = None):
+        """Sorted unique absolute doc ids of a qid."""
+        parts = [
+            _decode(self.postings_data, int(self.offsets[i]), int(self.counts[i]), self.widths[i], docs_only=True)
+            for i in self.terms(qid, label_id)
+        ]
+        if not parts:
+            return numpy.empty(0, dtype=numpy.int64)
+        if len(parts) > 1:
+            return numpy.unique(numpy.concatenate(parts)) + self.doc_start
+        docs = parts[0]
+        return docs[numpy.diff(docs, prepend=-1) > 0] + self.doc_start
+
+    def postings(self, qid: int, label_id: Optional[int] = None):
+        """Absolute doc ids, start chars and end chars of a qid, sorted by
+        doc id and start char."""
+        parts = [
+            _decode(self.postings_data, int(self.offsets[i]), int(self.counts[i]), self.widths[i])
+            for i in self.terms(qid, label_id)
+        ]
+        if not parts:
+            empty = numpy.empty(0, dtype=numpy.int64)
+            return empty, empty, empty
+        docs, start_chars, end_chars = (numpy.concatenate(column) for column in zip(*parts))
+        if len(parts) > 1:
+            order = numpy.lexsort((start_chars, docs))
+            docs, start_chars, end_chars = docs[order], start_chars[order], end_chars[order]
+        return docs + self.doc_start, start_chars, end_chars
+
+class InvertedIndex:
+    """Queries an index written by IndexWriter, eg all documents
+    mentioning Q3411. Postings are memory mapped and only the posting lists
+    of the queried ids are decoded.
+    """
+
+    def __init__(self, path):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        path : Path
+            Directory of the index.
+        """
+
+        self.path = ensure_path(path)
+        self.refresh()
+
+    def refresh(self):
+        """Reload the manifest to see segments written since opening."""
+        manifest = srsly.read_json(self.path / MANIFEST_FILE)
+        self.n_docs = manifest['n_docs']
+        self._label_ids = {label: int(key) for key, label in manifest['labels'].items()}
+        self._segments = [_Segment(self.path, info) for info in manifest['segments']]
+
+    def __len__(self):
+        """The number of distinct (qid, label) terms, counted per segment."""
+        return sum(len(segment.qids) for segment in self._segments)
+
+    def _label_id(self, label: Optional[str]):
+        if label is None:
+            return None
+        return self._label_ids.get(label, -1)
+
+    def postings(self, qid: str, label: Optional[str] = None):
+        """All annotations of an id.
+
+        Parameters
+        ----------
+        qid : str
+            eg 'Q3411'.
+        label : str, optional
+            Only annotations with this label, eg 'RIVER'.
+
+        Returns
+        -------
+        columns : Dict
+            Arrays doc, start_char and end_char sorted by doc.
+        """
+
+        qid = qid_to_int(qid)
+        label_id = self._label_id(label)
+        if label_id == -1:
+            parts = []
+        else:
+            parts = [segment.postings(qid, label_id) for segment in self._segments]
+        columns = [numpy.concatenate(column) for column in zip(*parts)] if parts else [numpy.empty(0, dtype=numpy.int64)] * 3
+        return OrderedDict(zip(('doc', 'start_char', 'end_char'), columns))
+
+    def docs(self, qid: str, label: Optional[str] = None):
+        """The sorted ids of the documents mentioning an id."""
+        qid = qid_to_int(qid)
+        label_id = self._label_id(label)
+        if label_id == -1:
+            return numpy.empty(0, dtype=numpy.int64)
+        docs = [segment.docs(qid, label_id) for segment in self._segments]
+        if not docs:
+            return numpy.empty(0, dtype=numpy.int64)
+        docs = numpy.concatenate(docs)
+        # consecutive segments can share the doc they were cut in.
+        return docs[numpy.diff(docs, prepend=-1) > 0]
+
+    def count(self, qid: str, label: Optional[str] = None):
+        """The number of annotations of an id."""
+        qid = qid_to_int(qid)
+        label_id = self._label_id(label)
+        if label_id == -1:
+            return 0
+        return sum(
+            int(segment.counts[i]) for segment in self._segments for i in segment.terms(qid, label_id)
+        )
+
+    def cooccurring(self, qids: List[str]):
+        """The sorted ids of the documents mentioning all of the ids."""
+        docs = None
+        for qid in qids:
+            found = self.docs(qid)
+            docs = found if docs is None else numpy.intersect1d(docs, found, assume_unique=True)
+            if len(docs) == 0:
+                break
+        return docs if docs is not None else numpy.empty(0, dtype=numpy.int64)
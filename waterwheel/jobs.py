@@ -0,0 +1,238 @@
+import io
+import os
+import time
+import shutil
+import hashlib
+import srsly
+from itertools import islice
+from typing import Callable, Dict, List, Optional
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from spacy.util import ensure_path
+
+MANIFEST_FILE = 'manifest.json'
+SHARDS_DIR = 'shards'
+
+def default_pipeline():
+    """Build the pipeline of a worker: en_core_web_sm and a WaterWheel."""
+    import spacy
+    from .waterwheel import WaterWheel
+    return WaterWheel(spacy.load('en_core_web_sm'))
+
+def export_shard(ww, texts: List[str], path):
+    """Annotate the texts of a shard into columnar chunks, see WaterWheel.export."""
+    return ww.export(texts, path)
+
+def checksum(path):
+    """SHA-256 of the names and contents of the files in a directory."""
+    digest = hashlib.sha256()
+    path = ensure_path(path)
+    for file in sorted(path.rglob('*')):
+        if file.is_file():
+            digest.update(str(file.relative_to(path)).encode('utf8'))
+            with open(file, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+    return digest.hexdigest()
+
+# the pipeline of the current worker process, built once by _init_worker.
+_worker_ww = None
+
+def _init_worker(pipeline: Callable):
+    global _worker_ww
+    _worker_ww = pipeline()
+
+def _run_shard(shard: Dict, output_dir: str, annotate: Callable):
+    """Annotate one shard into a temporary directory and move it into
+    place, so a shard directory is either complete or missing."""
+    start = time.perf_counter()
+    with open(shard['input'], 'rb') as file:
+        # only the lines of the shard are read, from its byte offset.
+        file.seek(shard['offset'])
+        lines = islice(io.TextIOWrapper(file, encoding='utf8'), shard['end'] - shard['start'])
+        texts = [line.rstrip('\n') for line in lines]
+    final = ensure_path(output_dir) / SHARDS_DIR / shard['id']
+    tmp = final.with_name(f"{shard['id']}.tmp-{os.getpid()}")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    try:
+        n_rows = annotate(_worker_ww, texts, tmp)
+        digest = checksum(tmp)
+        shutil.rmtree(final, ignore_errors=True)
+        os.replace(tmp, final)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return {'n_docs': len(texts), 'n_rows': n_rows, 'checksum': digest, 'seconds': time.perf_counter() - start}
+
+class Job:
+    """A resumable annotation job. Input files with one document per line
+    are split into shards of `shard_size` lines, which are annotated by a
+    pool of worker processes, each with its own pipeline. Each shard is
+    written to its own directory under `output_dir/shards` and recorded in
+    `output_dir/manifest.json` with a checksum of its files once complete,
+    and the corpus-wide index of its first document as `doc_start`.
+    Running the job again skips the shards whose outputs still match their
+    checksums and retries the others.
+    """
+
+    def __init__(self, inputs: List, output_dir, shard_size: int = 10000, n_process: int = 1,
+                 max_retries: int = 2, pipeline: Callable = default_pipeline,
+                 annotate: Callable = export_shard, report: Optional[Callable] = None):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        inputs : List[Path]
+            Text files with one document per line.
+        output_dir : Path
+            Directory of the manifest and the shard outputs.
+        shard_size : int, optional
+            Number of documents per shard.
+        n_process : int, optional
+            Number of worker processes.
+        max_retries : int, optional
+            Number of times a failed shard is retried within a run. A worker
+            crash fails every shard in flight, one per worker.
+        pipeline : Callable, optional
+            Picklable function building the WaterWheel of a worker.
+        annotate : Callable, optional
+            Picklable function (ww, texts, path) -> number of annotations,
+            writing the outputs of a shard to path. Defaults to columnar export.
+        report : Callable, optional
+            Called with the manifest entry of each finished or failed shard.
+            Defaults to printing a progress line.
+        """
+
+        self.inputs = [str(ensure_path(path)) for path in inputs]
+        self.output_dir = ensure_path(output_dir)
+        self.shard_size = shard_size
+        self.n_process = n_process
+        self.max_retries = max_retries
+        self.pipeline = pipeline
+        self.annotate = annotate
+        self.report = report if report is not None else self._print
+        self.manifest = self._load_manifest()
+
+    def _plan(self):
+        """Split the inputs into shards of line ranges, with the byte
+        offset of the first line of each."""
+        shards = OrderedDict()
+        n_docs = 0
+        for path in self.inputs:
+            offsets = []
+            n_lines = offset = 0
+            with open(path, 'rb') as file:
+                for line in file:
+                    if n_lines % self.shard_size == 0:
+                        offsets.append(offset)
+                    n_lines += 1
+                    offset += len(line)
+            for start, offset in zip(range(0, n_lines, self.shard_size), offsets):
+                shard_id = f'{len(shards):05d}'
+                shards[shard_id] = {
+                    'id': shard_id, 'input': path, 'start': start, 'offset': offset,
+                    'end': min(start + self.shard_size, n_lines), 'doc_start': n_docs + start,
+                    'status': 'pending', 'attempts': 0,
+                }
+            n_docs += n_lines
+        return shards
+
+    def _load_manifest(self):
+        path = self.output_dir / MANIFEST_FILE
+        if path.exists():
+            manifest = srsly.read_json(path)
+            if manifest['inputs'] != self.inputs or manifest['shard_size'] != self.shard_size:
+                raise ValueError(f'{path} was written for other inputs or another shard size')
+            return manifest
+        return {'inputs': self.inputs, 'shard_size': self.shard_size, 'shards': self._plan()}
+
+    def _write_manifest(self):
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        tmp = self.output_dir / (MANIFEST_FILE + '.tmp')
+        srsly.write_json(tmp, self.manifest)
+        os.replace(tmp, self.output_dir / MANIFEST_FILE)
+
+    def _print(self, shard: Dict):
+        n_done = sum(s['status'] == 'done' for s in self.manifest['shards'].values())
+        progress = f"[{n_done}/{len(self.manifest['shards'])}] shard {shard['id']}"
+        if shard['status'] == 'done':
+            print(f"{progress}: {shard['n_docs']} docs, {shard['n_rows']} entities, "
+                  f"{shard['seconds']:.1f} s, {shard['docs_per_second']:.0f} docs/s")
+        else:
+            print(f"{progress}: {shard['status']} after {shard['attempts']} attempts: {shard['error']}")
+
+    def shard_path(self, shard_id: str):
+        """The output directory of a shard."""
+        return self.output_dir / SHARDS_DIR / shard_id
+
+    def completed(self):
+        """Ids of the shards that are done and whose outputs match their checksums."""
+        return [
+            shard_id for shard_id, shard in self.manifest['shards'].items()
+            if shard['status'] == 'done' and self.shard_path(shard_id).exists()
+            and checksum(self.shard_path(shard_id)) == shard['checksum']
+        ]
+
+    def run(self):
+        """Annotate every shard that is not completed.
+
+        Returns
+        -------
+        failed : List[str]
+            Ids of the shards that still failed after max_retries retries.
+        """
+
+        shards = self.manifest['shards']
+        completed = set(self.completed())
+        pending = [shard_id for shard_id in shards if shard_id not in completed]
+        for shard_id in pending:
+            shards[shard_id].update(status='pending', attempts=0)
+        (self.output_dir / SHARDS_DIR).mkdir(parents=True, exist_ok=True)
+        # the partial outputs of workers that crashed in an earlier run.
+        for tmp in (self.output_dir / SHARDS_DIR).glob('*.tmp-*'):
+            shutil.rmtree(tmp, ignore_errors=True)
+        self._write_manifest()
+        pending.reverse()
+        failed = []
+        running = {}
+        pool = None
+        try:
+            while pending or running:
+                if pool is None:
+                    pool = ProcessPoolExecutor(self.n_process, initializer=_init_worker, initargs=(self.pipeline,))
+                # one shard per worker, so a crash only fails the shards it could have caused.
+                while pending and len(running) < self.n_process:
+                    shard_id = pending.pop()
+                    shards[shard_id]['attempts'] += 1
+                    future = pool.submit(_run_shard, shards[shard_id], str(self.output_dir), self.annotate)
+                    running[future] = shard_id
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    shard = shards[running.pop(future)]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        broken = broken or isinstance(e, BrokenProcessPool)
+                        shard['error'] = f'{type(e).__name__}: {e}'
+                        if shard['attempts'] <= self.max_retries:
+                            shard['status'] = 'retrying'
+                            pending.append(shard['id'])
+                        else:
+                            shard['status'] = 'failed'
+                            failed.append(shard['id'])
+                    else:
+                        result['docs_per_second'] = result['n_docs'] / max(result['seconds'], 1e-9)
+                        shard.update(result, status='done', error=None)
+                    self._write_manifest()
+                    self.report(shard)
+                if broken:
+                    pool.shutdown(wait=False)
+                    pool = None
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return failed
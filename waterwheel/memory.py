@@ -0,0 +1,55 @@
+import os
+import sys
+import array
+import resource
+
+def rss():
+    """Current resident set size of the process in bytes. Falls back to
+    the peak resident set size where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on macOS.
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+def deep_sizeof(obj, seen: set = None):
+    """Approximate memory used by an object and everything it references
+    through dicts, lists, tuples, sets and __dict__/__slots__ attributes.
+
+    Parameters
+    ----------
+    obj : object
+        The object to measure.
+    seen : set, optional
+        Ids of objects already counted.
+
+    Returns
+    -------
+    size : int
+        The size in bytes.
+    """
+
+    seen = set() if seen is None else seen
+    stack = [obj]
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, (str, bytes, bytearray, int, float, array.array)):
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(vars(obj))
+        for slot in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, slot):
+                stack.append(getattr(obj, slot))
+    return size
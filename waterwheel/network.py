@@ -0,0 +1,215 @@
+import array
+import numpy
+from typing import Iterable, Tuple
+from collections import OrderedDict
+
+from .export import qid_to_int
+
+class RiverNetwork:
+    """A river network harvested from Wikidata mouth (P403), tributary
+    (P974) and drainage basin (P4614) relations. Each river flows into a
+    single primary mouth, so the network is a forest stored as CSR arrays.
+    Nodes are numbered in depth first order from the sea upwards: the
+    tributaries, direct or not, of node i are exactly the nodes
+    i + 1 ... end[i] - 1. Checking whether a river is upstream of another is
+    O(1), and listing all of its tributaries is a slice.
+    """
+
+    def __init__(self, qids: bytes = b'', parents: bytes = b'', ends: bytes = b'',
+                 basins: bytes = b'', n_dropped: int = 0):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        qids : bytes, optional
+            Serialized array of the integer Wikidata id of each node.
+        parents : bytes, optional
+            Serialized array of the node each node flows into, -1 for mouths
+            into the sea or rivers with unknown mouth.
+        ends : bytes, optional
+            Serialized array of the node following the last tributary of
+            each node.
+        basins : bytes, optional
+            Serialized array of the integer id of the drainage basin of each
+            node, inherited from downstream rivers when not set, 0 if unknown.
+        n_dropped : int, optional
+            Number of secondary mouth edges dropped while building.
+        """
+
+        self._qids = array.array('q', qids)
+        self._parents = array.array('i', parents)
+        self._ends = array.array('i', ends)
+        self._basins = array.array('q', basins)
+        self._index = {qid: i for i, qid in enumerate(self._qids)}
+        self.n_dropped = n_dropped
+
+    @classmethod
+    def from_edges(cls, mouths: Iterable[Tuple[str, str]], basins: Iterable[Tuple[str, str]] = ()):
+        """Build a network from relation edges.
+
+        Parameters
+        ----------
+        mouths : Iterable[Tuple[str, str]]
+            (river, mouth) pairs of qids, eg from P403, or the reverse of P974.
+            The first mouth of a river is kept, repeated edges are ignored.
+            Edges that would close a cycle are dropped.
+        basins : Iterable[Tuple[str, str]], optional
+            (river, drainage basin) pairs of qids, from P4614.
+
+        Returns
+        -------
+        network : RiverNetwork
+            The built network.
+        """
+
+        parent = OrderedDict()
+        n_dropped = 0
+        for river, mouth in mouths:
+            river, mouth = qid_to_int(river), qid_to_int(mouth)
+            parent.setdefault(mouth, None)
+            if parent.get(river) is None and river != mouth:
+                parent[river] = mouth
+            elif parent[river] != mouth:
+                # the same edge from P403 and P974 is not a second mouth.
+                n_dropped += 1
+        basin = {}
+        for river, drainage_basin in basins:
+            basin.setdefault(qid_to_int(river), qid_to_int(drainage_basin))
+            parent.setdefault(qid_to_int(river), None)
+        children = {}
+        for river, mouth in parent.items():
+            if mouth is not None:
+                children.setdefault(mouth, []).append(river)
+        # depth first numbering from the roots; rivers on a cycle have no
+        # root, so one of their mouth edges is dropped to make them one.
+        order, parents, ends, basins_out = [], [], [], []
+        index = {}
+        roots = [river for river, mouth in parent.items() if mouth is None]
+        pending = list(parent)
+        while roots or pending:
+            if not roots:
+                river = pending.pop()
+                if river in index:
+                    continue
+                path = set()
+                while river not in path:
+                    path.add(river)
+                    river = parent[river]
+                roots = [river]
+                n_dropped += 1
+            root = roots.pop()
+            stack = [(root, -1, False)]
+            while stack:
+                river, up, done = stack.pop()
+                if done:
+                    ends[index[river]] = len(order)
+                    continue
+                if river in index:
+                    continue
+                index[river] = len(order)
+                order.append(river)
+                parents.append(up)
+                ends.append(0)
+                inherited = basins_out[up] if up >= 0 else 0
+                basins_out.append(basin.get(river, inherited))
+                stack.append((river, up, True))
+                for child in reversed(children.get(river, [])):
+                    stack.append((child, index[river], False))
+        network = cls(n_dropped=n_dropped)
+        network._qids = array.array('q', order)
+        network._parents = array.array('i', parents)
+        network._ends = array.array('i', ends)
+        network._basins = array.array('q', basins_out)
+        network._index = index
+        return network
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """Load a network from the output of to_dict."""
+        return cls(data['qids'], data['parents'], data['ends'], data['basins'], data.get('n_dropped', 0))
+
+    def to_dict(self):
+        """Serialize the network to a msgpack friendly dict."""
+        return OrderedDict((
+            ('qids', self._qids.tobytes()),
+            ('parents', self._parents.tobytes()),
+            ('ends', self._ends.tobytes()),
+            ('basins', self._basins.tobytes()),
+            ('n_dropped', self.n_dropped),
+        ))
+
+    def __len__(self):
+        """The number of rivers and mouths in the network."""
+        return len(self._qids)
+
+    def __contains__(self, qid: str):
+        return qid_to_int(qid) in self._index
+
+    def is_upstream(self, qid: str, of: str):
+        """Whether a river is a direct or indirect tributary of another.
+
+        Parameters
+        ----------
+        qid : str
+            The candidate tributary, eg 'Q1130063' (Liard River).
+        of : str
+            The downstream river, eg 'Q3411' (Mackenzie River).
+
+        Returns
+        -------
+        upstream : bool
+            False if either river is not in the network.
+        """
+
+        i = self._index.get(qid_to_int(qid))
+        j = self._index.get(qid_to_int(of))
+        if i is None or j is None:
+            return False
+        return j < i < self._ends[j]
+
+    def is_downstream(self, qid: str, of: str):
+        """Whether `of` flows, directly or not, into `qid`."""
+        return self.is_upstream(of, qid)
+
+    def upstream(self, qid: str):
+        """All direct and indirect tributaries of a river.
+
+        Returns
+        -------
+        qids : List[str]
+            Empty if the river is not in the network.
+        """
+
+        i = self._index.get(qid_to_int(qid))
+        if i is None:
+            return []
+        return ['Q' + str(q) for q in self._qids[i + 1:self._ends[i]]]
+
+    def tributaries(self, qid: str):
+        """The direct tributaries of a river."""
+        i = self._index.get(qid_to_int(qid))
+        if i is None:
+            return []
+        parents = numpy.frombuffer(self._parents, dtype=numpy.int32)[i + 1:self._ends[i]]
+        return ['Q' + str(self._qids[i + 1 + j]) for j in numpy.flatnonzero(parents == i)]
+
+    def downstream(self, qid: str):
+        """The rivers and water bodies a river flows through to its final mouth, in order."""
+        i = self._index.get(qid_to_int(qid))
+        path = []
+        while i is not None and self._parents[i] >= 0:
+            i = self._parents[i]
+            path.append('Q' + str(self._qids[i]))
+        return path
+
+    def basin(self, qid: str):
+        """The drainage basin of a river, or of the first downstream river
+        that has one. None if unknown."""
+        i = self._index.get(qid_to_int(qid))
+        if i is None or self._basins[i] == 0:
+            return None
+        return 'Q' + str(self._basins[i])
+
+    def in_basin(self, qid: str, basin: str):
+        """Whether a river belongs to a drainage basin."""
+        return self.basin(qid) == basin
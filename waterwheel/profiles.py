@@ -0,0 +1,154 @@
+import os
+import re
+import numpy
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+from collections import OrderedDict
+
+from spacy.tokens import DocBin
+from spacy.vocab import Vocab
+
+from .candidates import CandidateTable
+from .export import qid_to_int
+
+# where the gazetteer of each profile is stored, see profile_path.
+PROFILE_DIR = Path(os.path.dirname(os.path.realpath(__file__))) / 'resources/profiles'
+
+def profile_path(name: str, directory: Optional[Path] = None):
+    """The gazetteer file of a profile.
+
+    Parameters
+    ----------
+    name : str
+        The profile name, made of letters, digits, '_' and '-'.
+    directory : Path, optional
+        The directory of the profiles, PROFILE_DIR by default.
+
+    Returns
+    -------
+    path : Path
+        The path of the file, which need not exist.
+    """
+
+    if not re.fullmatch(r'[\w-]+', name):
+        raise ValueError(f'invalid profile name {name!r}')
+    return Path(directory or PROFILE_DIR) / f'{name}.msgpack'
+
+def list_profiles(directory: Optional[Path] = None):
+    """The names of the profiles built so far."""
+    directory = Path(directory or PROFILE_DIR)
+    return sorted(path.stem for path in directory.glob('*.msgpack')) if directory.exists() else []
+
+def _candidate_mask(table: CandidateTable, countries: set, admins: set, qids: set, keep_unlocated: bool):
+    """Which candidates of a table a profile keeps, see select_gazetteer."""
+    ids = numpy.frombuffer(table._qids, dtype=numpy.int64)
+    if not countries and not admins and not qids:
+        return numpy.ones(len(ids), dtype=bool)
+    keep = numpy.isin(ids, list(qids))
+    if countries or admins:
+        missing = numpy.zeros(len(ids), dtype=numpy.int64)
+        country = numpy.frombuffer(table._countries, dtype=numpy.int64) if table.has_countries() else missing
+        admin = numpy.frombuffer(table._admins, dtype=numpy.int64) if len(table._admins) else missing
+        keep |= numpy.isin(country, list(countries)) | numpy.isin(admin, list(admins))
+        if keep_unlocated:
+            keep |= (country == 0) & (admin == 0)
+    return keep
+
+def _select_phrases(doc_bin: DocBin, names: CandidateTable):
+    """The phrases of a DocBin whose text is one of the names, selected
+    from its token arrays without creating the Docs."""
+    strings = Vocab().strings
+    orths = {strings.add(string): string for string in doc_bin.strings}
+    keep = []
+    for i, (tokens, spaces) in enumerate(zip(doc_bin.tokens, doc_bin.spaces)):
+        # ORTH is always the first attribute of a DocBin.
+        words = [orths[orth] for orth in tokens[:, 0].tolist()]
+        text = ''.join(word + ' ' * space for word, space in zip(words, spaces[:, 0].tolist()))
+        if text in names:
+            keep.append(i)
+    selected = DocBin(attrs=doc_bin.attrs, store_user_data=doc_bin.store_user_data)
+    selected.tokens = [doc_bin.tokens[i] for i in keep]
+    selected.spaces = [doc_bin.spaces[i] for i in keep]
+    if hasattr(doc_bin, 'cats'):
+        # spaCy 2.2 does not store the categories of the Docs.
+        selected.cats = [doc_bin.cats[i] for i in keep]
+    selected.user_data = [doc_bin.user_data[i] for i in keep] if doc_bin.user_data else []
+    values = set(numpy.concatenate([tokens.ravel() for tokens in selected.tokens]).tolist()) if keep else set()
+    selected.strings = set(string for orth, string in orths.items() if orth in values)
+    return selected
+
+def select_gazetteer(cfg: Dict, labels: Optional[Iterable[str]] = None, countries: Iterable[str] = (),
+                     admins: Iterable[str] = (), qids: Iterable[str] = (), keep_unlocated: bool = True):
+    """Restrict a deserialized gazetteer file to the entities of a region,
+    of some labels or of a list of ids. Names left without any candidate
+    are removed from the phrases, link and candidate tables, and the
+    others link to their best remaining candidate.
+
+    Parameters
+    ----------
+    cfg : Dict
+        The gazetteer file, eg srsly.read_msgpack(path).
+    labels : Iterable[str], optional
+        The labels kept, all by default.
+    countries : Iterable[str], optional
+        Wikidata ids of countries; the entities whose country (P17) is one
+        of them are kept.
+    admins : Iterable[str], optional
+        Wikidata ids of admin areas; the entities directly located in one
+        of them (P131) are kept.
+    qids : Iterable[str], optional
+        Wikidata ids kept whatever their location.
+    keep_unlocated : bool, optional
+        If True then the entities with neither a country nor an admin area,
+        such as oceans, are kept by a country or admin filter.
+
+    Returns
+    -------
+    cfg : Dict
+        The gazetteer file of the profile. The river network is kept whole.
+    """
+
+    countries = set(qid_to_int(qid) for qid in countries)
+    admins = set(qid_to_int(qid) for qid in admins)
+    qids = set(qid_to_int(qid) for qid in qids)
+    wikidata = cfg.get('wikidata', {})
+    labels = list(wikidata) if labels is None else [label for label in labels if label in wikidata]
+    # labels without candidates only know the linked id of each name.
+    tables = OrderedDict(
+        (label, CandidateTable.from_dict(cfg['candidates'][label]) if label in cfg.get('candidates', {})
+         else CandidateTable.from_rows((name, qid, 0) for name, qid in wikidata[label].items()))
+        for label in labels
+    )
+    if countries and not any(table.has_countries() for table in tables.values()):
+        raise ValueError('the gazetteer has no countries, rebuild it from harvests with a Country column')
+    if admins and not any(len(table._admins) for table in tables.values()):
+        raise ValueError('the gazetteer has no admin areas, rebuild it from harvests with an Admin column')
+    tables = OrderedDict(
+        (label, table.select(_candidate_mask(table, countries, admins, qids, keep_unlocated)))
+        for label, table in tables.items()
+    )
+    # labels left without names are dropped.
+    tables = OrderedDict((label, table) for label, table in tables.items() if len(table))
+    doc_bins = OrderedDict()
+    for label, table in tables.items():
+        if label in cfg.get('doc_bins', {}):
+            doc_bin = _select_phrases(DocBin().from_bytes(cfg['doc_bins'][label]), table)
+            if len(doc_bin):
+                doc_bins[label] = doc_bin.to_bytes()
+    profile = OrderedDict((
+        ('stop_words', cfg.get('stop_words', [])),
+        ('vocab', {key: label for key, label in cfg.get('vocab', {}).items() if label in tables}),
+        ('wikidata', {label: {name: table.top(name) for name in table._index} for label, table in tables.items()}),
+        ('doc_bins', doc_bins),
+        ('candidates', {label: table.to_dict() for label, table in tables.items()}),
+    ))
+    if cfg.get('network') is not None:
+        profile['network'] = cfg['network']
+    needs_qualifier = {}
+    for label, names in cfg.get('needs_qualifier', {}).items():
+        names = [name for name in names if label in tables and name in tables[label]]
+        if names:
+            needs_qualifier[label] = names
+    if needs_qualifier:
+        profile['needs_qualifier'] = needs_qualifier
+    return profile
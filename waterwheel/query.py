@@ -0,0 +1,69 @@
+import threading
+
+# the characters of the casing checks of a match, see is_all_caps and is_all_lower.
+ASCII_UPPER = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+ASCII_LOWER = frozenset('abcdefghijklmnopqrstuvwxyz')
+
+def is_symbols(text: str):
+    """Whether a text has neither ASCII letters nor digits, like
+    re.search(r'^[^a-zA-Z\\d]+$', text) but without a regular expression."""
+    if not text:
+        return False
+    for char in text:
+        if char in ASCII_UPPER or char in ASCII_LOWER or char.isdecimal():
+            return False
+    return True
+
+def is_all_caps(text: str):
+    """Whether a text only has ASCII capitals and whitespace, like
+    re.search(r'^[\\sA-Z]+$', text)."""
+    if not text:
+        return False
+    for char in text:
+        if char not in ASCII_UPPER and not char.isspace():
+            return False
+    return True
+
+def is_all_lower(text: str):
+    """Whether a text only has ASCII lowercase letters and whitespace, like
+    re.search(r'^[\\sa-z]+$', text)."""
+    if not text:
+        return False
+    for char in text:
+        if char not in ASCII_LOWER and not char.isspace():
+            return False
+    return True
+
+class QueryScratch(threading.local):
+    """Buffers of WaterWheel.extract_query, allocated once per thread and
+    reused by every call, so annotating a short text allocates little more
+    than its results. Grown when a longer text comes along.
+    """
+
+    def __init__(self, size: int = 64):
+        """Allocate the buffers of the current thread.
+
+        Parameters
+        ----------
+        size : int, optional
+            Initial number of tokens the buffers hold.
+        """
+
+        # token positions covered by a match group, and by a final match.
+        self.seen = bytearray(size)
+        self.taken = bytearray(size)
+        # the matches that passed the preliminary filters.
+        self.candidates = []
+
+    def reset(self, n_tokens: int):
+        """Clear the buffers for a text of n_tokens tokens."""
+        if n_tokens > len(self.seen):
+            self.seen = bytearray(2 * n_tokens)
+            self.taken = bytearray(2 * n_tokens)
+        else:
+            self.seen[:n_tokens] = bytes(n_tokens)
+            self.taken[:n_tokens] = bytes(n_tokens)
+        self.candidates.clear()
+
+# the scratch state of each thread, shared by all WaterWheels.
+scratch = QueryScratch()
@@ -0,0 +1,108 @@
+import re
+import sys
+from typing import Dict, Iterable
+
+# the end of a word, where spaCy would end a token: not followed by a word
+# character, nor by an apostrophe inside a word as in "bol'shaya" (but "nile's").
+WORD_END = re.compile(r"(?!\w)(?!'(?!s(?!\w))\w)")
+# the word before a name, eg 'lake' in 'lake ontario' or 'mt.' in 'mt. everest'.
+PREVIOUS_WORD = re.compile(r"(?<![\w'])([^\W\d_]+\.?) $")
+# the word after a name, eg 'river' in 'nile river', with a following period.
+NEXT_WORD = re.compile(r" ([^\W\d_]+)(?![\w'])(\.?)")
+# longest qualifier looked up before a name, in characters.
+MAX_QUALIFIER = 24
+
+def _trie_pattern(node: Dict):
+    """Regular expression of the names below a node of a character trie,
+    with alternatives factored by common prefix and longer names first."""
+    branches = [re.escape(char) + _trie_pattern(child) for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ''
+    body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+    return '(?:' + body + ')?' if '' in node else body
+
+def lowercase(text: str):
+    """Lowercase a text without changing its length, so offsets into the
+    lowercase text are offsets into the text. Characters whose lowercase
+    form is longer, like 'İ', are kept as they are."""
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    return ''.join(char.lower() if len(char.lower()) == 1 else char for char in text)
+
+class RawMatcher:
+    """Finds gazetteer names in raw text, without tokenization. The names
+    are compiled into a single regular expression, a character automaton
+    factored along the trie of the names, which is searched for the
+    longest name starting at each word boundary. The shorter names ending
+    at a word boundary inside it are then looked up in a set, so all the
+    names in a text are found, overlapping or not, like the phrase matcher
+    finds all the matching token sequences.
+    """
+
+    def __init__(self, names: Iterable[str], abbreviations: Iterable[str] = ()):
+        """Compile the names.
+
+        Parameters
+        ----------
+        names : Iterable[str]
+            The lowercase names.
+        abbreviations : Iterable[str], optional
+            Lowercase words that keep their period as a single token, like
+            'mt.', from the tokenizer exceptions. A name is not matched
+            before the period of one of them.
+        """
+
+        self.names = set(name for name in names if name)
+        self.abbreviations = set(abbreviations)
+        trie = {}
+        for name in self.names:
+            node = trie
+            for char in name:
+                node = node.setdefault(char, {})
+            node[''] = {}
+        limit = sys.getrecursionlimit()
+        try:
+            sys.setrecursionlimit(max(limit, 2 * max(map(len, self.names), default=0) + 100))
+            pattern = _trie_pattern(trie)
+        finally:
+            sys.setrecursionlimit(limit)
+        self.pattern = re.compile(r"(?<!\w)(?<!\w')(?=(" + pattern + ')' + WORD_END.pattern + ')') if pattern else None
+
+    def __len__(self):
+        """The number of names."""
+        return len(self.names)
+
+    def _is_abbreviation(self, lowered: str, start: int, end: int):
+        """Whether a name is the start of an abbreviation token, as 'mt' in 'mt.'."""
+        if lowered[end:end + 1] != '.':
+            return False
+        word_start = max(lowered.rfind(' ', start, end) + 1, start)
+        return lowered[word_start:end + 1] in self.abbreviations
+
+    def __call__(self, lowered: str):
+        """Find all names in a lowercase text.
+
+        Parameters
+        ----------
+        lowered : str
+            The text, lowercased with `lowercase`.
+
+        Returns
+        -------
+        matches : List[Tuple[int, int]]
+            (start, end) character offsets of each name, ordered by start.
+        """
+
+        if self.pattern is None:
+            return []
+        matches = []
+        for match in self.pattern.finditer(lowered):
+            start = match.start()
+            longest = match.end(1)
+            for end in range(start + 1, longest + 1):
+                if end < longest and (WORD_END.match(lowered, end) is None or lowered[start:end] not in self.names):
+                    continue
+                if not self._is_abbreviation(lowered, start, end):
+                    matches.append((start, end))
+        return matches
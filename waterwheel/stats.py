@@ -0,0 +1,114 @@
+import srsly
+from typing import Dict, Iterable
+from collections import Counter, defaultdict
+
+from spacy.util import ensure_path
+
+# the rules of WaterWheel._get_matches a phrase matcher hit can be rejected by.
+REJECTIONS = (
+    'entity',           # overlaps an entity of a preceding component
+    'symbols',          # has no letters or digits
+    'needs_qualifier',  # marked as needing a qualifier by a pruned gazetteer
+    'stop_word',        # unqualified common word
+    'casing',           # unqualified all lower or all upper case
+    'context',          # eg 'CT' in 'CT scan'
+    'abbreviation',     # disabled abbreviation
+    'overlap',          # lost to an overlapping match
+)
+
+class PatternStats:
+    """Per pattern counters of phrase matcher hits: how many were kept and
+    how many were rejected by each rule of WaterWheel._get_matches, see
+    REJECTIONS. Patterns are keyed by label and lowercased name, like the
+    wikidata links. Collected with WaterWheel(nlp, collect_stats=True) and
+    used by scripts/util.py to prune patterns that never survive.
+    """
+
+    def __init__(self):
+        """Initialize empty counters."""
+        self.counts = defaultdict(Counter)
+
+    def record(self, label: str, name: str, outcome: str, qualified: bool = False):
+        """Count a hit of a pattern.
+
+        Parameters
+        ----------
+        label : str
+            The entity type of the pattern.
+        name : str
+            The lowercased name of the pattern.
+        outcome : str
+            'kept' or one of REJECTIONS.
+        qualified : bool, optional
+            Whether the hit was next to a qualifier of its type.
+        """
+
+        counts = self.counts[(label, name)]
+        counts['hits'] += 1
+        counts[outcome] += 1
+        if qualified:
+            counts['qualified'] += 1
+            if outcome == 'kept':
+                counts['kept_qualified'] += 1
+
+    def merge(self, other: 'PatternStats'):
+        """Add the counters of another PatternStats, eg of another process."""
+        for key, counts in other.counts.items():
+            self.counts[key].update(counts)
+        return self
+
+    def __len__(self):
+        """The number of patterns hit at least once."""
+        return len(self.counts)
+
+    def get(self, label: str, name: str):
+        """The counters of a pattern, empty if it was never hit."""
+        return self.counts.get((label, name), Counter())
+
+    def rows(self, min_hits: int = 1):
+        """Counters of the patterns hit at least `min_hits` times, most
+        wasted hits first.
+
+        Yields
+        ------
+        row : Dict
+            label, name, hits, kept, qualified, kept_qualified and a count
+            for each of REJECTIONS.
+        """
+
+        keys = sorted(
+            (key for key, counts in self.counts.items() if counts['hits'] >= min_hits),
+            key=lambda key: (self.counts[key]['kept'] - self.counts[key]['hits'], key)
+        )
+        for label, name in keys:
+            counts = self.counts[(label, name)]
+            row = {'label': label, 'name': name}
+            for column in ('hits', 'kept', 'qualified', 'kept_qualified') + REJECTIONS:
+                row[column] = counts[column]
+            yield row
+
+    def totals(self):
+        """Counters summed over all patterns."""
+        totals = Counter()
+        for counts in self.counts.values():
+            totals.update(counts)
+        return totals
+
+    def to_disk(self, path):
+        """Write the counters as JSON lines, one pattern per line."""
+        srsly.write_jsonl(ensure_path(path), self.rows())
+
+    @classmethod
+    def from_disk(cls, path):
+        """Read counters written by to_disk."""
+        return cls.from_rows(srsly.read_jsonl(ensure_path(path)))
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Dict]):
+        """Build counters from rows as yielded by `rows`."""
+        self = cls()
+        for row in rows:
+            row = dict(row)
+            key = (row.pop('label'), row.pop('name'))
+            self.counts[key].update({column: count for column, count in row.items() if count})
+        return self
@@ -0,0 +1,156 @@
+from spacy.tokens import Doc
+
+def stable_end(text: str):
+    """The length of the beginning of a text whose tokens are final: it
+    ends with whitespace that is followed by more text, so a later append
+    can neither extend its last token nor its trailing whitespace."""
+    end = len(text.rstrip())
+    while end > 0 and not text[end - 1].isspace():
+        end -= 1
+    return end
+
+class EntityStream:
+    """Incremental annotation of a text that arrives a few words at a time,
+    such as a live feed. Text is appended in chunks of any size, and the
+    entities are returned as soon as no longer phrase, qualifier or fuzzy
+    span can change them. Only the text after the last emitted entity is
+    kept, up to a cut token found like in WaterWheel.extract_long. With
+    `engine='trie'` the lookahead is exact, a cut only waits for phrases
+    actually in progress at the end of the text, while with the
+    PhraseMatcher it is the length of the longest phrase.
+
+    The tokens and phrase matches of the pending text are kept between
+    appends: only the text of each append is tokenized, and a TokenTrie
+    only walks the tokens from which a phrase could continue. The other
+    components of the pipeline only run if the component keeps their
+    entities (`overwrite_ents=False`), on the pending text. An append
+    costs time linear in its own text and in the pending tokens, which
+    are at most `max_lookahead` plus those of the append.
+
+    The entities are the same as those of WaterWheel.extract on the whole
+    text, unless more than `max_lookahead` tokens are pending without any
+    cut, in which case the stream is cut at the last whitespace anyway and
+    `n_forced` counted. The document-level geographic disambiguation only
+    sees the pending text, and the whole stream is annotated with the
+    gazetteer current at its start.
+    """
+
+    def __init__(self, ww, max_lookahead: int = 1000):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        ww : WaterWheel
+            The component to annotate with.
+        max_lookahead : int, optional
+            Largest number of final tokens kept pending, see n_forced.
+        """
+
+        ww.maybe_recycle()
+        self.ww = ww
+        self.gazetteer = ww.gazetteer
+        self.max_lookahead = max_lookahead
+        # the character offset of the pending text in the stream.
+        self.offset = 0
+        # the number of cuts that could change entities, see max_lookahead.
+        self.n_forced = 0
+        self.closed = False
+        self._text = ''
+        # the final part of the pending text, tokenized into these words.
+        self._stable = 0
+        self._words = []
+        self._spaces = []
+        # the phrase matches of the words, and the first word from which a
+        # phrase could continue past them.
+        self._matches = []
+        self._lookahead = 0
+
+    def __len__(self):
+        """The number of pending characters."""
+        return len(self._text)
+
+    def _extend(self, end: int):
+        """Tokenize the pending text up to `end`, match the phrases that
+        can end in its new tokens, and return the Doc of the pending words."""
+        ww, gazetteer = self.ww, self.gazetteer
+        n_words = len(self._words)
+        doc = ww.nlp.make_doc(self._text[self._stable:end])
+        self._words.extend(token.text for token in doc)
+        self._spaces.extend(bool(token.whitespace_) for token in doc)
+        self._stable = end
+        if n_words:
+            doc = Doc(ww.nlp.vocab, words=self._words, spaces=self._spaces)
+        # the matches ending in the old words were found by earlier appends.
+        self._matches.extend(
+            match for match in gazetteer.matches_from(doc, min(self._lookahead, n_words)) if match[2] > n_words
+        )
+        if not ww.overwrite:
+            # the entities of the other components are kept, see _get_matches.
+            for name, proc in ww.nlp.pipeline:
+                if name != ww.name:
+                    doc = proc(doc)
+        self._lookahead = gazetteer.lookahead_start(doc)
+        return doc
+
+    def append(self, text: str):
+        """Add the next chunk of the stream.
+
+        Parameters
+        ----------
+        text : str
+            The chunk, eg the next few words with their whitespace.
+
+        Returns
+        -------
+        entities : List[Entity]
+            The entities that became final, with character offsets in the
+            whole stream, in order.
+        """
+
+        if self.closed:
+            raise ValueError('cannot append to a closed stream')
+        self._text += text
+        stable = stable_end(self._text)
+        if stable <= self._stable:
+            return []
+        ww = self.ww
+        doc = self._extend(stable)
+        # a phrase could continue past the end from this token on.
+        horizon = len(doc) - self._lookahead + 1
+        cut = ww._find_cut(doc, self._matches, horizon, self.gazetteer, lowest=1)
+        if cut is None:
+            if len(doc) <= self.max_lookahead:
+                return []
+            cut = next((i for i in range(len(doc) - 1, 0, -1) if doc[i - 1].whitespace_), len(doc) - 1)
+            self.n_forced += 1
+        entities = ww._window_entities(doc, self._matches, cut, self.offset, self.gazetteer)
+        # the rest has no cut until more text arrives.
+        start = doc[cut].idx
+        self.offset += start
+        self._text = self._text[start:]
+        self._stable -= start
+        self._words = self._words[cut:]
+        self._spaces = self._spaces[cut:]
+        self._matches = [(match_id, start - cut, stop - cut) for match_id, start, stop in self._matches if start >= cut]
+        self._lookahead = max(self._lookahead - cut, 0)
+        return entities
+
+    def close(self):
+        """End the stream.
+
+        Returns
+        -------
+        entities : List[Entity]
+            The entities of the pending text.
+        """
+
+        if self.closed:
+            return []
+        self.closed = True
+        doc = self._extend(len(self._text))
+        entities = self.ww._window_entities(doc, self._matches, len(doc), self.offset, self.gazetteer)
+        self.offset += len(self._text)
+        self._text = ''
+        self._stable = 0
+        self._words, self._spaces, self._matches = [], [], []
+        return entities
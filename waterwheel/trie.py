@@ -0,0 +1,304 @@
+import numpy
+from itertools import islice
+from typing import Callable, Dict, Iterable, List, Optional
+
+from spacy.attrs import LOWER
+from spacy.tokens import Doc, DocBin
+from spacy.vocab import Vocab
+
+# odd multipliers mixing a parent node into the token hash of an edge key,
+# tried in turn until the keys of all edges are distinct.
+MULTIPLIERS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93)
+# documents up to this many tokens are matched one token at a time, see TokenTrie._walk.
+MAX_WALK_TOKENS = 16
+
+class TokenTrie:
+    """A trie of gazetteer phrases over lowercase token hashes, used as a
+    drop-in replacement of PhraseMatcher(vocab, attr='LOWER'). Calling it
+    on a Doc returns the same (match_id, start, end) triples, with one
+    triple per label of a matched phrase.
+
+    The trie is stored in flat arrays. Edge i goes from `parents[i]` to
+    `children[i]`, and its key is the token hash XOR the parent times a
+    multiplier, so that for a given parent a key identifies its token.
+    Keys are sorted, so all the edges leaving a set of nodes on a set of
+    tokens are found with one binary search. Matching walks the trie from
+    every token of a document at once, one level per pattern length, so
+    the number of numpy operations is bounded by the longest pattern
+    rather than the document length. The labels ending at node j are
+    `labels[label_ids[ends[j]:ends[j + 1]]]`.
+    """
+
+    def __init__(self, keys: numpy.ndarray, parents: numpy.ndarray, children: numpy.ndarray,
+                 ends: numpy.ndarray, label_ids: numpy.ndarray, labels: numpy.ndarray, multiplier: int,
+                 n_patterns: int = 0, depth: int = 0):
+        """Initialize the class, see from_doc_bins."""
+        self.keys = keys
+        self.parents = parents
+        self.children = children
+        self.ends = ends
+        self.label_ids = label_ids
+        self.labels = labels
+        self.multiplier = numpy.uint64(multiplier)
+        self._multiplier = multiplier
+        self.n_patterns = n_patterns
+        self.depth = depth
+
+    @classmethod
+    def from_doc_bins(cls, doc_bins: Dict[str, DocBin], vocab: Vocab, progress: Optional[Callable] = None):
+        """Build the trie of the phrases of each label.
+
+        Parameters
+        ----------
+        doc_bins : Dict[str, DocBin]
+            The phrases of each label, as stored in the gazetteer file.
+        vocab : Vocab
+            The shared vocab, the match ids are the hashes of the labels.
+        progress : Callable, optional
+            Called with the fraction of labels added.
+
+        Returns
+        -------
+        trie : TokenTrie
+            The built trie.
+        """
+
+        labels = []
+        lengths = []
+        tokens = []
+        pattern_labels = []
+        for i, (key, bin) in enumerate(doc_bins.items()):
+            labels.append(vocab.strings.add(key.upper()))
+            # ORTH is always the first attribute of a DocBin.
+            orths = [array[:, 0] for array in bin.tokens]
+            if orths:
+                orths = numpy.concatenate(orths).astype(numpy.uint64)
+                # strings.add rather than hash_string, since some strings have fixed symbol ids.
+                lower = {vocab.strings.add(string): vocab.strings.add(string.lower()) for string in bin.strings}
+                unique, inverse = numpy.unique(orths, return_inverse=True)
+                tokens.append(numpy.array([lower[orth] for orth in unique.tolist()], dtype=numpy.uint64)[inverse])
+                lengths.append(numpy.array([len(array) for array in bin.tokens], dtype=numpy.int64))
+                pattern_labels.append(numpy.full(len(bin.tokens), i, dtype=numpy.uint8))
+            if progress is not None:
+                progress((i + 1) / len(doc_bins))
+        labels = numpy.array(labels, dtype=numpy.uint64)
+        if not tokens:
+            empty = numpy.zeros(0, dtype=numpy.uint32)
+            return cls(numpy.zeros(0, dtype=numpy.uint64), empty, empty, numpy.zeros(1, dtype=numpy.uint32),
+                       numpy.zeros(0, dtype=numpy.uint8), labels, MULTIPLIERS[0])
+        tokens = numpy.concatenate(tokens)
+        lengths = numpy.concatenate(lengths)
+        pattern_labels = numpy.concatenate(pattern_labels)
+        starts = numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]])
+
+        # add the phrases level by level, each distinct (parent, token) pair is a new node.
+        nodes = numpy.zeros(len(lengths), dtype=numpy.int64)
+        parents, edge_tokens, children = [], [], []
+        n_nodes = 1
+        for depth in range(int(lengths.max()) if len(lengths) else 0):
+            patterns = numpy.flatnonzero(lengths > depth)
+            parent = nodes[patterns]
+            token = tokens[starts[patterns] + depth]
+            order = numpy.lexsort((token, parent))
+            parent, token = parent[order], token[order]
+            new = numpy.ones(len(order), dtype=bool)
+            new[1:] = (parent[1:] != parent[:-1]) | (token[1:] != token[:-1])
+            nodes[patterns[order]] = n_nodes + numpy.cumsum(new) - 1
+            parents.append(parent[new])
+            edge_tokens.append(token[new])
+            children.append(n_nodes + numpy.arange(new.sum()))
+            n_nodes += int(new.sum())
+        parents = numpy.concatenate(parents).astype(numpy.uint32)
+        edge_tokens = numpy.concatenate(edge_tokens)
+        children = numpy.concatenate(children).astype(numpy.uint32)
+
+        for multiplier in MULTIPLIERS:
+            keys = edge_tokens ^ (parents.astype(numpy.uint64) * numpy.uint64(multiplier))
+            order = numpy.argsort(keys, kind='stable')
+            keys = keys[order]
+            if not (keys[1:] == keys[:-1]).any():
+                break
+        else:
+            raise ValueError('no multiplier gives distinct trie edge keys')
+
+        # a phrase listed twice for a label only matches once.
+        terminals = numpy.unique(nodes.astype(numpy.int64) * len(labels) + pattern_labels)
+        terminal_nodes = terminals // len(labels)
+        ends = numpy.zeros(n_nodes + 1, dtype=numpy.uint32)
+        numpy.cumsum(numpy.bincount(terminal_nodes, minlength=n_nodes), out=ends[1:])
+        return cls(keys, parents[order], children[order], ends, (terminals % len(labels)).astype(numpy.uint8),
+                   labels, multiplier, len(lengths), int(lengths.max()))
+
+    def __len__(self):
+        """The number of phrases."""
+        return self.n_patterns
+
+    def nbytes(self):
+        """Bytes used by the arrays of the trie."""
+        return sum(array.nbytes for array in (self.keys, self.parents, self.children, self.ends, self.label_ids))
+
+    def _match(self, tokens: numpy.ndarray):
+        """Find all phrases in an array of lowercase token hashes, where 0
+        separates documents and pads the end with `depth` zeros. No phrase
+        contains the empty string, whose hash is 0, so no match crosses it.
+
+        Returns
+        -------
+        match_ids, starts, ends : numpy.ndarray
+            The label hash, start and end of each match.
+        """
+
+        starts = numpy.flatnonzero(tokens)
+        nodes = numpy.zeros(len(starts), dtype=numpy.uint32)
+        match_ids, match_starts, match_ends = [], [], []
+        for depth in range(self.depth):
+            keys = tokens[starts + depth] ^ (nodes.astype(numpy.uint64) * self.multiplier)
+            edges = numpy.searchsorted(self.keys, keys)
+            numpy.minimum(edges, len(self.keys) - 1, out=edges)
+            found = (self.keys[edges] == keys) & (self.parents[edges] == nodes)
+            starts, nodes = starts[found], self.children[edges[found]]
+            if len(starts) == 0:
+                break
+            counts = (self.ends[nodes + 1] - self.ends[nodes]).astype(numpy.int64)
+            ending = numpy.flatnonzero(counts)
+            if len(ending):
+                # one match per label ending at the node.
+                counts = counts[ending]
+                offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+                label_ids = self.label_ids[numpy.repeat(self.ends[nodes[ending]], counts) + offsets]
+                match_ids.append(self.labels[label_ids])
+                match_starts.append(numpy.repeat(starts[ending], counts))
+                match_ends.append(numpy.repeat(starts[ending] + depth + 1, counts))
+        if not match_ids:
+            empty = numpy.zeros(0, dtype=numpy.int64)
+            return empty.astype(numpy.uint64), empty, empty
+        return numpy.concatenate(match_ids), numpy.concatenate(match_starts), numpy.concatenate(match_ends)
+
+    def _walk(self, tokens: List[int]):
+        """Find all phrases in a few lowercase token hashes, walking the
+        trie from each token in turn with one binary search per step. For
+        short texts such as queries this beats _match, whose numpy calls
+        per level cost more than the whole walk.
+
+        Returns
+        -------
+        matches : List[Tuple[int, int, int]]
+            (match_id, start, end) triples.
+        """
+
+        keys, parents, children, ends = self.keys, self.parents, self.children, self.ends
+        n_keys = len(keys)
+        matches = []
+        for start in range(len(tokens)):
+            node = 0
+            for end in range(start, min(len(tokens), start + self.depth)):
+                key = tokens[end] ^ ((node * self._multiplier) & 0xFFFFFFFFFFFFFFFF)
+                edge = int(keys.searchsorted(numpy.uint64(key)))
+                if edge == n_keys or int(keys[edge]) != key or int(parents[edge]) != node:
+                    break
+                node = int(children[edge])
+                for i in range(int(ends[node]), int(ends[node + 1])):
+                    matches.append((int(self.labels[self.label_ids[i]]), start, end + 1))
+        return matches
+
+    def prefix_start(self, tokens: List[int]):
+        """The first position from which the lowercase token hashes up to
+        the end are the beginning of a phrase longer than them, so a phrase
+        starting there could still be matched once more tokens follow.
+
+        Returns
+        -------
+        start : int
+            The position, or len(tokens) if no phrase can be continued.
+        """
+
+        keys, parents, children = self.keys, self.parents, self.children
+        n_keys = len(keys)
+        for start in range(max(len(tokens) - self.depth + 1, 0), len(tokens)):
+            node = 0
+            for end in range(start, len(tokens)):
+                key = tokens[end] ^ ((node * self._multiplier) & 0xFFFFFFFFFFFFFFFF)
+                edge = int(keys.searchsorted(numpy.uint64(key)))
+                if edge == n_keys or int(keys[edge]) != key or int(parents[edge]) != node:
+                    break
+                node = int(children[edge])
+            else:
+                return start
+        return len(tokens)
+
+    def __call__(self, doc: Doc, start: int = 0):
+        """Find all phrases in a document.
+
+        Parameters
+        ----------
+        doc : Doc
+            The Doc object to search.
+        start : int, optional
+            The first token of the phrases, the tokens before it are not
+            walked.
+
+        Returns
+        -------
+        matches : List[Tuple[int, int, int]]
+            (match_id, start, end) triples like PhraseMatcher, where
+            match_id is the hash of the label.
+        """
+
+        n_tokens = len(doc) - start
+        if n_tokens <= 0 or len(self.keys) == 0:
+            return []
+        if n_tokens <= MAX_WALK_TOKENS:
+            matches = self._walk(doc.to_array(LOWER)[start:].tolist())
+        else:
+            tokens = numpy.zeros(n_tokens + self.depth, dtype=numpy.uint64)
+            tokens[:n_tokens] = doc.to_array(LOWER)[start:]
+            match_ids, starts, ends = self._match(tokens)
+            matches = list(zip(match_ids.tolist(), starts.tolist(), ends.tolist()))
+        if start:
+            matches = [(match_id, start + begin, start + end) for match_id, begin, end in matches]
+        return matches
+
+    def pipe(self, docs: Iterable[Doc], batch_size: int = 1000):
+        """Find all phrases in a stream of documents, walking the trie over
+        the tokens of `batch_size` documents at once. Equivalent to calling
+        the trie on each document, with far fewer numpy calls per document.
+
+        Parameters
+        ----------
+        docs : Iterable[Doc]
+            The Doc objects to search.
+        batch_size : int, optional
+            Number of documents matched together.
+
+        Yields
+        ------
+        doc, matches : Tuple[Doc, List[Tuple[int, int, int]]]
+            Each document and its (match_id, start, end) triples.
+        """
+
+        docs = iter(docs)
+        while True:
+            batch = list(islice(docs, batch_size))
+            if not batch:
+                return
+            if len(self.keys) == 0:
+                yield from ((doc, []) for doc in batch)
+                continue
+            lengths = numpy.array([len(doc) for doc in batch], dtype=numpy.int64)
+            # each document is followed by a 0 separator.
+            offsets = numpy.concatenate([[0], numpy.cumsum(lengths + 1)])
+            tokens = numpy.zeros(offsets[-1] + self.depth, dtype=numpy.uint64)
+            for doc, offset in zip(batch, offsets.tolist()):
+                if len(doc):
+                    tokens[offset:offset + len(doc)] = doc.to_array(LOWER)
+            match_ids, starts, ends = self._match(tokens)
+            doc_ids = numpy.searchsorted(offsets, starts, side='right') - 1
+            order = numpy.argsort(doc_ids, kind='stable')
+            match_ids, starts, ends, doc_ids = match_ids[order], starts[order], ends[order], doc_ids[order]
+            starts -= offsets[doc_ids]
+            ends -= offsets[doc_ids]
+            bounds = numpy.searchsorted(doc_ids, numpy.arange(len(batch) + 1)).tolist()
+            match_ids, starts, ends = match_ids.tolist(), starts.tolist(), ends.tolist()
+            for i, doc in enumerate(batch):
+                lo, hi = bounds[i], bounds[i + 1]
+                yield doc, list(zip(match_ids[lo:hi], starts[lo:hi], ends[lo:hi]))
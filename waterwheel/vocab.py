@@ -0,0 +1,77 @@
+from typing import Iterable
+
+from spacy import about
+from spacy.language import Language
+from spacy.morphology import Morphology
+from spacy.vocab import Vocab
+
+# the (major, minor) version of spaCy, setup.py pins 2.2.3.
+SPACY_VERSION = tuple(int(part) for part in about.__version__.split('.')[:2])
+
+def fresh_vocab(vocab: Vocab, strings: bytes):
+    """A new vocab with the strings of a snapshot, sharing the lookup
+    tables, lexical attribute getters, lemmatizer, tag map and vectors of
+    `vocab`. Only the strings, lexemes and morphology caches, which grow
+    with the documents processed, are new.
+
+    Parameters
+    ----------
+    vocab : Vocab
+        The vocab whose read-only resources are shared.
+    strings : bytes
+        The StringStore.to_bytes snapshot of the pinned strings.
+
+    Returns
+    -------
+    vocab : Vocab
+        The new vocab.
+    """
+
+    # the optional lookup tables only exist since spaCy 2.3.
+    lookups_extra = getattr(vocab, 'lookups_extra', None)
+    kwargs = {'lookups_extra': lookups_extra} if lookups_extra is not None else {}
+    new = Vocab(lex_attr_getters=vocab.lex_attr_getters, lookups=vocab.lookups, **kwargs)
+    new.strings.from_bytes(strings)
+    morphology = vocab.morphology
+    if SPACY_VERSION < (3, 0):
+        # the morphological exceptions are added again to the new strings.
+        new.morphology = Morphology(new.strings, morphology.tag_map, morphology.lemmatizer,
+                                    exc=getattr(morphology, 'exc', None))
+    else:
+        new.morphology = Morphology(new.strings)
+    new.vectors = vocab.vectors
+    new.cfg.update(vocab.cfg)
+    return new
+
+def rebuild_pipeline(nlp: Language, vocab: Vocab, keep: Iterable = ()):
+    """Move a pipeline to a new vocab, in place, so the old vocab and
+    everything it allocated can be freed once the documents using it are.
+    The tokenizer is rebuilt with the same rules. Components with a vocab
+    are rebuilt from their factory, as by spacy.load, and their weights
+    copied through to_bytes. Components without a vocab, and those named
+    in `keep`, are kept as they are.
+
+    Parameters
+    ----------
+    nlp : Language
+        The pipeline to move.
+    vocab : Vocab
+        The new vocab, see fresh_vocab.
+    keep : Iterable, optional
+        Names of components not to rebuild.
+    """
+
+    tokenizer = nlp.tokenizer
+    args = tokenizer.__reduce__()[1][1:]
+    fresh = type(nlp)(vocab=vocab, make_doc=type(tokenizer)(vocab, *args), meta=nlp.meta)
+    factories = nlp.meta.get('factories', {})
+    pipeline = []
+    for name, proc in nlp.pipeline:
+        if name not in keep and hasattr(proc, 'vocab') and hasattr(proc, 'to_bytes'):
+            config = nlp.meta.get('pipeline_args', {}).get(name, {})
+            new = fresh.create_pipe(factories.get(name, name), config=config)
+            proc = new.from_bytes(proc.to_bytes(exclude=['vocab']), exclude=['vocab'])
+        pipeline.append((name, proc))
+    nlp.vocab = vocab
+    nlp.tokenizer = fresh.tokenizer
+    nlp.pipeline = pipeline
@@ -1,16 +1,47 @@
-import re
 import os
+import time
+import pickle
 import srsly
+import threading
+import numpy
 from pathlib import Path
-from typing import Dict, List
-from collections import defaultdict, OrderedDict
+from itertools import islice
+from typing import Iterable, List
+from collections import namedtuple
+from concurrent.futures import Future
 
 from spacy.util import ensure_path
 from spacy.language import Language
 from spacy.pipeline import EntityRuler
-from spacy.tokens import Doc, Span, DocBin
+from spacy.matcher import Matcher, PhraseMatcher
+from spacy.tokens import Doc, Span
+
+from .export import ColumnarWriter, qid_to_int
+from .index import IndexWriter
+from .docbin import DocBinWriter, read_doc_bin
+from .gazetteer import DEFAULT_LABEL, ENGINES, Gazetteer
+from .profiles import list_profiles, profile_path
+from .stats import PatternStats
+from .raw import MAX_QUALIFIER, NEXT_WORD, PREVIOUS_WORD, lowercase
+from .query import is_all_caps, is_all_lower, is_symbols, scratch
+from .memory import rss
+from .vocab import fresh_vocab, rebuild_pipeline
+from .geo import MISSING, closest
 
 DOC_BIN_FILE = Path(os.path.dirname(os.path.realpath(__file__))) / 'resources/doc_bins.msgpack'
+WIKIDATA_URL = 'https://www.wikidata.org/wiki/'
+# longest candidate span, in tokens, looked up by the fuzzy matcher.
+MAX_FUZZY_TOKENS = 4
+# bounds on the document-level geographic disambiguation pass.
+MAX_GEO_ANCHORS = 32
+MAX_GEO_CANDIDATES = 256
+
+# attributes of a WaterWheel rebuilt rather than pickled, see WaterWheel.__getstate__.
+UNPICKLED = ('_gazetteer', '_reload_lock', '_loaded', '_load_thread', 'matcher', 'phrase_matcher')
+
+# lightweight record yielded by WaterWheel.extract in place of a Span.
+# version is the hash of the gazetteer that produced the record.
+Entity = namedtuple('Entity', ['start_char', 'end_char', 'label', 'qid', 'version'])
 
 class WaterWheel(EntityRuler):
     """WATERWHEEL (WATERloo Water and Hydrologic Entity Extractor and Linker)
@@ -21,7 +52,12 @@ class WaterWheel(EntityRuler):
 
     name = 'waterwheel'
 
-    def __init__(self, nlp: Language, overwrite_ents: bool = True, disable_abbreviations: bool = False):
+    def __init__(self, nlp: Language, overwrite_ents: bool = True, disable_abbreviations: bool = False,
+                 background: bool = False, fuzzy: bool = False, max_edit_distance: int = 1,
+                 geo_disambiguation: bool = False, compact: bool = False, collect_stats: bool = False,
+                 engine: str = 'phrase_matcher', max_vocab_growth: int = 0, share_gazetteer: bool = True,
+                 max_candidates: int = 0, max_group_size: int = 0, time_budget: float = 0, profile: str = None,
+                 path=None):
         """Initialize the class.
         
         Parameters
@@ -36,14 +72,105 @@ class WaterWheel(EntityRuler):
         disable_abbreviations : bool, optional
             If True then all abbreviations of US_STATES of CANADIAN_PROVINCES
             will be ignored.
+        background : bool, optional
+            If True then the gazetteer is loaded on a background thread and
+            the constructor returns immediately. Processing a document blocks
+            until loading is finished, see `ready`, `wait` and `progress`.
+        fuzzy : bool, optional
+            If True then capitalized spans missed by the exact matcher are
+            looked up in a diacritic-insensitive fuzzy index of the gazetteer.
+        max_edit_distance : int, optional
+            Maximum edit distance of a fuzzy match.
+        geo_disambiguation : bool, optional
+            If True then names with several candidates are linked to the
+            candidate closest to the unambiguous entities of the document,
+            when the gazetteer has coordinates. The linked candidate comes
+            first in `ent._.candidates`.
+        compact : bool, optional
+            If True then the DocBins and link dicts used to build the matcher
+            are freed after loading. Only their serialized bytes and the
+            candidate arrays are kept for `__len__`, linking and `to_bytes`.
+        collect_stats : bool, optional
+            If True then the hits of each gazetteer pattern, and the rule
+            that rejected them if any, are counted in `stats`.
+        engine : str, optional
+            The matcher of the gazetteer phrases: 'phrase_matcher' for spaCy's
+            PhraseMatcher, or 'trie' for an array-backed trie of lowercase
+            token hashes that loads much faster and matches whole batches in
+            `pipe`, `extract`, `export` and `index`, see waterwheel.trie.
+        max_vocab_growth : int, optional
+            If positive then the vocab of `nlp` is recycled once documents
+            have added that many strings to it, see `recycle`. `extract`,
+            `export` and `index` check between batches, other loops call
+            `maybe_recycle`. The gazetteer then keeps its phrases in a vocab
+            of its own, so they are not copied into the recycled vocab.
+        share_gazetteer : bool, optional
+            If True then WaterWheels of the process loading the same file
+            with the same `fuzzy`, `max_edit_distance`, `compact` and
+            `engine` share one gazetteer, built once, whatever their other
+            options, see Gazetteer.shared. A shared gazetteer must not be
+            modified; pass False for a private one that can be.
+        max_candidates : int, optional
+            If positive then only the first `max_candidates` phrase matches
+            of a document, in order of position, are considered.
+        max_group_size : int, optional
+            If positive then a run of overlapping matches is resolved in
+            groups of at most `max_group_size` matches, left to right, so
+            dense runs such as lists of names cost time linear in their
+            length. Matches of consecutive groups still never overlap.
+        time_budget : float, optional
+            If positive then the phrase and fuzzy matches of a document are
+            checked, in order of position, for at most this many seconds.
+            The matches checked by then are resolved as usual and the others
+            dropped, so a document keeps the entities of its beginning. A
+            document that hits this or the two limits above lists them in
+            `doc._.limits_hit`, and is counted in `n_limited`.
+        profile : str, optional
+            If set then the gazetteer of this profile, built with
+            `python scripts/util.py profile`, is loaded instead of the
+            bundled one, see waterwheel.profiles.
+        path : Path, optional
+            A gazetteer file to load instead of the bundled one, eg a pruned
+            copy, rather than loading the bundled one and then `from_disk`.
         """
+        if engine not in ENGINES:
+            raise ValueError(f'unknown matching engine {engine!r}, expected one of {ENGINES}')
+        if path is not None and profile is not None:
+            raise ValueError('pass either a gazetteer path or a profile, not both')
+        path = DOC_BIN_FILE if path is None else ensure_path(path)
+        if profile is not None:
+            path = profile_path(profile)
+            if not path.exists():
+                raise ValueError(f'unknown gazetteer profile {profile!r}, expected one of {list_profiles()}')
         super().__init__(nlp, phrase_matcher_attr='LOWER', overwrite_ents=overwrite_ents)
         self._disable_abbreviations = disable_abbreviations
-        self._ent_ids = defaultdict(lambda: "WATER_BODY")
-        self._stop_words = set()
-        self._wikidata = {}
-        self._doc_bins = {}
-        self._qualifiers = defaultdict(lambda: [])
+        self._gazetteer = Gazetteer(nlp.vocab)
+        self._gazetteer_path = None
+        # (path, version) of the gazetteer of an unpickled WaterWheel, loaded on first use.
+        self._reference = None
+        self._reload_lock = threading.Lock()
+        self._compact = compact
+        self._fuzzy = fuzzy
+        self._max_edit_distance = max_edit_distance
+        self._geo_disambiguation = geo_disambiguation
+        self._engine = engine
+        self._max_vocab_growth = max_vocab_growth
+        self._share_gazetteer = share_gazetteer
+        self._max_candidates = max_candidates
+        self._max_group_size = max_group_size
+        self._time_budget = time_budget
+        # the number of documents that hit a limit.
+        self.n_limited = 0
+        # the strings of the model, before any gazetteer or document, the
+        # start of the gazetteer vocab and of every recycled vocab.
+        self._pinned_strings = nlp.vocab.strings.to_bytes()
+        self._n_pinned = len(nlp.vocab.strings)
+        self.n_recycles = 0
+        # tokens of the tokenizer exceptions that end with a period, like 'mt.'.
+        self._abbreviations = set(
+            key.lower() for key in getattr(nlp.Defaults, 'tokenizer_exceptions', {}) if key.endswith('.')
+        )
+        self.stats = PatternStats() if collect_stats else None
         # if a match without a qualifier can be of multiple potential types then
         # this is used to set priority.
         self._pq = {
@@ -52,8 +179,206 @@ class WaterWheel(EntityRuler):
                 'US_STATE', 'LAKE', 'MOUNTAIN', 'DRAINAGEBASIN', 
                 'WATERCOURSE', 'WATER_BODY', 'CHINESE_PROVINCE'
         ])}
-        self.from_disk(DOC_BIN_FILE)
+        self._progress = 0.0
+        self._load_error = None
+        self._loaded = threading.Event()
+        self._set_extensions()
+        if background:
+            self._load_thread = threading.Thread(target=self._load, args=(path,), daemon=True)
+            self._load_thread.start()
+        else:
+            self._load(path)
+            self.wait()
+
+    @staticmethod
+    def _set_extensions():
+        """Register the Span and Doc attributes set by WaterWheel."""
         Span.set_extension('wikilink', default=None, force=True)
+        Span.set_extension('candidates', default=None, force=True)
+        Doc.set_extension('gazetteer_version', default=None, force=True)
+        Doc.set_extension('limits_hit', default=None, force=True)
+
+    def _load(self, path):
+        """Load the gazetteer from disk and flag the component as ready."""
+        try:
+            self.from_disk(path)
+        except Exception as e:
+            self._load_error = e
+        finally:
+            self._loaded.set()
+
+    def ready(self):
+        """Whether the gazetteer has finished loading."""
+        return self._loaded.is_set()
+
+    def wait(self, timeout: float = None):
+        """Block until the gazetteer has finished loading.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum number of seconds to wait. Waits indefinitely by default.
+
+        Returns
+        -------
+        ready : bool
+            True if loading finished within the timeout.
+        """
+
+        if self._reference is not None:
+            self._attach()
+        if not self._loaded.wait(timeout):
+            return False
+        if self._load_error is not None:
+            raise self._load_error
+        return True
+
+    def progress(self):
+        """Fraction of the gazetteer loaded so far, between 0.0 and 1.0."""
+        return self._progress
+
+    def _set_progress(self, progress: float):
+        self._progress = progress
+
+    @property
+    def gazetteer(self):
+        """The gazetteer used for new documents. Blocks until loaded.
+
+        Returns
+        -------
+        gazetteer : Gazetteer
+            See waterwheel.gazetteer.Gazetteer.
+        """
+
+        self.wait()
+        return self._gazetteer
+
+    @property
+    def version(self):
+        """The hash of the gazetteer used for new documents."""
+        return self.gazetteer.version
+
+    def reload(self, path):
+        """Load a new gazetteer file in the background and swap it in once
+        its matcher and link tables are built. Documents are processed with
+        the old gazetteer until then, and each call, or batch of a stream in
+        `pipe` and `extract`, keeps the gazetteer it started with, so a swap
+        happens between documents. The results of
+        a document report the version that produced them, in
+        doc._.gazetteer_version or Entity.version. Memory peaks at two
+        gazetteers during a reload. Concurrent reloads are applied in turn.
+
+        Parameters
+        ----------
+        path : Path
+            path to the gazetteer file, eg a rebuilt doc_bins.msgpack.
+
+        Returns
+        -------
+        future : Future
+            Resolves to the new version once swapped in, or to the error
+            that stopped the reload, in which case the old gazetteer is kept.
+        """
+
+        self.wait()
+        future = Future()
+
+        def build():
+            try:
+                with self._reload_lock:
+                    with open(ensure_path(path), 'rb') as file:
+                        serial = file.read()
+                    gazetteer = self._build_gazetteer(serial)
+                    # a single reference assignment, so calls see either version whole.
+                    self._gazetteer = gazetteer
+                    self._gazetteer_path = ensure_path(path)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(gazetteer.version)
+
+        threading.Thread(target=build, daemon=True).start()
+        return future
+
+    def _build_gazetteer(self, serial: bytes, progress=None):
+        """Build, or reuse if shared, the gazetteer of a gazetteer file."""
+        build = Gazetteer.shared if self._share_gazetteer else Gazetteer.from_bytes
+        return build(serial, self._gazetteer_vocab(), self._fuzzy, self._max_edit_distance, self._compact,
+                     progress=progress, engine=self._engine)
+
+    def _gazetteer_vocab(self):
+        """The vocab a new gazetteer adds its phrases to: the shared vocab,
+        or one of its own if the shared vocab is recycled. Its matcher only
+        compares hashes with those of the documents, so the strings of its
+        phrases need not be copied into recycled vocabs."""
+        if self._max_vocab_growth > 0 or self.n_recycles > 0:
+            return fresh_vocab(self.nlp.vocab, self._pinned_strings)
+        return self.nlp.vocab
+
+    @property
+    def vocab_growth(self):
+        """The number of strings added to the shared vocab since it was
+        created or last recycled."""
+        return len(self.nlp.vocab.strings) - self._n_pinned
+
+    def recycle(self):
+        """Move the shared nlp object to a new vocab holding only the
+        strings of the model, so the strings, lexemes and tokenizer cache
+        added by past documents are freed along with the last of those
+        documents. The tokenizer and the components of other packages are
+        rebuilt on the new vocab, with their weights copied in memory, while
+        the gazetteer is kept: its matcher only compares hashes. Documents
+        made before keep working with the old vocab. Without
+        `max_vocab_growth` the gazetteer holds its phrases in the old vocab,
+        which it keeps alive until the next reload. Do not call this
+        while a stream from nlp.pipe is being consumed, nor from several
+        threads.
+
+        Returns
+        -------
+        n_strings : int
+            The number of strings freed.
+        """
+
+        n_strings = self.vocab_growth
+        vocab = fresh_vocab(self.nlp.vocab, self._pinned_strings)
+        rebuild_pipeline(self.nlp, vocab, keep=[self.name])
+        # the entity ruler matchers are unused, but would keep the old vocab alive.
+        self.matcher = Matcher(vocab)
+        self.phrase_matcher = PhraseMatcher(vocab, attr=self.phrase_matcher_attr)
+        self._n_pinned = len(vocab.strings)
+        self.n_recycles += 1
+        return n_strings
+
+    def maybe_recycle(self):
+        """Recycle the shared vocab if it grew by more than `max_vocab_growth`
+        strings, see `recycle`. Call it between streams of documents.
+
+        Returns
+        -------
+        recycled : bool
+            True if the vocab was recycled.
+        """
+
+        if self._max_vocab_growth <= 0 or self.vocab_growth <= self._max_vocab_growth:
+            return False
+        self.recycle()
+        return True
+
+    def _pipe_texts(self, texts: Iterable[str], batch_size: int):
+        """Process texts with the shared nlp object, without this component.
+        In a new nlp.pipe stream for each batch if the vocab is recycled,
+        so that it can be recycled between batches."""
+        if self._max_vocab_growth <= 0:
+            yield from self.nlp.pipe(texts, batch_size=batch_size, disable=[self.name])
+            return
+        texts = iter(texts)
+        while True:
+            batch = list(islice(texts, batch_size))
+            if not batch:
+                return
+            self.maybe_recycle()
+            yield from self.nlp.pipe(batch, batch_size=batch_size, disable=[self.name])
 
     def __call__(self, doc: Doc):
         """Find matches in document and add them as entities
@@ -69,49 +394,557 @@ class WaterWheel(EntityRuler):
             The Doc with added entities, if available.
         """
 
+        return self._set_entities(doc, None, self.gazetteer)
+
+    def pipe(self, docs: Iterable[Doc], batch_size: int = 1000):
+        """Find matches in a stream of documents and add them as entities,
+        matching `batch_size` documents at once. Used by nlp.pipe.
+
+        Parameters
+        ----------
+        docs : Iterable[Doc]
+            The Doc objects in the pipeline.
+        batch_size : int, optional
+            Number of documents matched together.
+
+        Yields
+        ------
+        doc : Doc
+            Each Doc with added entities, if available.
+        """
+
+        for doc, matches, gazetteer in self._match_stream(docs, batch_size):
+            yield self._set_entities(doc, matches, gazetteer)
+
+    def _match_stream(self, docs: Iterable[Doc], batch_size: int, gazetteer: Gazetteer = None):
+        """Run the matcher on a stream of documents in batches, each batch
+        with the gazetteer current at its start unless one is given.
+
+        Yields
+        ------
+        doc, matches, gazetteer : Tuple[Doc, List, Gazetteer]
+            Each document, its phrase matches and the gazetteer they come from.
+        """
+
+        docs = iter(docs)
+        while True:
+            batch = list(islice(docs, batch_size))
+            if not batch:
+                return
+            current = gazetteer if gazetteer is not None else self.gazetteer
+            for doc, matches in current.pipe(batch, batch_size):
+                yield doc, matches, current
+
+    def _set_entities(self, doc: Doc, matches: List, gazetteer: Gazetteer):
+        """Add the final matches of a document as entities."""
+        doc._.set('limits_hit', None)
         if self.overwrite:
             doc.ents = []
-        matches = list(self.phrase_matcher(doc))
-        matches = sorted([(start, end, self._ent_ids[m_id]) for m_id, start, end in matches if start != end])
+        spans = []
+        for match in self._get_matches(doc, matches, gazetteer):
+            span = Span(doc, match['start'], match['end'], label = match['label'])
+            qid = gazetteer.get_qid(match)
+            candidates = gazetteer.get_candidates(match['label'], match['name'])
+            if 'qid' in match:
+                # the candidate chosen by _disambiguate comes first, like the top prior one otherwise.
+                candidates = sorted(candidates, key = lambda candidate: candidate[0] != qid)
+            span._.set('wikilink', WIKIDATA_URL + qid)
+            span._.set('candidates', candidates)
+            spans.append(span)
+        doc.ents = list(doc.ents) + spans
+        doc._.set('gazetteer_version', gazetteer.version)
+        return doc
+
+    def extract(self, texts: Iterable[str], batch_size: int = 1000):
+        """Extract entities from a stream of texts without creating Span
+        objects or modifying doc.ents. The waterwheel component itself is
+        disabled while the texts are processed by the shared nlp object.
+
+        Parameters
+        ----------
+        texts : Iterable[str]
+            The texts to process.
+        batch_size : int, optional
+            Number of texts to buffer in nlp.pipe.
+
+        Yields
+        ------
+        entities : List[Entity]
+            The (start_char, end_char, label, qid, version) records of each text.
+        """
+
+        docs = self._pipe_texts(texts, batch_size)
+        for doc, matches, gazetteer in self._match_stream(docs, batch_size):
+            yield self._extract(doc, matches, gazetteer)
+
+    def extract_doc(self, doc: Doc):
+        """Extract entities from a processed document without creating
+        Span objects or modifying doc.ents.
+
+        Parameters
+        ----------
+        doc : Doc
+            The Doc object to search.
+
+        Returns
+        -------
+        entities : List[Entity]
+            The (start_char, end_char, label, qid, version) records of the doc.
+        """
+
+        return self._extract(doc, None, self.gazetteer)
+
+    def _extract(self, doc: Doc, matches: List, gazetteer: Gazetteer):
+        """The Entity records of the final matches of a document."""
+        entities = []
+        for match in self._get_matches(doc, matches, gazetteer):
+            last = doc[match['end'] - 1]
+            entities.append(Entity(
+                doc[match['start']].idx,
+                last.idx + len(last),
+                match['label'],
+                gazetteer.get_qid(match),
+                gazetteer.version
+            ))
+        return entities
+
+    def export(self, texts: Iterable[str], path, batch_size: int = 1000,
+               chunk_size: int = 1000000, format: str = 'npy'):
+        """Annotate a stream of texts and write the results straight into
+        columnar chunks on disk (doc index, start/end char, start/end token,
+        label id and integer QID). Memory is bounded by `chunk_size` rows.
+        Use `waterwheel.export.load_columns` to read the results back. All
+        texts are annotated with the gazetteer current at the start.
+
+        Parameters
+        ----------
+        texts : Iterable[str]
+            The texts to process.
+        path : Path
+            Directory the chunks are written to, empty or missing.
+        batch_size : int, optional
+            Number of texts to buffer in nlp.pipe.
+        chunk_size : int, optional
+            Number of rows buffered before a chunk is flushed.
+        format : str, optional
+            Either 'npy' or 'parquet' (requires pyarrow).
+
+        Returns
+        -------
+        n_rows : int
+            The number of annotations written.
+        """
+
+        gazetteer = self.gazetteer
+        label_ids = {label: self.nlp.vocab.strings[label] for label in self._pq}
+        with ColumnarWriter(path, gazetteer.ent_ids, chunk_size, format) as writer:
+            docs = self._pipe_texts(texts, batch_size)
+            for doc_index, (doc, matches, _) in enumerate(self._match_stream(docs, batch_size, gazetteer)):
+                for match in self._get_matches(doc, matches, gazetteer):
+                    start, end = match['start'], match['end']
+                    last = doc[end - 1]
+                    writer.add(
+                        doc_index,
+                        doc[start].idx,
+                        last.idx + len(last),
+                        start,
+                        end,
+                        label_ids[match['label']],
+                        qid_to_int(gazetteer.get_qid(match))
+                    )
+        return writer.n_rows
+
+    def index(self, texts: Iterable[str], path, batch_size: int = 1000, segment_size: int = 1000000):
+        """Annotate a stream of texts and append the results to an on-disk
+        inverted index from QID and label to the documents and character
+        offsets of their mentions. Texts are numbered after the documents
+        already in the index. Use `waterwheel.index.InvertedIndex` to query it.
+        All texts are annotated with the gazetteer current at the start.
+
+        Parameters
+        ----------
+        texts : Iterable[str]
+            The texts to process.
+        path : Path
+            Directory of the index, created if missing.
+        batch_size : int, optional
+            Number of texts to buffer in nlp.pipe.
+        segment_size : int, optional
+            Number of rows buffered before a segment is written.
+
+        Returns
+        -------
+        n_docs : int
+            The number of texts indexed.
+        """
+
+        gazetteer = self.gazetteer
+        label_ids = {label: self.nlp.vocab.strings[label] for label in self._pq}
+        n_docs = 0
+        with IndexWriter(path, gazetteer.ent_ids, segment_size) as writer:
+            docs = self._pipe_texts(texts, batch_size)
+            for doc_index, (doc, matches, _) in enumerate(self._match_stream(docs, batch_size, gazetteer)):
+                n_docs = doc_index + 1
+                for match in self._get_matches(doc, matches, gazetteer):
+                    start, end = match['start'], match['end']
+                    last = doc[end - 1]
+                    writer.add(
+                        doc_index,
+                        doc[start].idx,
+                        last.idx + len(last),
+                        label_ids[match['label']],
+                        qid_to_int(gazetteer.get_qid(match))
+                    )
+            writer.n_docs = max(writer.n_docs, n_docs)
+        return n_docs
+
+    def annotate_doc_bins(self, paths: Iterable, path, chunk_size: int = 10000, batch_size: int = 1000):
+        """Add entities to Docs already stored in DocBin files, without
+        tokenizing them again or running the other components. Entities
+        already in the Docs are kept or replaced according to
+        `overwrite_ents`. The Docs are written to numbered DocBin files of
+        `chunk_size` Docs, with their user data, which holds the wikilink
+        and candidates of each entity. Read them with
+        `waterwheel.docbin.load_docs`. One input file and one output chunk
+        are held in memory at a time. All Docs are annotated with the
+        gazetteer current at the start.
+
+        Parameters
+        ----------
+        paths : Iterable
+            The DocBin files to annotate, in order.
+        path : Path
+            Directory the annotated chunks are written to, created if missing.
+        chunk_size : int, optional
+            Number of Docs per output file.
+        batch_size : int, optional
+            Number of Docs matched together.
+
+        Returns
+        -------
+        n_docs : int
+            The number of Docs written.
+        """
+
+        gazetteer = self.gazetteer
+        with DocBinWriter(path, chunk_size=chunk_size) as writer:
+            for file in paths:
+                self.maybe_recycle()
+                doc_bin = read_doc_bin(file)
+                writer.set_attrs(doc_bin.attrs)
+                docs = doc_bin.get_docs(self.nlp.vocab)
+                for doc, matches, _ in self._match_stream(docs, batch_size, gazetteer):
+                    writer.add(self._set_entities(doc, matches, gazetteer))
+                del doc_bin, docs
+        return writer.n_docs
+
+    def extract_raw(self, texts: Iterable[str]):
+        """Extract entities from a stream of short texts, such as titles,
+        filenames or posts, without tokenizing them or creating Doc objects,
+        for first-pass screening of large volumes. Names are found by a
+        character automaton compiled from the gazetteer on first use, which
+        takes a few seconds, and the qualifier, casing, stop word and overlap
+        rules of `extract` are applied to space separated words instead of
+        spaCy tokens. Results closely agree with `extract`; fuzzy matching is
+        not available. All texts are annotated with the gazetteer current at
+        the start.
+
+        Parameters
+        ----------
+        texts : Iterable[str]
+            The texts to process.
+
+        Yields
+        ------
+        entities : List[Entity]
+            The (start_char, end_char, label, qid, version) records of each text.
+        """
+
+        gazetteer = self.gazetteer
+        for text in texts:
+            yield [
+                Entity(match['start'], match['end'], match['label'], gazetteer.get_qid(match), gazetteer.version)
+                for match in self._get_raw_matches(text, gazetteer)
+            ]
+
+    def extract_query(self, text: str):
+        """Extract entities from a short text, such as a search query, with
+        as little overhead per call as possible. The text is only tokenized,
+        without the other components of the pipeline, and its matches are
+        filtered as tuples, without regular expressions or Span objects, in
+        buffers reused by every call of the thread, see
+        waterwheel.query.QueryScratch. Match dicts are only built for the
+        final matches. A text with a single match skips the overlap
+        resolution. The records are those extract_doc returns for
+        the tokenized text. With `fuzzy` or `collect_stats`, extract_doc is
+        used.
+
+        Parameters
+        ----------
+        text : str
+            The text to process, typically a few tokens long.
+
+        Returns
+        -------
+        entities : List[Entity]
+            The (start_char, end_char, label, qid, version) records of the text.
+        """
+
+        gazetteer = self.gazetteer
+        doc = self.nlp.tokenizer(text)
+        if gazetteer.fuzzy_index is not None or self.stats is not None:
+            return self._extract(doc, None, gazetteer)
+        return self._get_query_matches(doc, gazetteer)
+
+    def _get_query_matches(self, doc: Doc, gazetteer: Gazetteer):
+        """The Entity records of a short document, applying the rules of
+        _get_matches to tuples in the scratch buffers of the thread."""
+        n_tokens = len(doc)
+        matches = gazetteer.matcher(doc)
+        if not matches:
+            return []
+        scratch.reset(n_tokens)
+        text = doc.text
+        # the start and end character of each token.
+        bounds = [(token.idx, token.idx + len(token)) for token in doc]
+        matches = sorted([(start, end, gazetteer.ent_ids.get(m_id, DEFAULT_LABEL)) for m_id, start, end in matches if start != end])
+        hits = set()
+        deadline = time.perf_counter() + self._time_budget if self._time_budget > 0 else None
+        if 0 < self._max_candidates < len(matches):
+            matches = matches[:self._max_candidates]
+            hits.add('candidates')
+        candidates = scratch.candidates
+        for start, end, label in matches:
+            if deadline is not None and time.perf_counter() > deadline:
+                hits.add('time_budget')
+                break
+            match_str = text[bounds[start][0]:bounds[end - 1][1]]
+            word_before = text[bounds[start - 1][0]:bounds[start - 1][1]] if start > 0 else ''
+            word_after = text[bounds[end][0]:bounds[end][1]] if end < n_tokens else ''
+            qualifiers = gazetteer.qualifiers.get(label, ())
+            q_before = word_before.lower() in qualifiers
+            q_after = word_after.lower() in qualifiers
+            rejection, is_stop_word, is_improper_noun = self._check_match(
+                label, match_str, q_before or q_after, word_after, gazetteer
+            )
+            if rejection is not None:
+                continue
+            end += q_after
+            # precedence given to proceeding qualifier over preceding one.
+            start -= q_before and not q_after
+            candidates.append((start, end, label, match_str.lower(), q_before or q_after,
+                               not is_stop_word, not is_improper_noun))
+        if len(candidates) > 1:
+            final_matches = self._resolve_query_overlaps(candidates, hits)
+        else:
+            final_matches = candidates
+        final_matches = [{'start': start, 'end': end, 'label': label, 'name': name}
+                         for start, end, label, name, *_ in final_matches]
+        if self._geo_disambiguation and len(final_matches) > 1:
+            self._disambiguate(final_matches, gazetteer)
+        self._record_limits(doc, hits)
+        return [
+            Entity(bounds[match['start']][0], bounds[match['end'] - 1][1], match['label'],
+                   gazetteer.get_qid(match), gazetteer.version)
+            for match in final_matches
+        ]
+
+    def _resolve_query_overlaps(self, candidates: List, hits: set):
+        """Choose the final matches among the candidate tuples of
+        _get_query_matches, like _resolve_overlaps. The cascade of
+        _filter_matches orders a group of overlapping matches by whether
+        they are uncommon, qualified and proper nouns, then by start,
+        priority and descending length, which is a single stable sort.
+        """
+
+        candidates.sort(key = lambda x: x[0])
+        # groups are consecutive, so a match starting before the end of the
+        # current group overlaps it.
+        keys = []
+        group, group_end, group_size = -1, -1, 0
+        for start, end, label, _, is_qualified, is_uncommon, is_proper_noun in candidates:
+            if start < group_end and (self._max_group_size <= 0 or group_size < self._max_group_size):
+                group_end = max(group_end, end)
+                group_size += 1
+            else:
+                if start < group_end:
+                    hits.add('group_size')
+                group += 1
+                group_end, group_size = end, 1
+            keys.append((group, not is_uncommon, not is_qualified, not is_proper_noun,
+                         start, self._pq[label], start - end))
+        seen, taken = scratch.seen, scratch.taken
+        final_matches = []
+        for i in sorted(range(len(candidates)), key = keys.__getitem__):
+            start, end = candidates[i][0], candidates[i][1]
+            if seen[start] and seen[end - 1]:
+                continue
+            seen[start:end] = b'\x01' * (end - start)
+            # skip overlapping or intersecting matches.
+            if 1 in taken[start:end]:
+                continue
+            taken[start:end] = b'\x01' * (end - start)
+            final_matches.append(candidates[i])
+        return final_matches
+
+    def extract_long(self, text: str, window: int = 100000):
+        """Extract entities from a text too long to be processed as a
+        single Doc. The text is processed in windows of about `window`
+        characters, cut at whitespace. The entities of a window are kept up
+        to a cut token that no potential match, qualifier or fuzzy span
+        crosses, and the next window starts at that token. The result is the
+        same as matching the whole text at once, while memory is bounded by
+        the window size. A window without such a cut token is doubled. The
+        document-level geographic disambiguation only sees one window. The
+        whole text is annotated with the gazetteer current at the start.
+
+        Parameters
+        ----------
+        text : str
+            The text to process.
+        window : int, optional
+            Number of characters processed at a time.
+
+        Yields
+        ------
+        entity : Entity
+            The (start_char, end_char, label, qid, version) records of the text.
+        """
+
+        self.maybe_recycle()
+        gazetteer = self.gazetteer
+        # furthest a match can reach: the longest pattern plus its qualifiers.
+        horizon = gazetteer.max_pattern_length + 2
+        offset = 0
+        size = window
+        while offset < len(text):
+            end = min(offset + size, len(text))
+            if end < len(text):
+                # cut at whitespace so the last tokens of the window are whole.
+                while end > offset and not text[end - 1].isspace():
+                    end -= 1
+                if end == offset:
+                    end = offset + size
+            doc = self.nlp(text[offset:end], disable=[self.name])
+            matches = list(gazetteer.matcher(doc))
+            cut = len(doc) if end == len(text) else self._find_cut(doc, matches, horizon, gazetteer)
+            if cut is None:
+                size *= 2
+                continue
+            yield from self._window_entities(doc, matches, cut, offset, gazetteer)
+            if cut == len(doc):
+                break
+            offset += doc[cut].idx
+            size = window
+
+    def _find_cut(self, doc: Doc, matches: List, horizon: int, gazetteer: Gazetteer, lowest: int = None):
+        """Find the last token of the second half of a window, at least
+        `horizon` tokens from its end, where the window can be cut without
+        changing any match. The token follows whitespace, is not inside or
+        at the edge of a potential match, is not a qualifier and, with a
+        fuzzy index, cannot start a fuzzy span.
+
+        Parameters
+        ----------
+        lowest : int, optional
+            The first token that can be a cut, the middle of the window by
+            default.
+
+        Returns
+        -------
+        cut : int
+            The token index, or None if there is no such token.
+        """
+
+        if lowest is None:
+            lowest = len(doc) // 2
+        fuzzy = gazetteer.fuzzy_index is not None
+        blocked = set()
+        for _, start, end in matches:
+            if end >= lowest:
+                blocked.update(range(start, end + 1))
+        for i in range(len(doc) - horizon, max(lowest, 1) - 1, -1):
+            token = doc[i]
+            if (i in blocked or not doc[i - 1].whitespace_ or (fuzzy and token.text[:1].isupper())
+                    or token.lower_ in gazetteer.qualifier_words):
+                continue
+            return i
+        return None
+
+    def _window_entities(self, doc: Doc, matches: List, cut: int, offset: int, gazetteer: Gazetteer):
+        """The Entity records of the final matches of a window that start
+        before the cut token, with character offsets shifted by `offset`,
+        see extract_long and waterwheel.stream."""
+        entities = []
+        for match in self._get_matches(doc, matches, gazetteer):
+            if match['start'] >= cut:
+                continue
+            last = doc[match['end'] - 1]
+            entities.append(Entity(
+                offset + doc[match['start']].idx,
+                offset + last.idx + len(last),
+                match['label'],
+                gazetteer.get_qid(match),
+                gazetteer.version
+            ))
+        return entities
+
+    def _get_matches(self, doc: Doc, matches: List = None, gazetteer: Gazetteer = None):
+        """Find the final non overlapping matches in a document.
+
+        Parameters
+        ----------
+        doc : Doc
+            The Doc object to search.
+        matches : List, optional
+            The phrase matcher results for doc, if already available.
+        gazetteer : Gazetteer, optional
+            The gazetteer to match with, the current one by default.
+
+        Returns
+        -------
+        final_matches : List
+            List of match dicts in the order they are to be added to doc.ents.
+        """
+
+        if gazetteer is None:
+            gazetteer = self.gazetteer
+        if matches is None:
+            matches = list(gazetteer.matcher(doc))
+        matches = sorted([(start, end, gazetteer.ent_ids.get(m_id, DEFAULT_LABEL)) for m_id, start, end in matches if start != end])
+        hits = set()
+        deadline = time.perf_counter() + self._time_budget if self._time_budget > 0 else None
+        if 0 < self._max_candidates < len(matches):
+            matches = matches[:self._max_candidates]
+            hits.add('candidates')
+        stats = self.stats
         match_dicts = []
         # stick together qualifiers with matcher wherever possible.
         for start, end, label in matches:
-            if any(t.ent_type for t in doc[start:end]) and not self.overwrite:
-                continue
+            if deadline is not None and time.perf_counter() > deadline:
+                hits.add('time_budget')
+                break
             match_str = str(doc[start:end])
-            is_non_alphabetical = re.search('^[^a-zA-Z\d]+$', match_str) is not None
-            if is_non_alphabetical:
+            word_after = str(doc[end:end+1])
+            qualifiers = gazetteer.qualifiers.get(label, ())
+            q_before = str(doc[start-1:start]).lower() in qualifiers
+            q_after = word_after.lower() in qualifiers
+            if any(t.ent_type for t in doc[start:end]) and not self.overwrite:
+                rejection, is_stop_word, is_improper_noun = 'entity', False, False
+            else:
+                rejection, is_stop_word, is_improper_noun = self._check_match(
+                    label, match_str, q_before or q_after, word_after, gazetteer
+                )
+            if rejection is not None:
+                if stats is not None:
+                    stats.record(label, match_str.lower(), rejection, q_before or q_after)
                 continue
-            is_all_caps = re.search('^[\sA-Z]+$', match_str) is not None
-            is_all_lower =  re.search('^[\sa-z]+$', match_str) is not None
-            is_improper_noun = is_all_caps or is_all_lower
-            is_stop_word = match_str.lower() in self._stop_words
-            q_before = str(doc[start-1:start]).lower() in self._qualifiers[label]
-            q_after = str(doc[end:end+1]).lower() in self._qualifiers[label]
             end += q_after
             # precedence given to proceeding qualifier over preceding one.
             start -= q_before and not q_after
-            # prelimenary filters
-            if not (q_before or q_after):
-                # skip unqualified/improper/stop_words
-                # unless it is province abbreviation
-                if label in ['US_STATE', 'CANADIAN_PROVINCE']:
-                    # all abbreviations are 4 chars or less.
-                    if len(match_str) < 5:
-                        if not is_all_caps:
-                            continue
-                    elif is_stop_word or is_improper_noun:
-                        continue
-                    #quick filter to filter out CT Scan to avoid ambiguity
-                    if (match_str == 'CT' and str(doc[end:end+1]).lower() == 'scan'):
-                        continue
-                elif is_stop_word or is_improper_noun:
-                    continue
-            if self._disable_abbreviations:
-                if label in ['US_STATE', 'CANADIAN_PROVINCE'] and len(match_str) < 5:
-                    continue
             match_dicts.append({
                 'match_str': match_str,
+                'name': match_str.lower(),
                 'start': start, 
                 'end': end, 
                 'label': label,
@@ -121,42 +954,409 @@ class WaterWheel(EntityRuler):
                 'length': end - start,
                 'priority': self._pq[label]
             })
+        taken = set()
+        if not self.overwrite:
+            taken.update(i for ent in doc.ents for i in range(ent.start, ent.end))
+        final_matches = self._resolve_overlaps(match_dicts, taken, hits)
+        if stats is not None:
+            kept = set(id(match) for match in final_matches)
+            for match in match_dicts:
+                outcome = 'kept' if id(match) in kept else 'overlap'
+                stats.record(match['label'], match['name'], outcome, match['is_qualified'])
+        if gazetteer.fuzzy_index is not None and 'time_budget' not in hits:
+            final_matches.extend(self._get_fuzzy_matches(doc, taken, gazetteer, hits, deadline))
+            final_matches.sort(key = lambda x: x['start'])
+        if self._geo_disambiguation:
+            self._disambiguate(final_matches, gazetteer)
+        self._record_limits(doc, hits)
+        return final_matches
+
+    def _record_limits(self, doc: Doc, hits: set):
+        """Flag a document that hit limits, see max_candidates,
+        max_group_size and time_budget."""
+        if hits:
+            self.n_limited += 1
+            if doc is not None:
+                doc._.set('limits_hit', sorted(hits))
+
+    def _check_match(self, label: str, match_str: str, is_qualified: bool, word_after: str, gazetteer: Gazetteer):
+        """Apply the preliminary filters to a phrase match.
+
+        Parameters
+        ----------
+        label : str
+            The label of the match.
+        match_str : str
+            The text of the match, without qualifiers.
+        is_qualified : bool
+            Whether a qualifier of the label precedes or follows the match.
+        word_after : str
+            The text of the token following the match, '' if none.
+        gazetteer : Gazetteer
+            The gazetteer the match comes from.
+
+        Returns
+        -------
+        rejection, is_stop_word, is_improper_noun : Tuple[str, bool, bool]
+            The rule rejecting the match, see waterwheel.stats.REJECTIONS,
+            or None if it passes, and the flags used to rank it.
+        """
+
+        if is_symbols(match_str):
+            return 'symbols', False, False
+        name = match_str.lower()
+        if not is_qualified and name in gazetteer.needs_qualifier.get(label, ()):
+            # patterns that never survived unqualified in a corpus, see scripts/util.py.
+            return 'needs_qualifier', False, False
+        all_caps = is_all_caps(match_str)
+        is_improper_noun = all_caps or is_all_lower(match_str)
+        is_stop_word = name in gazetteer.stop_words
+        rejection = None
+        # prelimenary filters
+        if not is_qualified:
+            # skip unqualified/improper/stop_words
+            # unless it is province abbreviation
+            if label in ['US_STATE', 'CANADIAN_PROVINCE']:
+                # all abbreviations are 4 chars or less.
+                if len(match_str) < 5:
+                    if not all_caps:
+                        rejection = 'casing'
+                elif is_stop_word or is_improper_noun:
+                    rejection = 'stop_word' if is_stop_word else 'casing'
+                #quick filter to filter out CT Scan to avoid ambiguity
+                if rejection is None and match_str == 'CT' and word_after.lower() == 'scan':
+                    rejection = 'context'
+            elif is_stop_word or is_improper_noun:
+                rejection = 'stop_word' if is_stop_word else 'casing'
+        if rejection is None and self._disable_abbreviations:
+            if label in ['US_STATE', 'CANADIAN_PROVINCE'] and len(match_str) < 5:
+                rejection = 'abbreviation'
+        return rejection, is_stop_word, is_improper_noun
+
+    def _resolve_overlaps(self, match_dicts: List, taken: set, hits: set = None):
+        """Choose the final matches among overlapping ones, see _filter_matches.
+
+        Parameters
+        ----------
+        match_dicts : List
+            The matches that passed the preliminary filters.
+        taken : set
+            Positions already covered by entities. Updated in place.
+        hits : set, optional
+            Names of the limits the document hit. Updated in place.
+
+        Returns
+        -------
+        final_matches : List
+            The non overlapping matches.
+        """
+
+        if hits is None:
+            hits = set()
         match_dicts = sorted(match_dicts, key = lambda x: x['start'])
-        current_range = set()
+        group_end = -1
         match_groups = []
-        # arrange the matches in overlapping groups.
+        # arrange the matches in overlapping groups. Matches are sorted by
+        # start, so a match overlaps the current group if it starts before
+        # the group ends.
         for match in match_dicts:
-            if match['start'] in current_range or match['end'] - 1 in current_range:
-                current_range.update(range(match['start'], match['end']))
-            else:
-                current_range = set(range(match['start'], match['end']))
-                match_groups.append([])
-            match_groups[-1].append(match)
+            if match['start'] < group_end:
+                if self._max_group_size <= 0 or len(match_groups[-1]) < self._max_group_size:
+                    group_end = max(group_end, match['end'])
+                    match_groups[-1].append(match)
+                    continue
+                hits.add('group_size')
+            group_end = match['end']
+            match_groups.append([match])
         # filter out best matches in each group.
-        final_matches = self._filter_matches(match_groups)
-        # set wikilinks to final matches.
-        for match in final_matches:
-            span = Span(doc, match['start'], match['end'], label = match['label'])
-            span._.set(
-                'wikilink',
-                'https://www.wikidata.org/wiki/' + self._wikidata[match['label']].get(match['match_str'].lower())
-            )
-            try:
-                doc.ents = list(doc.ents) + [span]
-            except ValueError:
+        final_matches = []
+        seen = set()
+        for group in match_groups:
+            for match in self._filter_matches([group], seen):
                 # skip overlapping or intersecting matches.
+                if any(i in taken for i in range(match['start'], match['end'])):
+                    continue
+                taken.update(range(match['start'], match['end']))
+                final_matches.append(match)
+        return final_matches
+
+    def _get_raw_matches(self, text: str, gazetteer: Gazetteer):
+        """Find the final non overlapping matches in a raw text, applying
+        the rules of _get_matches to words instead of tokens.
+
+        Parameters
+        ----------
+        text : str
+            The text to search.
+        gazetteer : Gazetteer
+            The gazetteer to match with.
+
+        Returns
+        -------
+        final_matches : List
+            List of match dicts, with character offsets as start and end.
+        """
+
+        lowered = lowercase(text)
+        match_dicts = []
+        for start, end in gazetteer.raw_matcher(self._abbreviations)(lowered):
+            match_str = text[start:end]
+            name = lowered[start:end]
+            if is_symbols(match_str):
                 continue
-        return doc
-        
-    
+            before = PREVIOUS_WORD.search(lowered, max(start - MAX_QUALIFIER, 0), start)
+            after = NEXT_WORD.match(lowered, end)
+            word_before = before.group(1) if before is not None else None
+            word_after = after.group(1) if after is not None else None
+            # a following period can belong to the qualifier, as in 'mt.'.
+            abbreviation_after = word_after + '.' if after is not None and after.group(2) else None
+            for label, links in gazetteer.wikidata.items():
+                if name not in links:
+                    continue
+                qualifiers = gazetteer.qualifiers.get(label, ())
+                q_before = word_before in qualifiers
+                q_abbreviation = abbreviation_after in qualifiers
+                q_after = word_after in qualifiers or q_abbreviation
+                # the same rules as the matches of a Doc.
+                rejection, is_stop_word, is_improper_noun = self._check_match(
+                    label, match_str, q_before or q_after, word_after or '', gazetteer
+                )
+                if rejection is not None:
+                    continue
+                # precedence given to proceeding qualifier over preceding one.
+                match_start = before.start(1) if q_before and not q_after else start
+                match_end = after.end(2 if q_abbreviation else 1) if q_after else end
+                length = len(match_str.split()) + (q_before or q_after)
+                match_dicts.append({
+                    'match_str': match_str,
+                    'name': name,
+                    'start': match_start,
+                    'end': match_end,
+                    'label': label,
+                    'is_qualified': q_before or q_after,
+                    'is_uncommon': not is_stop_word,
+                    'is_proper_noun': not is_improper_noun,
+                    'length': length,
+                    'priority': self._pq[label]
+                })
+        hits = set()
+        final_matches = self._resolve_overlaps(match_dicts, set(), hits)
+        if self._geo_disambiguation:
+            self._disambiguate(final_matches, gazetteer)
+        self._record_limits(None, hits)
+        return final_matches
+
+    def _disambiguate(self, matches: List, gazetteer: Gazetteer):
+        """Link matches with several candidates to the candidate in the
+        admin area of, or else closest to, the unambiguous matches of the
+        same document. Matches keep their top prior candidate when there
+        is nothing to compare to. At most MAX_GEO_ANCHORS unambiguous and
+        MAX_GEO_CANDIDATES candidates per match are compared.
+
+        Parameters
+        ----------
+        matches : List
+            The final matches of a document. Resolved matches get a 'qid'.
+        gazetteer : Gazetteer
+            The gazetteer the matches were found with.
+        """
+
+        anchors = []
+        anchor_qids = set()
+        ambiguous = []
+        for match in matches:
+            table = gazetteer.candidates.get(match['label'])
+            if table is None or not table.has_coordinates():
+                continue
+            n_candidates = table.count(match['name'])
+            if n_candidates == 1:
+                qids, lats, lons, _ = table.coordinates(match['name'])
+                anchor_qids.add(int(qids[0]))
+                if lats[0] != MISSING and len(anchors) < MAX_GEO_ANCHORS:
+                    anchors.append((int(lats[0]), int(lons[0])))
+            elif n_candidates > 1:
+                ambiguous.append((match, table))
+        if not anchor_qids:
+            return
+        for match, table in ambiguous:
+            qids, lats, lons, admins = table.coordinates(match['name'], MAX_GEO_CANDIDATES)
+            in_admin = numpy.isin(admins, list(anchor_qids))
+            if anchors:
+                distances = closest(lats, lons, anchors)
+            else:
+                distances = numpy.full(len(qids), numpy.inf)
+            if not in_admin.any() and numpy.isinf(distances).all():
+                continue
+            # candidates in an anchor's admin area first, then by distance.
+            best = numpy.lexsort((distances, ~in_admin))[0]
+            match['qid'] = 'Q' + str(qids[best])
+
+    def _get_fuzzy_matches(self, doc: Doc, taken: set, gazetteer: Gazetteer, hits: set = None,
+                           deadline: float = None):
+        """Find approximate matches for runs of capitalized tokens that
+        the exact matcher missed. Runs are searched left to right, longest
+        span first, and a following or preceding qualifier is attached to a
+        match like in the exact path.
+
+        Parameters
+        ----------
+        doc : Doc
+            The Doc object to search.
+        taken : set
+            Indices of tokens already covered by entities. Updated in place.
+        gazetteer : Gazetteer
+            The gazetteer with the fuzzy index.
+        hits : set, optional
+            Names of the limits the document hit. Updated in place.
+        deadline : float, optional
+            The time.perf_counter() after which the search stops, see
+            time_budget.
+
+        Returns
+        -------
+        fuzzy_matches : List
+            List of match dicts.
+        """
+
+        qualifier_words = gazetteer.qualifier_words
+        fuzzy_matches = []
+        start = 0
+        while start < len(doc):
+            if deadline is not None and time.perf_counter() > deadline:
+                hits.add('time_budget')
+                break
+            token = doc[start]
+            if start in taken or not token.text[:1].isupper() or token.lower_ in qualifier_words:
+                start += 1
+                continue
+            end = start
+            while end < len(doc) and end - start < MAX_FUZZY_TOKENS and end not in taken and doc[end].text[:1].isupper():
+                end += 1
+            match = None
+            for length in range(end - start, 0, -1):
+                match_str = str(doc[start:start + length])
+                if match_str.lower() in gazetteer.stop_words or doc[start + length - 1].lower_ in qualifier_words:
+                    continue
+                if is_all_caps(match_str):
+                    continue
+                names = gazetteer.fuzzy_index.lookup(match_str)
+                if names:
+                    match = self._make_fuzzy_match(doc, start, start + length, match_str, names, taken, gazetteer)
+                    break
+            if match is None:
+                start += 1
+                continue
+            taken.update(range(match['start'], match['end']))
+            fuzzy_matches.append(match)
+            start = match['end']
+        return fuzzy_matches
+
+    def _make_fuzzy_match(self, doc: Doc, start: int, end: int, match_str: str, names: List, taken: set,
+                          gazetteer: Gazetteer):
+        """Choose the label of a fuzzy match by qualifier, then by type priority."""
+        before = str(doc[start-1:start]).lower() if start - 1 not in taken else None
+        after = str(doc[end:end+1]).lower() if end not in taken else None
+        candidates = []
+        for name in names:
+            for label in gazetteer.wikidata:
+                if name in gazetteer.wikidata[label]:
+                    qualifiers = gazetteer.qualifiers.get(label, ())
+                    q_before = before in qualifiers
+                    q_after = after in qualifiers
+                    candidates.append((not (q_before or q_after), self._pq[label], name, label, q_before, q_after))
+        _, _, name, label, q_before, q_after = min(candidates)
+        end += q_after
+        start -= q_before and not q_after
+        return {
+            'match_str': match_str,
+            'name': name,
+            'start': start,
+            'end': end,
+            'label': label,
+            'is_qualified': q_before or q_after,
+            'is_uncommon': True,
+            'is_proper_noun': True,
+            'length': end - start,
+            'priority': self._pq[label]
+        }
+
+    def get_candidates(self, label: str, name: str):
+        """All Wikidata ids a gazetteer name can refer to.
+
+        Parameters
+        ----------
+        label : str
+            The entity type, eg 'LAKE'.
+        name : str
+            The lowercased gazetteer name, eg 'mud'.
+
+        Returns
+        -------
+        candidates : List[Tuple[str, int]]
+            (qid, prior) tuples sorted by descending prior. The first one is
+            the id used for the wikilink.
+        """
+
+        return self.gazetteer.get_candidates(label, name)
+
+    def get_aliases(self, qid: str, label: str = None):
+        """All gazetteer names of a Wikidata id, eg to expand a linked
+        entity into search terms. A lookup in the reverse index built when
+        the gazetteer is loaded, see waterwheel.candidates.AliasIndex.
+
+        Parameters
+        ----------
+        qid : str
+            eg 'Q3411'.
+        label : str, optional
+            If set then only the names listed under this label, eg 'RIVER'.
+
+        Returns
+        -------
+        names : List[str]
+            The distinct lowercased names, those for which the qid is the
+            top candidate first. Empty if the qid is unknown.
+        """
+
+        return self.gazetteer.aliases.names(qid, label)
+
+    @property
+    def network(self):
+        """The river network of the gazetteer, used for upstream, downstream
+        and drainage basin queries on linked ids, eg
+        ww.network.is_upstream(qid, 'Q3411'). None if the gazetteer was
+        built without one.
+
+        Returns
+        -------
+        network : RiverNetwork
+            The network, see waterwheel.network.RiverNetwork.
+        """
+
+        return self.gazetteer.network
+
     def __len__(self):
         """The number of all water_bodies."""
-        n_phrases = 0
-        for key in self._doc_bins:
-            n_phrases += len(self._doc_bins[key])
-        return n_phrases
+        return len(self.gazetteer)
+
+    def memory_report(self):
+        """Approximate memory used by each component, in bytes. Objects
+        shared between components are counted once. The phrase matcher is
+        measured as the growth of the resident set size while it was built.
+
+        Returns
+        -------
+        report : OrderedDict
+            Mapping of component name to bytes, with the current resident
+            set size of the whole process under 'process_rss'.
+        """
+
+        report = self.gazetteer.memory_report()
+        report['vocab_strings'] = sum(len(string.encode('utf8')) for string in self.nlp.vocab.strings)
+        report['process_rss'] = rss()
+        return report
     
-    def _filter_matches(self, match_groups: List):
+    def _filter_matches(self, match_groups: List, seen: set = None):
         """Filter matches according to following procedure:
         In case of overlap, give precedence to uncommon words over common words.
             Example: In 'The Lake Ontario', 'Lake Ontario' is chosen over 'The Lake'.
@@ -177,6 +1377,9 @@ class WaterWheel(EntityRuler):
         ----------
         match_groups : List
             List of matches in same overlapping regions.
+        seen : set, optional
+            Positions covered by the matches chosen in previous groups.
+            Updated in place.
         
         Returns
         -------
@@ -184,7 +1387,8 @@ class WaterWheel(EntityRuler):
             List of non overlapping matches filtered by the procedure.
         """
         final_matches = []
-        seen = set()
+        if seen is None:
+            seen = set()
         for group in match_groups:
             ordered_lists = [[i for i in range(len(group))]]
             new_ordered_lists = []
@@ -288,16 +1492,7 @@ class WaterWheel(EntityRuler):
             The serialized bytes data.
         """
 
-        doc_bins_bytes = {key: bin.to_bytes() for key, bin in self._doc_bins.items()}
-        serial = OrderedDict(
-            (
-                ('stop_words', list(self._stop_words)),
-                ('vocab', self._ent_ids),
-                ('wikidata', self._wikidata),
-                ('doc_bins', doc_bins_bytes),
-            )
-        )
-        return srsly.msgpack_dumps(serial)
+        return self.gazetteer.to_bytes()
     
     def from_bytes(self, serial: bytes, **kwargs):
         """Load waterwheel from a bytestring.
@@ -313,22 +1508,10 @@ class WaterWheel(EntityRuler):
             The loaded WaterWheel object.
         """
 
-        cfg = srsly.msgpack_loads(serial)
-        if isinstance(cfg, dict):
-            vocab = cfg.get('vocab', {})
-            for hash, label in vocab.items():
-                self._ent_ids[int(hash)] = label
-                self._qualifiers[label] = [label.lower(), label.lower()+'s']
-            self._qualifiers['MOUNTAIN'].extend(['mount', 'mounts', 'mt.'])
-            self._stop_words = cfg.get('stop_words', [])
-            self._stop_words = set(self._stop_words)
-            self._wikidata = cfg.get('wikidata', {})
-
-            doc_bins_bytes = cfg.get('doc_bins', {})
-            self._doc_bins = {key: DocBin().from_bytes(value) for key, value in doc_bins_bytes.items()}
-            phrases_bin = {key: list(bin.get_docs(self.nlp.vocab)) for key, bin in self._doc_bins.items()}
-            for key, phrases in phrases_bin.items():
-                self.phrase_matcher.add(key.upper(), phrases)
+        self._progress = 0.0
+        self._gazetteer = self._build_gazetteer(serial, self._set_progress)
+        self._gazetteer_path = None
+        self._progress = 1.0
         return self
 
     def to_disk(self, path, **kwargs):
@@ -352,6 +1535,9 @@ class WaterWheel(EntityRuler):
             'vocab': {},
             'wikidata': {},
             'doc_bins': doc_bins_bytes,
+            'candidates': {},
+            'network': {},
+            'needs_qualifier': {},
         }
 
         Parameters
@@ -369,4 +1555,55 @@ class WaterWheel(EntityRuler):
         with open(path, 'rb') as file:
             serial = file.read()
         self.from_bytes(serial)
+        self._gazetteer_path = path
         return self
+
+    def __getstate__(self):
+        """Pickle a reference to the gazetteer, its file and version, in
+        place of the gazetteer and its matcher. The copy loads it on first
+        use through the shared gazetteers of its process, see
+        Gazetteer.shared: a forked worker finds the gazetteer of its parent,
+        and a spawned one builds it once for all its WaterWheels.
+        """
+
+        gazetteer = self.gazetteer
+        if self._gazetteer_path is None:
+            raise pickle.PicklingError('only a WaterWheel whose gazetteer was loaded from a file can be pickled')
+        state = {key: value for key, value in self.__dict__.items() if key not in UNPICKLED}
+        state['_reference'] = (str(self._gazetteer_path), gazetteer.version)
+        return state
+
+    def __setstate__(self, state: dict):
+        """Restore a pickled WaterWheel. Its nlp object may still be
+        unpickling, so the gazetteer is only attached on first use. The
+        extensions are registered again, as spaCy 2.2 does not pass them
+        to the worker processes of nlp.pipe."""
+        self.__dict__.update(state)
+        self._set_extensions()
+        self._gazetteer = None
+        self._reload_lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._loaded.set()
+
+    def _attach(self):
+        """Find or load the gazetteer of an unpickled WaterWheel."""
+        with self._reload_lock:
+            if self._reference is None:
+                return
+            path, version = self._reference
+            gazetteer = None
+            if self._share_gazetteer:
+                gazetteer = Gazetteer.find(
+                    version, self.nlp.vocab, self._fuzzy, self._max_edit_distance, self._compact, self._engine
+                )
+            if gazetteer is None:
+                with open(path, 'rb') as file:
+                    gazetteer = self._build_gazetteer(file.read())
+                if gazetteer.version != version:
+                    raise ValueError(f'{path} changed since the WaterWheel was pickled, '
+                                     f'its version is {gazetteer.version} instead of {version}')
+            self.matcher = Matcher(self.nlp.vocab)
+            self.phrase_matcher = PhraseMatcher(self.nlp.vocab, attr=self.phrase_matcher_attr)
+            self._gazetteer = gazetteer
+            self._gazetteer_path = ensure_path(path)
+            self._reference = None